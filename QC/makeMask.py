@@ -20,24 +20,31 @@ License along with this library; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 '''
 
+import os
 import nibabel as nib
 import numpy as np
 import argparse
 
-def makeMask(inputFile, roi):
+def makeMask(inputFile, roi, output=None):
+    '''
+    Writes a uint8 mask (255 inside) of the voxels of inputFile whose label is one of the ROI IDs in roi, in one
+    pass over the label volume. Returns the output file name.
+    '''
     fileprefix = inputFile.split('.')[0]
+    if output is None:
+        output = fileprefix + '.pvc.edge.mask.nii.gz'
     nii = nib.load(inputFile)
-    output=fileprefix + '.pvc.edge.mask.nii.gz'
+    labels = np.asanyarray(nii.dataobj)
 
-    data = nii.get_data()
+    mask = np.isin(labels, np.array([int(i) for i in roi], dtype=labels.dtype)).astype(np.uint8) * np.uint8(255)
 
-    for i in roi:
-        data[data == int(i)] = 255
-
-    data[data < 255] = 0
-
-    recon = nib.Nifti1Image(data.astype(np.int8), nii._affine)
-    nib.save(recon, output)
+    recon = nib.Nifti1Image(mask, nii.affine)
+    # the BDP and BFP nodes write the same mask, possibly at the same time
+    tmpFile = '{0}.{1}.tmp.nii.gz'.format(output[:-len('.nii.gz')] if output.endswith('.nii.gz') else output,
+                                          os.getpid())
+    nib.save(recon, tmpFile)
+    os.rename(tmpFile, output)
+    return output
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Create mask using ROI IDs from BrainSuite.')
@@ -50,19 +57,7 @@ def parse_args():
 
 def main():
     args = parse_args()
-    fileprefix = args.inputFile.split('.')[0]
-    nii = nib.load(args.inputFile)
-    output=fileprefix + '.pvc.edge.mask.nii.gz'
-
-    data = nii.get_data()
-
-    for i in args.roi:
-        data[data == int(i)] = 255
-
-    data[data < 255] = 0
-
-    recon = nib.Nifti1Image(data.astype(np.int8), nii._affine)
-    nib.save(recon, output)
+    makeMask(args.inputFile, args.roi)
 
 if __name__ == '__main__':
  main()
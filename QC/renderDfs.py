@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import numpy as np
+import nibabel as nib
+from QC.renderVolslice import writePNG
+
+# defaults of renderdfs
+WIDTH = 512
+HEIGHT = 512
+SURFACE_COLOR = (0.8, 0.8, 0.8)
+AMBIENT = 0.25
+# largest number of samples along a triangle edge when rasterizing
+MAX_SAMPLES = 6
+
+# (direction towards the viewer, image right, image up) in RAS coordinates
+VIEWS = {
+    'Left': ((-1, 0, 0), (0, -1, 0), (0, 0, 1)),
+    'Right': ((1, 0, 0), (0, 1, 0), (0, 0, 1)),
+    'Sup': ((0, 0, 1), (1, 0, 0), (0, 1, 0)),
+    'Inf': ((0, 0, -1), (-1, 0, 0), (0, 1, 0)),
+    'Ant': ((0, 1, 0), (-1, 0, 0), (0, 0, 1)),
+    'Pos': ((0, -1, 0), (1, 0, 0), (0, 0, 1))
+}
+
+def readDFS(filename):
+    '''
+    Reads a BrainSuite surface (.dfs). Returns the faces (0-indexed), the vertices (mm, in the voxel frame
+    of the volume it was generated from) and the vertex colors (RGB in [0, 1]) or None.
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    endian = '>' if data[:6] == b'DFS_BE' else '<'
+    header = np.frombuffer(data, dtype=endian + 'i4', count=12, offset=12)
+    hdrsize, nTriangles, nVertices, vcoffset = header[0], header[3], header[4], header[9]
+    faces = np.frombuffer(data, dtype=endian + 'i4', count=3 * nTriangles, offset=hdrsize).reshape(-1, 3)
+    vertices = np.frombuffer(data, dtype=endian + 'f4', count=3 * nVertices,
+                             offset=hdrsize + 12 * nTriangles).reshape(-1, 3).astype(np.float64)
+    colors = None
+    if vcoffset > 0:
+        colors = np.frombuffer(data, dtype=endian + 'f4', count=3 * nVertices,
+                               offset=vcoffset).reshape(-1, 3).astype(np.float64)
+    return faces, vertices, colors
+
+def parseColor(value, default):
+    '''
+    Parses a color given as 'r g b' (in [0, 1], or 0-255).
+    '''
+    if not value:
+        return np.asarray(default, dtype=np.float64)
+    color = np.array([float(c) for c in value.split()], dtype=np.float64)
+    return color / 255.0 if color.max() > 1 else color
+
+class surfaceScene(object):
+    '''
+    Surfaces loaded once and rendered from several views. Vertices are mapped to RAS world coordinates with
+    the affine of centerVol, if it is given; views are orthographic and centered on centerVol (or on the
+    surfaces). At zoom 1, the largest extent of the surfaces fills the image.
+    '''
+
+    def __init__(self, surfaces, centerVol=None, useColors=None, grey=False):
+        affine = np.eye(4)
+        center = None
+        if centerVol:
+            img = nib.load(centerVol)
+            zooms = np.asarray(img.header.get_zooms()[:3], dtype=np.float64)
+            affine = img.affine.dot(np.diag(list(1.0 / zooms) + [1]))
+            center = img.affine.dot(list((np.asarray(img.shape[:3]) - 1) / 2.0) + [1])[:3]
+        perSurface = None
+        if useColors:
+            perSurface = np.array([float(c) for c in useColors.split()]).reshape(-1, 3)
+        faces, vertices, colors = [], [], []
+        offset = 0
+        for num, surface in enumerate(surfaces):
+            f, v, c = readDFS(surface)
+            if perSurface is not None and num < len(perSurface):
+                c = np.tile(perSurface[num], (len(v), 1))
+            if c is None or grey:
+                c = np.tile(SURFACE_COLOR, (len(v), 1))
+            faces.append(f + offset)
+            vertices.append(v.dot(affine[:3, :3].T) + affine[:3, 3])
+            colors.append(c)
+            offset += len(v)
+        self.faces = np.concatenate(faces)
+        self.vertices = np.concatenate(vertices)
+        self.colors = np.clip(np.concatenate(colors), 0, 1)
+        self.extent = (self.vertices.max(axis=0) - self.vertices.min(axis=0)).max()
+        self.center = center if center is not None else \
+            (self.vertices.max(axis=0) + self.vertices.min(axis=0)) / 2.0
+        normals = np.cross(self.vertices[self.faces[:, 1]] - self.vertices[self.faces[:, 0]],
+                           self.vertices[self.faces[:, 2]] - self.vertices[self.faces[:, 0]])
+        lengths = np.linalg.norm(normals, axis=1)
+        lengths[lengths == 0] = 1
+        self.normals = normals / lengths[:, None]
+
+    def render(self, view, width=WIDTH, height=HEIGHT, zoom=1.0, background=(0, 0, 0)):
+        '''
+        Renders the surfaces (z-buffered, Lambert shaded with a light at the viewer). Returns an RGB image.
+        '''
+        towards, right, up = [np.asarray(axis, dtype=np.float64) for axis in VIEWS[view]]
+        scale = zoom * min(width, height) / self.extent
+        relative = self.vertices - self.center
+        col = relative.dot(right) * scale + width / 2.0
+        row = height / 2.0 - relative.dot(up) * scale
+        depth = relative.dot(towards)
+
+        # sample each triangle on a barycentric grid fine enough to cover every pixel it projects to
+        edges = np.stack([np.hypot(col[self.faces[:, a]] - col[self.faces[:, b]],
+                                   row[self.faces[:, a]] - row[self.faces[:, b]])
+                          for a, b in [(0, 1), (1, 2), (2, 0)]], axis=1)
+        samples = int(min(MAX_SAMPLES, max(1, np.ceil(np.percentile(edges, 99)))))
+        weights = [(i / float(samples), j / float(samples), 1 - (i + j) / float(samples))
+                   for i in range(samples + 1) for j in range(samples + 1 - i)] + [(1 / 3.0, 1 / 3.0, 1 / 3.0)]
+        shade = AMBIENT + (1 - AMBIENT) * np.abs(self.normals.dot(towards))
+
+        pixels, depths, rgbs = [], [], []
+        for w in weights:
+            c = sum(w[k] * col[self.faces[:, k]] for k in range(3))
+            r = sum(w[k] * row[self.faces[:, k]] for k in range(3))
+            inside = (c >= 0) & (c < width) & (r >= 0) & (r < height)
+            pixels.append((r[inside].astype(np.int64) * width + c[inside].astype(np.int64)))
+            depths.append(sum(w[k] * depth[self.faces[inside, k]] for k in range(3)))
+            rgbs.append(sum(w[k] * self.colors[self.faces[inside, k]] for k in range(3)) * shade[inside, None])
+        pixels = np.concatenate(pixels)
+        depths = np.concatenate(depths)
+        rgbs = np.concatenate(rgbs)
+
+        # nearest sample of each pixel
+        order = np.lexsort((-depths, pixels))
+        pixels, first = np.unique(pixels[order], return_index=True)
+        image = np.tile(np.asarray(background, dtype=np.float64), (height * width, 1))
+        image[pixels] = rgbs[order][first]
+        return (np.clip(image, 0, 1) * 255).astype(np.uint8).reshape(height, width, 3)
+
+def renderViews(surfaces, views, centerVol=None, useColors=None, grey=False, width=WIDTH, height=HEIGHT,
+                zoom=1.0, background=None):
+    '''
+    Renders the surfaces from each view ({'outFile': ..., 'view': 'Left'|'Right'|'Sup'|'Inf'|'Ant'|'Pos'})
+    and writes the images as PNG files. The surfaces are read once for all views.
+    '''
+    scene = surfaceScene(surfaces, centerVol, useColors, grey)
+    background = parseColor(background, (0, 0, 0))
+    for view in views:
+        writePNG(view['outFile'], scene.render(view['view'], view.get('Xwidth', width), view.get('Ywidth', height),
+                                               view.get('Zoom', zoom), background))
+    return [view['outFile'] for view in views]
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import zlib
+import struct
+import colorsys
+import xml.etree.ElementTree as ET
+import numpy as np
+import nibabel as nib
+
+# defaults of volslice
+OVERLAY_ALPHA = 128
+LABEL_ALPHA = 64
+MASK_ALPHA = 96
+MASK_COLOR = (255, 0, 0)
+
+def writePNG(filename, rgb):
+    '''
+    Writes an 8-bit RGB image (rows x columns x 3 uint8 array) as a PNG file.
+    '''
+    height, width = rgb.shape[:2]
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = rgb.reshape(height, width * 3)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    png = b'\x89PNG\r\n\x1a\n' + \
+          chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) + \
+          chunk(b'IDAT', zlib.compress(rows.tobytes(), 6)) + \
+          chunk(b'IEND', b'')
+    tmpFile = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(tmpFile, 'wb') as f:
+        f.write(png)
+    os.rename(tmpFile, filename)
+
+def colorMap(name, values):
+    '''
+    Maps values in [0, 1] to RGB (0-255) with one of the volslice color maps.
+    '''
+    v = np.clip(values, 0, 1)
+    if name == 'hot':
+        rgb = np.stack([np.clip(3 * v, 0, 1), np.clip(3 * v - 1, 0, 1), np.clip(3 * v - 2, 0, 1)], axis=-1)
+    elif name == 'jet':
+        rgb = np.stack([np.clip(1.5 - np.abs(4 * v - 3), 0, 1), np.clip(1.5 - np.abs(4 * v - 2), 0, 1),
+                        np.clip(1.5 - np.abs(4 * v - 1), 0, 1)], axis=-1)
+    elif name in ['red', 'green', 'blue']:
+        rgb = np.zeros(v.shape + (3,))
+        rgb[..., ['red', 'green', 'blue'].index(name)] = v
+    elif name == 'inverse':
+        rgb = np.stack([1 - v] * 3, axis=-1)
+    else:
+        # grey, and the maps that are not reproduced here
+        rgb = np.stack([v] * 3, axis=-1)
+    return rgb * 255
+
+def labelColors(labelDesc):
+    '''
+    Reads the label colors (id -> (r, g, b)) of a BrainSuite label description XML file.
+    '''
+    colors = {}
+    if not labelDesc or not os.path.exists(labelDesc):
+        return colors
+    for label in ET.parse(labelDesc).getroot().iter('label'):
+        try:
+            color = int(label.get('color').replace('#', '0x'), 16)
+            colors[int(label.get('id'))] = ((color >> 16) & 255, (color >> 8) & 255, color & 255)
+        except (AttributeError, TypeError, ValueError):
+            continue
+    return colors
+
+def defaultLabelColor(label):
+    hue = (label * 0.618033988749895) % 1.0
+    return tuple(int(255 * c) for c in colorsys.hsv_to_rgb(hue, 0.8, 1.0))
+
+class volumeCache(object):
+    '''
+    Volumes loaded by a batch, reoriented to RAS, so that each file is read and decompressed once.
+    '''
+
+    def __init__(self):
+        self.volumes = {}
+        self.labelDescs = {}
+
+    def get(self, filename):
+        if filename not in self.volumes:
+            img = nib.load(filename)
+            shape = img.shape
+            # color FA volumes hold the RGB components along the 4th dimension
+            rgb = len(shape) > 3 and int(np.prod(shape[3:])) == 3 and '.color.' in os.path.basename(filename)
+            if len(shape) > 3 and not rgb:
+                # only the first volume of a 4D series (e.g. the b=0 image of a DWI series) is read
+                data = np.asanyarray(img.dataobj[(slice(None),) * 3 + (0,) * (len(shape) - 3)])
+            else:
+                data = np.asanyarray(img.dataobj)
+            if data.dtype.names:
+                # RGB volumes
+                data = np.stack([data[name] for name in data.dtype.names], axis=-1)
+                rgb = True
+            elif rgb:
+                data = data.reshape(data.shape[:3] + (-1,))
+            # reoriented to RAS, as nib.as_closest_canonical, without reading the other volumes
+            orientation = nib.orientations.io_orientation(img.affine)
+            data = nib.orientations.apply_orientation(data, orientation)
+            zooms = np.asarray(img.header.get_zooms()[:3])[np.argsort(orientation[:, 0])]
+            self.volumes[filename] = (data, tuple(float(zoom) for zoom in zooms), rgb)
+        return self.volumes[filename]
+
+    def get_labelDesc(self, labelDesc):
+        if labelDesc not in self.labelDescs:
+            self.labelDescs[labelDesc] = labelColors(labelDesc)
+        return self.labelDescs[labelDesc]
+
+def extractSlice(data, zooms, view, sliceNum, voxelspace):
+    '''
+    Extracts a slice of a RAS volume as an image with superior (axial: anterior) at the top. view is
+    1 (axial), 2 (coronal) or 3 (sagittal); sliceNum -1 is the center slice. Unless voxelspace is set,
+    the image is resampled (nearest neighbor) so that pixels are square.
+    '''
+    axis = {1: 2, 2: 1, 3: 0}[view]
+    if sliceNum < 0:
+        sliceNum = data.shape[axis] // 2
+    sliceNum = min(sliceNum, data.shape[axis] - 1)
+    plane = np.take(data, sliceNum, axis=axis)
+    inPlane = [zoom for ax, zoom in enumerate(zooms) if ax != axis]
+    image = np.swapaxes(plane, 0, 1)[::-1]
+    if not voxelspace:
+        rowZoom, colZoom = inPlane[1], inPlane[0]
+        pixel = min(rowZoom, colZoom)
+        rows = np.floor(np.arange(int(round(image.shape[0] * rowZoom / pixel))) * pixel / rowZoom).astype(int)
+        cols = np.floor(np.arange(int(round(image.shape[1] * colZoom / pixel))) * pixel / colZoom).astype(int)
+        image = image[rows][:, cols]
+    return image
+
+def blend(rgb, where, color, alpha):
+    '''
+    Blends color (an RGB triplet, or an image of the same size as rgb) into rgb where where is set.
+    '''
+    color = np.asarray(color, dtype=np.float64)
+    if color.ndim > 1:
+        color = color[where]
+    rgb[where] = rgb[where] * (1 - alpha) + color * alpha
+
+def renderView(view, cache):
+    '''
+    Renders one view (see VolsliceBatch in nipype/brainsuite) and writes it as a PNG file.
+    '''
+    orientation = view.get('view', 1)
+    sliceNum = view.get('Slice', -1)
+    voxelspace = view.get('voxelspace', False)
+    data, zooms, rgbVolume = cache.get(view['inFile'])
+    image = extractSlice(data, zooms, orientation, sliceNum, voxelspace).astype(np.float64)
+
+    scaling = view.get('scaling', 0)
+    if rgbVolume:
+        vmax = image.max() if scaling == 0 else scaling
+        rgb = np.clip(image / (vmax if vmax > 0 else 1.0), 0, 1) * 255
+    else:
+        if scaling == 0:
+            positive = image[image > 0]
+            vmax = np.percentile(positive, 99.5) if positive.size > 0 else 1.0
+        else:
+            vmax = scaling
+        rgb = colorMap(view.get('colorMap', 'grey'), image / (vmax if vmax > 0 else 1.0))
+
+    if view.get('Overlay'):
+        overlayData, overlayZooms, _ = cache.get(view['Overlay'])
+        overlay = extractSlice(overlayData, overlayZooms, orientation, sliceNum, voxelspace).astype(np.float64)
+        if overlay.shape == rgb.shape[:2]:
+            omax = overlay.max()
+            where = overlay > 0
+            blend(rgb, where, colorMap('hot', overlay / (omax if omax > 0 else 1.0)),
+                  view.get('OverlayAlpha', OVERLAY_ALPHA) / 255.0)
+    if view.get('maskFile'):
+        maskData, maskZooms, _ = cache.get(view['maskFile'])
+        mask = extractSlice(maskData, maskZooms, orientation, sliceNum, voxelspace)
+        if mask.shape == rgb.shape[:2]:
+            blend(rgb, mask > 0, MASK_COLOR, MASK_ALPHA / 255.0)
+    if view.get('labelFile'):
+        labelData, labelZooms, _ = cache.get(view['labelFile'])
+        labels = extractSlice(labelData, labelZooms, orientation, sliceNum, voxelspace).astype(np.int64)
+        if labels.shape == rgb.shape[:2]:
+            colors = cache.get_labelDesc(view.get('labelDesc'))
+            labelRGB = np.zeros(rgb.shape)
+            for label in np.unique(labels[labels > 0]):
+                labelRGB[labels == label] = colors.get(int(label), defaultLabelColor(int(label)))
+            blend(rgb, labels > 0, labelRGB, view.get('labelAlpha', LABEL_ALPHA) / 255.0)
+
+    if view.get('flip'):
+        rgb = rgb[::-1]
+    if view.get('flop'):
+        rgb = rgb[:, ::-1]
+    writePNG(view['outFile'], np.ascontiguousarray(np.clip(rgb, 0, 255).astype(np.uint8)))
+    return view['outFile']
+
+def renderViews(views):
+    '''
+    Renders a batch of views; volumes shared by the views are loaded once.
+    '''
+    cache = volumeCache()
+    return [renderView(view, cache) for view in views]
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import json
+import fcntl
+from datetime import datetime
+from QC.stageNumDict import stageNumDict
+
+STATES_FILE = 'states.json'
+
+completed = 'C'
+launched = 'L'
+unqueued = 'N'
+queued = 'Q'
+errored = 'E'
+# not run because a stage it depends on failed
+blocked = 'B'
+
+class qcStateStore(object):
+    '''
+    QC states of all stages of a subject, kept as a single record in <statesDir>/states.json:
+    {"states": "CCCLQ...", "times": {"4": {"Q": ..., "L": ...}}, "updated": ...}, where the n-th character is
+    the state of stage n (see QC/stageNumDict.py) and times holds when stage n entered each of its states
+    since it was last queued. Updates are serialized with a lock file and the record is replaced atomically,
+    so that watch.sh never reads a partially written record.
+    '''
+
+    def __init__(self, statesDir):
+        self.statesDir = statesDir
+        self.statesFile = os.path.join(statesDir, STATES_FILE)
+        self.lockFile = self.statesFile + '.lock'
+
+    def readRecord(self):
+        '''
+        Returns (states, times): the states as a dictionary of stage number -> state, and the times as a
+        dictionary of stage number -> {state: ISO time}. Stages without a state are left out.
+        '''
+        if not os.path.exists(self.statesFile):
+            return self.readLegacy(), {}
+        try:
+            with open(self.statesFile, 'r') as f:
+                record = json.load(f)
+        except ValueError:
+            return {}, {}
+        states = dict((num + 1, state) for num, state in enumerate(record['states']) if state != ' ')
+        times = dict((int(num), stateTimes) for num, stateTimes in record.get('times', {}).items())
+        return states, times
+
+    def read(self):
+        '''
+        Returns the states as a dictionary of stage number -> state. Stages without a state are left out.
+        '''
+        return self.readRecord()[0]
+
+    def readLegacy(self):
+        '''
+        Reads the per-stage stage-<n>.state files written by earlier versions of the BIDS App.
+        '''
+        states = {}
+        for num in stageNumDict.values():
+            stateFile = os.path.join(self.statesDir, 'stage-{0}.state'.format(num))
+            if os.path.exists(stateFile):
+                with open(stateFile, 'r') as f:
+                    states[num] = f.read().strip()[:1]
+        return states
+
+    def write(self, states, times=None):
+        numstages = max(list(stageNumDict.values()) + list(states.keys()))
+        record = {'states': ''.join([states.get(num, ' ') for num in range(1, numstages + 1)]),
+                  'times': dict((str(num), stateTimes) for num, stateTimes in (times or {}).items()),
+                  'updated': datetime.now().isoformat()}
+        tmpFile = '{0}.{1}.tmp'.format(self.statesFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump(record, f)
+        os.rename(tmpFile, self.statesFile)
+
+    def update(self, states, initial=False):
+        '''
+        Sets the states of several stages ({stage number: state}) in one locked read-modify-write, and records
+        the time of each change. With initial=True, stages that already have a state are left unchanged.
+        '''
+        with open(self.lockFile, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                current, times = self.readRecord()
+                now = datetime.now().isoformat()
+                for num, state in states.items():
+                    if initial and num in current:
+                        continue
+                    if current.get(num) != state:
+                        # a stage that is queued again starts a new run
+                        if state == queued:
+                            times.pop(num, None)
+                        times.setdefault(num, {})[state] = now
+                    current[num] = state
+                self.write(current, times)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def set(self, stagenum, state):
+        self.update({stagenum: state})
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import json
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+import argparse
+from datetime import datetime
+from QC.stateStore import STATES_FILE
+from workflows.runtimeProfile import EVENTS_FILE
+
+DASHBOARD_STATE_FILE = 'brainsuite_state.json'
+# seconds between checks for the subject list and the first states folder
+INIT_INTERVAL = 10
+# seconds between stat sweeps of all subjects; catches writes from other hosts on shared storage,
+# which inotify does not report
+SWEEP_INTERVAL = 10
+# seconds between checks of all subjects when inotify is not available
+POLL_INTERVAL = 2
+# seconds between rewrites of brainsuite_state.json when no state has changed (keeps the run time current)
+HEARTBEAT_INTERVAL = 30
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+EVENT_HEADER = struct.Struct('iIII')
+
+class inotify(object):
+    '''
+    Minimal ctypes binding of the Linux inotify API. Raises OSError if inotify is not available.
+    '''
+
+    def __init__(self):
+        libcName = ctypes.util.find_library('c')
+        if libcName is None:
+            raise OSError('libc not found.')
+        self.libc = ctypes.CDLL(libcName, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify is not supported.')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed.')
+
+    def add_watch(self, path, mask=IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE):
+        wd = self.libc.inotify_add_watch(self.fd, path.encode('utf-8'), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed for {0}.'.format(path))
+        return wd
+
+    def wait(self, timeout):
+        '''
+        Waits up to timeout seconds and returns the set of watch descriptors that had events.
+        '''
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        wds = set()
+        if not ready:
+            return wds
+        try:
+            buf = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return wds
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            wds.add(wd)
+            offset += EVENT_HEADER.size + length
+        return wds
+
+    def close(self):
+        os.close(self.fd)
+
+class stateAggregator(object):
+    '''
+    Builds brainsuite_state.json, read by the BrainSuite Dashboard, from the QC state records of the
+    subjects in subjectIDs.json (see QC/stateStore.py) and, if outputdir is given, from the events of the
+    BrainSuite commands they have run (<outputdir>/<subject>/events.jsonl, see workflows/runtimeProfile.py).
+    A subject's record is only read again when it has changed, only the new lines of its events are read,
+    and brainsuite_state.json is only rewritten when a state or the events have changed (or every
+    HEARTBEAT_INTERVAL seconds, to update the run time).
+    '''
+
+    def __init__(self, webdir, outputdir=None):
+        self.webdir = webdir
+        self.outputdir = outputdir
+        self.webpath = os.path.join(webdir, DASHBOARD_STATE_FILE)
+        self.startTime = datetime.now()
+        self.subjects = []
+        self.states = {}
+        self.times = {}
+        self.mtimes = {}
+        self.events = {}
+        self.offsets = {}
+        self.lastWrite = 0
+
+    def load_subjects(self):
+        subjectFile = os.path.join(self.webdir, 'subjectIDs.json')
+        if not os.path.exists(subjectFile):
+            return False
+        with open(subjectFile, 'r') as f:
+            self.subjects = json.load(f)['subjects']
+        return len(self.subjects) > 0
+
+    def statesDir(self, subjID):
+        return os.path.join(self.webdir, subjID, subjID, 'states')
+
+    def refresh(self, subjID):
+        '''
+        Reads the state record of a subject if it has changed. Returns True if the states have changed.
+        '''
+        statesFile = os.path.join(self.statesDir(subjID), STATES_FILE)
+        try:
+            st = os.stat(statesFile)
+        except OSError:
+            return False
+        if self.mtimes.get(subjID) == (st.st_mtime, st.st_size):
+            return False
+        try:
+            with open(statesFile, 'r') as f:
+                record = json.load(f)
+        except ValueError:
+            # being replaced; read it again on the next event or sweep
+            return False
+        states = record['states'].replace(' ', '')
+        self.mtimes[subjID] = (st.st_mtime, st.st_size)
+        self.times[subjID] = record.get('times', {})
+        if self.states.get(subjID) == states:
+            return False
+        self.states[subjID] = states
+        return True
+
+    def refreshEvents(self, subjID):
+        '''
+        Adds the events appended to the event log of a subject since it was last read to its summary. Returns
+        True if there were new events.
+        '''
+        if self.outputdir is None:
+            return False
+        eventLog = os.path.join(self.outputdir, subjID, EVENTS_FILE)
+        try:
+            size = os.path.getsize(eventLog)
+        except OSError:
+            return False
+        offset = self.offsets.get(subjID, 0)
+        if size < offset:
+            # the log was replaced (e.g. the output folder was cleared); summarize it again
+            offset = 0
+            self.events.pop(subjID, None)
+        if size == offset:
+            return False
+        with open(eventLog, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+        # leave a line that is still being written for the next read
+        complete = data.rfind(b'\n') + 1
+        if complete == 0:
+            return False
+        self.offsets[subjID] = offset + complete
+        summary = self.events.setdefault(subjID, {'commands': 0, 'errors': 0, 'cpu_time_s': 0.0,
+                                                  'wall_time_s': 0.0, 'max_rss_mb': None, 'last': None})
+        for line in data[:complete].decode('utf-8').splitlines():
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            summary['commands'] += 1
+            if event.get('returncode'):
+                summary['errors'] += 1
+            summary['cpu_time_s'] += event.get('cpu_time_s') or 0.0
+            summary['wall_time_s'] += event.get('wall_time_s') or 0.0
+            if event.get('max_rss_mb') is not None:
+                summary['max_rss_mb'] = max(summary['max_rss_mb'] or 0.0, event['max_rss_mb'])
+            summary['last'] = dict((field, event.get(field)) for field in ['interface', 'node', 'end', 'returncode'])
+        return True
+
+    def process_states(self):
+        return [self.states.get(subjID, 'P') for subjID in self.subjects]
+
+    def process_times(self):
+        '''
+        For each subject, when each stage entered each of its states: {stage number: {state: ISO time}}.
+        '''
+        return [self.times.get(subjID, {}) for subjID in self.subjects]
+
+    def process_events(self):
+        '''
+        For each subject, a summary of the BrainSuite commands it has run (see refreshEvents), or None.
+        '''
+        return [self.events.get(subjID) for subjID in self.subjects]
+
+    def write(self, status, end=0):
+        now = datetime.now()
+        seconds = int((now - self.startTime).total_seconds())
+        record = {'status': status,
+                  'start_time': self.startTime.astimezone().isoformat(timespec='seconds'),
+                  'update_time': now.astimezone().isoformat(timespec='seconds'),
+                  'runtime': '{0:02d}:{1:02d}:{2:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60),
+                  'process_states': self.process_states(),
+                  'process_times': self.process_times(),
+                  'process_events': self.process_events(),
+                  'end': end}
+        tmpFile = '{0}.{1}.tmp'.format(self.webpath, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump(record, f)
+        os.chmod(tmpFile, 0o644)
+        os.rename(tmpFile, self.webpath)
+        self.lastWrite = time.time()
+
+    def finished(self):
+        '''
+        Processing has ended when every subject has a state record and none of its stages are queued or
+        launched; errored (E) and blocked (B) stages are final.
+        '''
+        return all([subjID in self.states and 'Q' not in self.states[subjID] and 'L' not in self.states[subjID]
+                    for subjID in self.subjects])
+
+    def wait_for_subjects(self):
+        print('Real-time QC watch initiated...')
+        while True:
+            print('Checking queued subjects...')
+            if self.load_subjects():
+                print('QCing {0} subjects...'.format(len(self.subjects)))
+                self.write('initializing')
+                if any([os.path.isdir(self.statesDir(subjID)) for subjID in self.subjects]):
+                    return
+            time.sleep(INIT_INTERVAL)
+
+    def run(self):
+        self.wait_for_subjects()
+        self.startTime = datetime.now()
+        try:
+            notifier = inotify()
+        except OSError as e:
+            print('inotify is not available ({0}); checking the QC states every {1} seconds.'.format(
+                e, POLL_INTERVAL))
+            notifier = None
+        watches = {}
+        watched = set()
+
+        for subjID in self.subjects:
+            self.refresh(subjID)
+            self.refreshEvents(subjID)
+        self.write('running')
+        lastSweep = time.time()
+        while not self.finished():
+            changed = False
+            if notifier is not None:
+                # watch the states folders that have been created since the last sweep
+                for subjID in self.subjects:
+                    if subjID not in watched and os.path.isdir(self.statesDir(subjID)):
+                        watches[notifier.add_watch(self.statesDir(subjID))] = subjID
+                        watched.add(subjID)
+                        changed = self.refresh(subjID) or changed
+                for wd in notifier.wait(min(SWEEP_INTERVAL, HEARTBEAT_INTERVAL)):
+                    if wd in watches:
+                        changed = self.refresh(watches[wd]) or changed
+            else:
+                time.sleep(POLL_INTERVAL)
+            if notifier is None or time.time() - lastSweep >= SWEEP_INTERVAL:
+                for subjID in self.subjects:
+                    changed = self.refresh(subjID) or changed
+                    # the event logs are in the output folders, which are not watched
+                    changed = self.refreshEvents(subjID) or changed
+                lastSweep = time.time()
+            if changed or time.time() - self.lastWrite >= HEARTBEAT_INTERVAL:
+                self.write('running')
+
+        if notifier is not None:
+            notifier.close()
+        for subjID in self.subjects:
+            self.refreshEvents(subjID)
+        self.write('terminating', end=1)
+        print('Completed monitoring.')
+        self.write('finished at {0}'.format(datetime.now().strftime('%c')), end=1)
+        print('Exiting.')
+        self.write('process monitoring has ended.', end=1)
+
+def parser():
+    parser = argparse.ArgumentParser(description='Aggregates the QC states of the subjects for the BrainSuite '
+                                                 'Dashboard.')
+    parser.add_argument('webdir', help='BrainSuite Dashboard folder (with subjectIDs.json).')
+    parser.add_argument('outputdir', help='Output folder of the participant-level processing.', nargs='?')
+    return parser
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    stateAggregator(args.webdir, args.outputdir).run()
@@ -20,6 +20,8 @@
 var path = "./QC/";
 var subjects = [];
 var subjstatus = [];
+var subjtimes = [];
+var subjevents = [];
 var clocks = 0;
 var currentSubject = -1;
 var brainsuiteRunParameters;
@@ -30,6 +32,7 @@ var completed = "🟢";
 var launched = "🔵";
 var queued = "⚪";
 var errorsymbol = "🔴";
+var blockedsymbol = "🟠";
 var updateInterval = 1000;
 var wrapImages = false;
 var pixel='data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7'
@@ -48,13 +51,14 @@ const notRunCode='N';
 const errorCode='E';
 const launchCode='L';
 const queuedCode='Q';
+const blockedCode='B';
 
 const allFinishedRegex = new RegExp('^['+completedCode+notRunCode+']*$');
-const notRunningRegex = new RegExp('^['+queuedCode+completedCode+notRunCode+errorCode+']*$');
+const notRunningRegex = new RegExp('^['+queuedCode+completedCode+notRunCode+errorCode+blockedCode+']*$');
 const isQueuedRegex = new RegExp(queuedCode);
 const isErrorRegex = new RegExp(errorCode);
 const isLaunchedRegex = new RegExp(launchCode);
-const finishedWithErrorRegex = new RegExp('^['+completedCode+notRunCode+errorCode+']+$');
+const finishedWithErrorRegex = new RegExp('^['+completedCode+notRunCode+errorCode+blockedCode+']+$');
 
 function setUpdateInterval(t) {
 	updateInterval = t;
@@ -211,6 +215,7 @@ function progressBar(stagecodes, showAll = false) {
 		switch (stagecodes[stage]) {
 			case launchCode: code = launched; stagename += ' - running'; break;
 			case errorCode: code = errorsymbol; stagename += ' - error'; break;
+			case blockedCode: code = blockedsymbol; stagename += ' - blocked by an error'; break;
 			case queuedCode: code = queued;  stagename += ' - queued'; break;
 			case completedCode: code = completed; stagename += ' - completed'; break;
 			case notRunCode: code = notrun; break;
@@ -291,6 +296,8 @@ function updateState() {
 		dataType: "json",
 		success: function (data) {
 			subjstatus = data.process_states;
+			subjtimes = data.process_times || [];
+			subjevents = data.process_events || [];
 			var infotext = "";
 			var start=new Date(data.start_time);
 			var update=new Date(data.update_time);
@@ -377,6 +384,23 @@ function refillSubjectRows(flag) {
 	}
 }
 
+function launchTime(sid, stage) {
+	var times = (subjtimes[sid] != null) ? subjtimes[sid][stage + 1] : null;
+	if (times == null || times[launchCode] == null) return "";
+	return " since " + new Date(times[launchCode]).toLocaleTimeString();
+}
+
+function commandStats(sid) {
+	var events = subjevents[sid];
+	if (events == null) return "";
+	var cpu = Math.round(events.cpu_time_s);
+	var text = events.commands + " commands, CPU " + Math.floor(cpu / 3600) + ":" + ("0" + Math.floor(cpu % 3600 / 60)).slice(-2) + ":" + ("0" + cpu % 60).slice(-2);
+	if (events.max_rss_mb != null) text += ", peak " + (events.max_rss_mb / 1024).toFixed(1) + " GB";
+	if (events.errors > 0) text += ", " + events.errors + " failed";
+	if (events.last != null) text += "; last: " + events.last.interface + " (" + events.last.node + ")";
+	return "<span class='desc text-muted'>[" + text + "]</span>&nbsp";
+}
+
 function makeSubjectStatusBar(sid) {
 	var stagecodes = subjstatus[sid];
 	var subject = subjects[sid];
@@ -387,28 +411,34 @@ function makeSubjectStatusBar(sid) {
 		+ "&nbsp" + subject;
 	if (stagecodes == null) return subjectLine+"</b>&nbspstatus unavailable. &nbsp</B>";
 	if (stagecodes[0] == pendingCode) return subjectLine+ "</b>&nbsplaunch pending. &nbsp</B>";
-	subjectLine += "</b>&nbsp" + progressBar(stagecodes) + "&nbsp";
+	subjectLine += "</b>&nbsp" + progressBar(stagecodes) + "&nbsp" + commandStats(sid);
 	var allFinished = allFinishedRegex.test(stagecodes); // finished if all jobs are complete or not specified to run
 	var isQueued = isQueuedRegex.test(stagecodes);
 	var notRunning = notRunningRegex.test(stagecodes); // test if queued but not running
 	var finishedWithError = true;
-	for (var stage = 0; stage < stagecodes.length; stage++) if (stagecodes[stage] != completedCode && stagecodes[stage] != errorCode) { finishedWithError = false; break; }
+	for (var stage = 0; stage < stagecodes.length; stage++) if (stagecodes[stage] != completedCode && stagecodes[stage] != errorCode && stagecodes[stage] != blockedCode) { finishedWithError = false; break; }
 	var finishedOrQueued = true;
 	for (var stage = 0; stage < stagecodes.length; stage++) if (stagecodes[stage] != completedCode && stagecodes[stage] != queuedCode) { finishedOrQueued = false; break; }
 	if (allFinished) { subjectLine += "<span class='desc text-success' style='color:green;'>finished all stages.</span>"; }
 	else if (isQueued && notRunning) { subjectLine += "<span class='desc' style='color:black;'>queued to run.</span>"; }
 	else {
 	var errors = "";
+	var blocked = "";
 	for (var stage = 0; stage < stagecodes.length; stage++) {
 		if (stagecodes[stage] == launchCode) {
-			subjectLine += "<span class='desc text-primary' style='color:blue'>running " + stagenames[stage] + ".</span>" + "&nbsp";
+			subjectLine += "<span class='desc text-primary' style='color:blue'>running " + stagenames[stage] + launchTime(sid, stage) + ".</span>" + "&nbsp";
 		}
 		if (stagecodes[stage] == errorCode) {
 			if (errors.length > 0) errors += ", ";
 			errors += stagenames[stage];
 		}
+		if (stagecodes[stage] == blockedCode) {
+			if (blocked.length > 0) blocked += ", ";
+			blocked += stagenames[stage];
+		}
 	}
 	if (errors.length > 0) subjectLine += "<span class='desc text-danger' style='color:red'>errors occurred running " + errors + "</span>";
+	if (blocked.length > 0) subjectLine += "&nbsp<span class='desc text-warning' style='color:orange'>" + blocked + " will not run.</span>";
 	}
 	return subjectLine;
 }
@@ -436,6 +466,7 @@ function generateSlideRow(sid) {
 				case launchCode: color = "blue"; bootcls = 'primary'; imagetext = para + "running " + stagenames[stage] + "...<br/><br/>" + runningGIF + "</p>"; break;
 				case queuedCode: color = "black"; bootcls = 'dark'; imagetext = para + stagenames[stage] + " is queued</p>"; break;
 				case errorCode: color = "red"; bootcls = 'danger'; imagetext = para + "error in: " + stagenames[stage] + "</p>"; break;
+				case blockedCode: color = "orange"; bootcls = 'warning'; imagetext = para + stagenames[stage] + " is blocked by an earlier error</p>"; break;
 				case notRunCode: continue;
 				default: break;
 			}
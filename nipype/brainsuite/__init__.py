@@ -23,5 +23,6 @@ from .brainsuite import (Bse, Bfc, Pvc, Cerebro, Cortex, Scrubmask, Tca,
                          Dewisp, Dfs, Pialmesh, Skullfinder, Hemisplit,
                          SVReg, BDP, ThicknessPVC, SVRegSmoothSurf,
                          SVRegApplyMap, SVRegSmoothVol, GenerateXls, Volslice,
-                         RenderDfs, QCState, Thickness2Atlas, BFP, makeMask,
-                         copyFile, GSmooth)
+                         VolsliceBatch, RenderDfs, RenderDfsViews, QCState,
+                         Thickness2Atlas, BFP, makeMask, copyFile, GSmooth, RESOURCE_PROFILES, resourceProfile,
+                         BrainSuiteCommandLine)
@@ -24,8 +24,14 @@ from __future__ import print_function, division, unicode_literals, absolute_impo
 
 import os
 import re as regex
-
-from ..base import TraitedSpec, CommandLineInputSpec, CommandLine, File, traits, isdefined
+import errno
+import fcntl
+import shutil
+import resource
+import time
+
+from ..base import (TraitedSpec, CommandLineInputSpec, CommandLine, BaseInterface, BaseInterfaceInputSpec, File,
+                    traits, isdefined)
 from ..traits_extension import str
 from ... import config, logging, LooseVersion, __version__
 iflogger = logging.getLogger('interface')
@@ -35,7 +41,118 @@ This class provides interfaces for BrainSuite command line tools.
 Please see brainsuite.org for more information.
 '''
 
+# Default resources of each interface, used by the MultiProc plugin to decide which nodes can run at
+# the same time. Values can be overridden per interface class or per node name in the preprocspec
+# (Global Settings -> resources), e.g. {"SVReg": {"mem_gb": 8, "n_procs": 4}}.
+RESOURCE_PROFILES = {
+    # CSE
+    'Bse': {'mem_gb': 1.0, 'n_procs': 1},
+    'Bfc': {'mem_gb': 1.5, 'n_procs': 1},
+    'Pvc': {'mem_gb': 1.0, 'n_procs': 1},
+    'Cerebro': {'mem_gb': 2.0, 'n_procs': 1},
+    'Cortex': {'mem_gb': 0.5, 'n_procs': 1},
+    'Scrubmask': {'mem_gb': 0.5, 'n_procs': 1},
+    'Tca': {'mem_gb': 0.5, 'n_procs': 1},
+    'Dewisp': {'mem_gb': 0.5, 'n_procs': 1},
+    'Dfs': {'mem_gb': 1.0, 'n_procs': 1},
+    'Pialmesh': {'mem_gb': 1.5, 'n_procs': 1},
+    'Hemisplit': {'mem_gb': 0.5, 'n_procs': 1},
+    'Skullfinder': {'mem_gb': 1.0, 'n_procs': 1},
+    'ThicknessPVC': {'mem_gb': 3.0, 'n_procs': 1},
+    # SVREG
+    'SVReg': {'mem_gb': 6.0, 'n_procs': 4},
+    'Thickness2Atlas': {'mem_gb': 2.0, 'n_procs': 1},
+    'SVRegSmoothSurf': {'mem_gb': 1.5, 'n_procs': 1},
+    'SVRegSmoothVol': {'mem_gb': 1.5, 'n_procs': 1},
+    'SVRegApplyMap': {'mem_gb': 2.0, 'n_procs': 1},
+    'GSmooth': {'mem_gb': 1.0, 'n_procs': 1},
+    'GenerateXls': {'mem_gb': 2.0, 'n_procs': 1},
+    # BDP
+    'BDP': {'mem_gb': 4.0, 'n_procs': 1},
+    'Eddy': {'mem_gb': 4.0, 'n_procs': 1},
+    'EddyQuad': {'mem_gb': 1.0, 'n_procs': 1},
+    # BFP
+    'BFP': {'mem_gb': 8.0, 'n_procs': 1},
+    # QC
+    'Volslice': {'mem_gb': 0.25, 'n_procs': 1},
+    'VolsliceBatch': {'mem_gb': 1.0, 'n_procs': 1},
+    'RenderDfs': {'mem_gb': 0.5, 'n_procs': 1},
+    'RenderDfsViews': {'mem_gb': 1.0, 'n_procs': 1},
+    'makeMask': {'mem_gb': 0.25, 'n_procs': 1},
+    'copyFile': {'mem_gb': 0.05, 'n_procs': 1},
+    'QCState': {'mem_gb': 0.05, 'n_procs': 1}
+}
+
+def resourceProfile(interfaceName, nodeName=None, overrides=None):
+    '''
+    Returns the resources (mem_gb, n_procs) of a node, or None if neither its interface class nor its
+    name has a profile. overrides is keyed by interface class or node name; node names take precedence.
+    '''
+    if overrides is None:
+        overrides = {}
+    if interfaceName not in RESOURCE_PROFILES and interfaceName not in overrides and nodeName not in overrides:
+        return None
+    # nipype's default node resources
+    profile = dict(RESOURCE_PROFILES.get(interfaceName, {'mem_gb': 0.2, 'n_procs': 1}))
+    profile.update(overrides.get(interfaceName, {}))
+    profile.update(overrides.get(nodeName, {}))
+    return profile
+
+
+# Interfaces whose outputs only depend on their inputs (every file they read is named in their inputs). Their
+# executions can be served from the global node cache (see workflows/nodeCache.py).
+CACHEABLE_INTERFACES = ['Bse', 'Bfc', 'Pvc', 'Cerebro', 'Cortex', 'Scrubmask', 'Tca', 'Dewisp', 'Dfs', 'Pialmesh',
+                        'Hemisplit', 'Skullfinder', 'VolsliceBatch', 'RenderDfsViews', 'makeMask']
+# inputs that only order the execution of nodes
+ORDERING_INPUTS = ['dataSinkDelay', 'Run', 'LaunchInput', 'Surfbilateral']
+
+def outputFiles(interface):
+    files = []
+    for value in interface._list_outputs().values():
+        for filename in (value if isinstance(value, list) else [value]):
+            if isdefined(filename) and isinstance(filename, str) and filename not in files:
+                files.append(filename)
+    return files
+
+def cachedRun(interface, runtime, run):
+    """
+    Runs run(runtime), unless the global node cache is enabled and holds the outputs of an execution of the
+    interface with the same inputs, in which case the outputs are restored from the cache.
+    """
+    interfaceName = type(interface).__name__
+    if interfaceName not in CACHEABLE_INTERFACES:
+        return run(runtime)
+    from workflows.nodeCache import globalCache, hashedInputs
+    cache = globalCache()
+    if cache is None:
+        return run(runtime)
+    outputs = outputFiles(interface)
+    key = cache.key(interfaceName, getattr(interface, '_cmd', None), hashedInputs(interface.inputs, ORDERING_INPUTS), outputs)
+    # the cached files are never linked, since the tools may rewrite their outputs in place
+    stage = lambda source, destination: stageFile(source, destination, links=False)
+    if cache.restore(key, outputs, stage):
+        iflogger.info('Restored the outputs of {0} from the global node cache.'.format(interfaceName))
+        runtime.returncode = 0
+        runtime.cached = True
+        return runtime
+    runtime = run(runtime)
+    if getattr(runtime, 'returncode', None) in [0, None]:
+        cache.store(key, outputs, stage)
+    return runtime
+
+def stagedAtlasPath(path):
+    """
+    Path to read a file (or prefix) of the SVReg atlas from on this host: in its staged copy if atlas staging is
+    enabled (see workflows/stageAtlas.py), otherwise path. Called when the command runs, so that the atlas is
+    staged on the host that runs it and the input of the node, which is hashed, stays the original path.
+    """
+    from workflows.stageAtlas import stagedAtlas
+    return stagedAtlas(os.path.expanduser(path))
+
+
 class BrainSuiteCommandLine(CommandLine):
+    _eventTimes = None
+
     def _check_mandatory_inputs(self):
         """ Raises an exception if a mandatory input is Undefined
         """
@@ -62,6 +179,62 @@ class BrainSuiteCommandLine(CommandLine):
         allargs = [self.cmd] + self._parse_inputs()
         return ' '.join(allargs)
 
+    def run(self, *args, **kwargs):
+        # the event of the command is logged once nipype's resource monitor, if enabled, has set its peak memory
+        # (runtime.mem_peak_gb) on the result
+        self._eventTimes = None
+        results = super(BrainSuiteCommandLine, self).run(*args, **kwargs)
+        if self._eventTimes is not None:
+            self._log_event(results.runtime, *self._eventTimes)
+        return results
+
+    def _run_interface(self, runtime, *args, **kwargs):
+        # Resources used by the command (see workflows/runtimeProfile.py). The counters of RUSAGE_CHILDREN
+        # are cumulative over the children of this process, so the CPU time and I/O of the command are
+        # differences. Its peak resident memory is that of the largest child of this nipype worker over its
+        # lifetime: it is the peak of the command only if the command raised it, and is unknown otherwise;
+        # nipype's resource monitor measures it when enabled (see runtimeProfile.enableResourceMonitor).
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_CHILDREN)
+        runtime = cachedRun(self, runtime, lambda runtime: self._run_command(runtime, *args, **kwargs))
+        after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        end = time.time()
+        runtime.rusage = {
+            'cpu_time_s': (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+            'max_rss_mb': after.ru_maxrss / 1024.0 if after.ru_maxrss > before.ru_maxrss else None,
+            'read_bytes': (after.ru_inblock - before.ru_inblock) * 512,
+            'written_bytes': (after.ru_oublock - before.ru_oublock) * 512
+        }
+        self._eventTimes = (start, end)
+        return runtime
+
+    def _log_event(self, runtime, start, end):
+        # one JSON line per command in the event log of the subject, if the workflow set one on the node
+        # (see subjLevelProcessing.setEventLog and workflows/runtimeProfile.py)
+        from workflows.runtimeProfile import EVENT_LOG_ENV, EVENT_SUBJECT_ENV, commandEvent, appendEvent
+        environ = dict(runtime.environ)
+        environ.update(self.inputs.environ)
+        eventLog = environ.get(EVENT_LOG_ENV)
+        if not eventLog:
+            return
+        event = commandEvent(self, runtime, start, end, environ.get(EVENT_SUBJECT_ENV))
+        try:
+            appendEvent(eventLog, event)
+        except (IOError, OSError) as e:
+            # the events are informative; never fail the command because of them
+            iflogger.info('Could not append to the event log {0} ({1}).'.format(eventLog, e))
+
+    def _run_command(self, runtime, *args, **kwargs):
+        # the compiled MATLAB tools extract the runtime components into MCR_CACHE_ROOT, which is shared by
+        # the subjects on a machine; the first use of a tool extracts them under a lock (see workflows/mcrCache.py)
+        environ = dict(runtime.environ)
+        environ.update(self.inputs.environ)
+        if environ.get('MCR_CACHE_ROOT'):
+            from workflows.mcrCache import MATLAB_TOOLS, warmTool
+            if self._cmd in MATLAB_TOOLS:
+                warmTool(environ['MCR_CACHE_ROOT'], self._cmd, environ)
+        return super(BrainSuiteCommandLine, self)._run_interface(runtime, *args, **kwargs)
+
     def raise_exception(self, runtime):
         iflogger.info('[ERROR] RuntimeError has occurred.')
         message = "Command:\n" + runtime.cmdline + "\n"
@@ -1123,6 +1296,12 @@ class SVReg(BrainSuiteCommandLine):
     input_spec = SVRegInputSpec
     output_spec = SVRegOutputSpec
     _cmd = 'svreg.sh'
+    _stagedAtlas = None
+
+    def _run_command(self, runtime, *args, **kwargs):
+        if isdefined(self.inputs.atlasFilePrefix):
+            self._stagedAtlas = stagedAtlasPath(self.inputs.atlasFilePrefix)
+        return super(SVReg, self)._run_command(runtime, *args, **kwargs)
 
     def _gen_filename(self, name):
         fileToSuffixMap = {
@@ -1140,6 +1319,8 @@ class SVReg(BrainSuiteCommandLine):
         return l_outputs(self)
 
     def _format_arg(self, name, spec, value):
+        if name == 'atlasFilePrefix' and self._stagedAtlas:
+            return spec.argstr % self._stagedAtlas
         if name == 'subjectFilePrefix' or name == 'atlasFilePrefix' or name == 'curveMatchingInstructions':
             return spec.argstr % os.path.expanduser(value)
         if name == 'dataSinkDelay':
@@ -1766,14 +1947,10 @@ class ThicknessPVCInputSpec(CommandLineInputSpec):
         argstr='%s', mandatory=True,
         desc='Absolute path and filename prefix of the subject data'
     )
-    dataSinkDelay = traits.List(
+    dataSinkDelay = traits.Any(
         str, argstr='%s',
-        desc='Connect datasink out_file to dataSinkDelay to delay execution of SVReg '
-             'until dataSink has finished sinking CSE outputs.'
-             'For use with parallel processing workflows including Brainsuites Cortical '
-             'Surface Extraction sequence (SVReg requires certain files from Brainsuite '
-             'CSE, which must all be in the pathway specified by subjectFilePrefix. see '
-             'http://brainsuite.org/processing/svreg/usage/ for list of required inputs '
+        desc='Connect an output to dataSinkDelay to delay execution of ThicknessPVC '
+             'until the CSE outputs it requires (e.g. the hemisplit surfaces) have been written.'
     )
 
 
@@ -1990,10 +2167,19 @@ class SVRegApplyMap(BrainSuiteCommandLine):
     input_spec = SVRegApplyMapInputSpec
     output_spec = SVRegApplyMapOutputSpec
     _cmd = 'svreg_apply_map.sh'
+    _stagedTarget = None
+
+    def _run_command(self, runtime, *args, **kwargs):
+        # the target is a file of the atlas (see workflows/stageTable.py)
+        if isdefined(self.inputs.targetFile):
+            self._stagedTarget = stagedAtlasPath(self.inputs.targetFile)
+        return super(SVRegApplyMap, self)._run_command(runtime, *args, **kwargs)
 
     def _format_arg(self, name, spec, value):
         if name == 'dataSinkDelay':
             return spec.argstr % ''
+        if name == 'targetFile' and self._stagedTarget:
+            return spec.argstr % self._stagedTarget
 
         return super(SVRegApplyMap, self)._format_arg(name, spec, value)
 
@@ -2119,11 +2305,11 @@ class GenerateXlsInputSpec(CommandLineInputSpec):
         argstr='%s', mandatory=True,
         desc='Absolute path and filename prefix of the subject data'
     )
-    dataSinkDelay = traits.List(
+    dataSinkDelay = traits.Any(
         str,
         argstr='%s',
-        desc='Connect datasink out_file to dataSinkDelay to delay execution of '
-             'generate_xls until dataSink has finished sinking ThicknessPVC outputs.'
+        desc='Connect an output to dataSinkDelay to delay execution of '
+             'generate_xls until Thickness2Atlas has finished.'
     )
 
 
@@ -2211,6 +2397,68 @@ class Volslice(BrainSuiteCommandLine):
         # return super(Volslice, self)._format_arg(name, spec, value)
 
 
+class VolsliceBatchInputSpec(BaseInterfaceInputSpec):
+    inFile = File(mandatory=False, desc='Input file (default of the views).')
+    maskFile = File(mandatory=False, desc='Mask filename (default of the views).')
+    labelFile = File(mandatory=False, desc='Label filename (default of the views).')
+    views = traits.List(traits.Dict, mandatory=True,
+                        desc='Views to render. Each view is a dictionary with outFile and any of the inputs of '
+                             'Volslice (inFile, Overlay, OverlayAlpha, maskFile, colorMap, labelFile, labelAlpha, '
+                             'labelDesc, scaling, view, Slice, flip, flop, voxelspace). inFile, maskFile and '
+                             'labelFile default to the inputs of the node; set them to an empty string to '
+                             'render a view without them.')
+    Run = traits.Any(mandatory=False, desc='dummy arg.')
+    dataSinkDelay = traits.List(
+        str,
+        desc='Connect datasink outfile to dataSinkDelay to delay execution of '
+             'qcState until dataSink has finished sinking volslice outputs.'
+    )
+
+
+class VolsliceBatchOutputSpec(TraitedSpec):
+    outFiles = traits.List(File, desc='Output files, in the order of the views.')
+
+
+class VolsliceBatch(BaseInterface):
+    """
+    Renders the QC thumbnails of a stage (see QC/renderVolslice.py), in-process. Each volume is read once
+    for all views, instead of once per volslice call.
+    """
+    input_spec = VolsliceBatchInputSpec
+    output_spec = VolsliceBatchOutputSpec
+
+    def _views(self):
+        views = []
+        for view in self.inputs.views:
+            view = dict(view)
+            for name in ['inFile', 'maskFile', 'labelFile']:
+                if name not in view and isdefined(getattr(self.inputs, name)):
+                    view[name] = getattr(self.inputs, name)
+            views.append(view)
+        return views
+
+    def _run_interface(self, runtime):
+        return cachedRun(self, runtime, self._render)
+
+    def _render(self, runtime):
+        from QC.renderVolslice import renderViews
+        try:
+            renderViews(self._views())
+        except Exception as e:
+            # a QC image is not needed by the rest of the workflow; as with volslice, the error is only logged
+            iflogger.info('[ERROR] Could not render {0} ({1}: {2}).'.format(
+                ', '.join([view['outFile'] for view in self.inputs.views]), type(e).__name__, e))
+            runtime.returncode = 1
+            return runtime
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['outFiles'] = [view['outFile'] for view in self.inputs.views]
+        return outputs
+
+
 class RenderDfsInputSpec(CommandLineInputSpec):
     OutFile = File(argstr='-o %s', mandatory=True, desc='Output file. Must be a png.', genfile=True, hash_files=True)
     Ant = traits.Bool(argstr='--ant', mandatory=False, desc='coronal view (anterior)')
@@ -2269,85 +2517,200 @@ class RenderDfs(BrainSuiteCommandLine):
         return super(RenderDfs, self)._format_arg(name, spec, value)
 
 
-class QCStateInputSpec(CommandLineInputSpec):
-    prefix = traits.Str(mandatory=True, argstr='%s', position=0, desc='Basename.')
-    stagenum = traits.Int(mandatory=True, argstr='%d', position=1, desc='Stage number.')
-    # stage = traits.Str(mandatory=True, argstr='%s', position=2, desc='Stage character/symbol of the state.')
-    state = traits.Str(mandatory=True, argstr='%s', position=2, desc='String of all states.')
-    Run = traits.Any(argstr='', mandatory=False, desc='dummy arg.')
-    LaunchInput = traits.Any(argstr='', mandatory=False, desc='Waits for QC launch state.')
+class RenderDfsViewsInputSpec(BaseInterfaceInputSpec):
+    Surfaces = traits.Str(mandatory=True, desc='surface1 [... surfaceN]')
+    views = traits.List(traits.Dict, mandatory=True,
+                        desc="Views to render. Each view is a dictionary with OutFile and view ('Left', 'Right', "
+                             "'Sup', 'Inf', 'Ant' or 'Pos'), and optionally Xwidth, Ywidth and Zoom.")
+    BGcolor = traits.Str(mandatory=False, desc='background color (rgb) [default: 0 0 0]')
+    Xwidth = traits.Int(512, usedefault=True, desc='width in pixels [default: 512]')
+    Ywidth = traits.Int(512, usedefault=True, desc='height in pixels [default: 512]')
+    Zoom = traits.Float(1.0, usedefault=True, desc='zoom factor [default: 1]')
+    Grey = traits.Bool(False, usedefault=True, desc='render surfaces in greyscale')
+    CenterVol = File(mandatory=False, desc='center based on volume')
+    UseColors = traits.Str(mandatory=False, desc='r1 g1 b1 [ ... rN gN bN] (use these colors)')
+    Surfbilateral = traits.Any(mandatory=False, desc='dummy argument to print bilateral hemi')
+    dataSinkDelay = traits.Any(
+        str,
+        desc='Connect datasink outfile to dataSinkDelay to delay execution of '
+             'qcState until dataSink has finished sinking dfsrender outputs.'
+    )
+
+class RenderDfsViewsOutputSpec(TraitedSpec):
+    outFiles = traits.List(File, desc='Output files, in the order of the views.')
+
+
+class RenderDfsViews(BaseInterface):
+    """
+    Renders surfaces from several views (see QC/renderDfs.py), in-process. The surfaces are read once for
+    all views, instead of once per renderdfs call.
+    """
+    input_spec = RenderDfsViewsInputSpec
+    output_spec = RenderDfsViewsOutputSpec
+
+    def _run_interface(self, runtime):
+        return cachedRun(self, runtime, self._render)
+
+    def _render(self, runtime):
+        from QC.renderDfs import renderViews
+        views = [{'outFile': view['OutFile'], 'view': view['view'],
+                  'Xwidth': view.get('Xwidth', self.inputs.Xwidth), 'Ywidth': view.get('Ywidth', self.inputs.Ywidth),
+                  'Zoom': view.get('Zoom', self.inputs.Zoom)} for view in self.inputs.views]
+        try:
+            renderViews(os.path.expanduser(self.inputs.Surfaces).split(), views,
+                        centerVol=self.inputs.CenterVol if isdefined(self.inputs.CenterVol) else None,
+                        useColors=self.inputs.UseColors if isdefined(self.inputs.UseColors) else None,
+                        grey=self.inputs.Grey,
+                        background=self.inputs.BGcolor if isdefined(self.inputs.BGcolor) else None)
+        except Exception as e:
+            # a QC image is not needed by the rest of the workflow; as with renderdfs, the error is only logged
+            iflogger.info('[ERROR] Could not render {0} ({1}: {2}).'.format(
+                ', '.join([view['outFile'] for view in views]), type(e).__name__, e))
+            runtime.returncode = 1
+            return runtime
+        runtime.returncode = 0
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['outFiles'] = [view['OutFile'] for view in self.inputs.views]
+        return outputs
+
+
+class QCStateInputSpec(BaseInterfaceInputSpec):
+    prefix = traits.Str(mandatory=True, desc='Directory of the QC states of the subject.')
+    stagenum = traits.Int(mandatory=True, desc='Stage number.')
+    state = traits.Str(mandatory=True, desc='Character/symbol of the state.')
+    Run = traits.Any(mandatory=False, desc='dummy arg.')
+    LaunchInput = traits.Any(mandatory=False, desc='Waits for QC launch state.')
 
 class QCStateOutputSpec(TraitedSpec):
     OutStateFile = File(desc='State file output.')
 
-class QCState(BrainSuiteCommandLine):
+class QCState(BaseInterface):
+    """
+    Sets the QC state of a stage in the subject's state record (see QC/stateStore.py), in-process.
+    """
     input_spec = QCStateInputSpec
     output_spec = QCStateOutputSpec
-    _cmd = 'qcState.sh'
 
-    def _gen_filename(self, name):
-        if name == 'OutStateFile':
-            return self.inputs.prefix + os.sep + 'stage-{0}.state'.format(self.inputs.stagenum)
-        # return getFileName(self.inputs.filename, '.state')
+    def _run_interface(self, runtime):
+        from QC.stateStore import qcStateStore
+        qcStateStore(self.inputs.prefix).set(self.inputs.stagenum, self.inputs.state)
+        return runtime
 
     def _list_outputs(self):
-        return l_outputs(self)
-
-    def _format_arg(self, name, spec, value):
-        if (name == 'Run') or (name == 'LaunchInput'):
-            return #' %s %s %s ' % (self.inputs.prefix,self.inputs.stagenum,self.inputs.state)
-        return spec.argstr % value
+        from QC.stateStore import STATES_FILE
+        outputs = self.output_spec().get()
+        outputs['OutStateFile'] = os.path.join(self.inputs.prefix, STATES_FILE)
+        return outputs
 
 
-class makeMaskInputSpec(CommandLineInputSpec):
-    fileNameAndROIs = traits.Str(mandatory=True, argstr='%s', position=0, desc='Input file name and ROI IDs.')
-    Run = traits.Str(mandatory=False, position=1, desc='dummy arg.')
+class makeMaskInputSpec(BaseInterfaceInputSpec):
+    fileNameAndROIs = traits.Str(mandatory=True, desc='Input file name and ROI IDs.')
+    Run = traits.Any(mandatory=False, desc='dummy arg.')
 
 class makeMaskOutputSpec(TraitedSpec):
     OutFile = File(desc='Output mask file name.')
 
-class makeMask(BrainSuiteCommandLine):
+class makeMask(BaseInterface):
+    """
+    Writes a uint8 mask of the ROIs of a label volume (see QC/makeMask.py), in-process.
+    """
     input_spec = makeMaskInputSpec
     output_spec = makeMaskOutputSpec
-    _cmd = 'makeMask.sh'
 
     def _gen_filename(self, name):
         if name == 'OutFile':
             return self.inputs.fileNameAndROIs.split(' ')[0].split('.')[0] + '.pvc.edge.mask.nii.gz'
 
+    def _run_interface(self, runtime):
+        return cachedRun(self, runtime, self._makeMask)
+
+    def _makeMask(self, runtime):
+        from QC.makeMask import makeMask as writeMask
+        fileNameAndROIs = self.inputs.fileNameAndROIs.split()
+        writeMask(fileNameAndROIs[0], fileNameAndROIs[1:], self._gen_filename('OutFile'))
+        return runtime
+
     def _list_outputs(self):
         return l_outputs(self)
 
-    def _format_arg(self, name, spec, value):
-        if name == "Run":
-            return super(makeMask, self)._format_arg(name, spec, value)
-        return super(makeMask, self)._format_arg(name, spec, value)
+# ioctl that clones the extents of a file (copy-on-write copy) on btrfs, xfs and other reflink-capable file systems
+FICLONE = 0x40049409
 
-class copyFileInputSpec(CommandLineInputSpec):
-    inFile = traits.Str(mandatory=True, argstr='%s', position=0, desc='Input file name to be copied.')
-    outFile = traits.Str(mandatory=True, argstr='%s', position=1, desc='Output copied file name.',
-                         genfile=True, hash_files=True)
-    Run = traits.Str(argstr='%s', position=2, desc='dummy arg.')
+def stageFile(inFile, outFile, links=True):
+    """
+    Makes outFile a copy of inFile at little or no I/O cost: a reflink (copy-on-write) copy if the file system
+    supports it, otherwise (if links is set) a hard link, otherwise a symbolic link. The file is only copied if
+    none of them are possible. outFile is replaced atomically. Returns the method used.
+    """
+    inFile = os.path.abspath(inFile)
+    if os.path.exists(outFile) and os.path.samefile(inFile, outFile):
+        return 'existing'
+    tmpFile = '{0}.{1}.tmp'.format(outFile, os.getpid())
+
+    def staged(method):
+        os.rename(tmpFile, outFile)
+        return method
+
+    try:
+        with open(inFile, 'rb') as src, open(tmpFile, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        shutil.copystat(inFile, tmpFile)
+        return staged('reflink')
+    except (IOError, OSError):
+        if os.path.lexists(tmpFile):
+            os.remove(tmpFile)
+    for method, link in ([('hardlink', os.link), ('symlink', os.symlink)] if links else []):
+        try:
+            link(inFile, tmpFile)
+            return staged(method)
+        except OSError as e:
+            if e.errno not in [errno.EXDEV, errno.EPERM, errno.EACCES, errno.ENOTSUP, errno.EMLINK, errno.ENOSYS]:
+                raise
+    shutil.copy2(inFile, tmpFile)
+    return staged('copy')
+
+class copyFileInputSpec(BaseInterfaceInputSpec):
+    inFile = traits.Str(mandatory=True, desc='Input file name to be copied.')
+    outFile = traits.Str(mandatory=True, desc='Output copied file name.', genfile=True, hash_files=True)
+    Run = traits.Any(desc='dummy arg.')
+    links = traits.Bool(True, usedefault=True,
+                        desc='Stage the file as a hard or symbolic link if it cannot be reflinked. Must be False '
+                             'if a tool rewrites the output file in place, which would also rewrite the input.')
 
 class copyFileOutputSpec(TraitedSpec):
     OutFile = File(desc='Copied file name.')
 
-class copyFile(BrainSuiteCommandLine):
+class copyFile(BaseInterface):
+    """
+    Stages a file at a new location (see stageFile), in-process. The output only depends on the input and
+    output file names, as with cp. The file is linked unless links is False, so only for outputs that are
+    read and replaced (never rewritten in place); stageFile replaces an existing output instead of writing
+    through it. As with cp, a failed copy is logged and reported in the return code instead of raising.
+    """
     input_spec = copyFileInputSpec
     output_spec = copyFileOutputSpec
-    _cmd = 'cp'
 
     def _gen_filename(self, name):
         return self.inputs.outFile
 
+    def _run_interface(self, runtime):
+        try:
+            method = stageFile(self.inputs.inFile, self.inputs.outFile, links=self.inputs.links)
+        except (IOError, OSError) as e:
+            iflogger.info('[ERROR] Could not copy {0} to {1} ({2}).'.format(self.inputs.inFile,
+                                                                          self.inputs.outFile, e))
+            runtime.returncode = 1
+            return runtime
+        iflogger.info('Staged {0} as {1} ({2}).'.format(self.inputs.inFile, self.inputs.outFile, method))
+        runtime.returncode = 0
+        return runtime
+
     def _list_outputs(self):
         return l_outputs(self)
 
-    def _format_arg(self, name, spec, value):
-        if name == "Run":
-            return super(copyFile, self)._format_arg(name, spec, value)
-        return super(copyFile, self)._format_arg(name, spec, value)
-
 
 ## BFP module
 class BFPInputSpec(CommandLineInputSpec):
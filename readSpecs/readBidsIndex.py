@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import json
+
+INDEX_VERSION = 1
+INDEX_FILE = '.bidsIndex.json'
+ANY = '*'
+
+def parseFilename(filename):
+    '''
+    Splits a BIDS file name (e.g. sub-01_ses-A_run-01_T1w.nii.gz) into its entities ({'sub': '01', 'ses': 'A',
+    'run': '01'}), its type (T1w) and its extension (nii.gz).
+    '''
+    stem, _, extension = filename.partition('.')
+    tokens = stem.split('_')
+    entities = {}
+    for tok in tokens[:-1]:
+        if '-' in tok:
+            key, value = tok.split('-', 1)
+            entities[key] = value
+    return entities, tokens[-1], extension
+
+class bidsIndex(object):
+    '''
+    Index of the files of a BIDS dataset, built with a single scan of bids_dir. Files are keyed by
+    (subject, session, run, type) so that the queries made while planning a participant-level run are
+    dictionary reads rather than rescans of the dataset.
+
+    The directory listing is saved in output_dir and reused by later invocations; only directories whose
+    modification time has changed since then are listed again.
+    '''
+
+    def __init__(self, bids_dir, outputdir=None):
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.indexFile = None
+        if outputdir:
+            self.indexFile = os.path.join(outputdir, INDEX_FILE)
+
+        cachedDirs = self.load_index()
+        self.dirs = {}
+        self.rescanned = 0
+        self.scan_dir('', cachedDirs)
+        if self.rescanned > 0 or len(cachedDirs) != len(self.dirs):
+            self.save_index()
+
+        self.files = {}
+        self.subjects = set()
+        self.tasks = set()
+        for rel in sorted(self.dirs):
+            for filename in self.dirs[rel]['files']:
+                self.add_file(os.path.join(self.bids_dir, rel, filename), filename)
+
+    def load_index(self):
+        if not self.indexFile or not os.path.exists(self.indexFile):
+            return {}
+        try:
+            with open(self.indexFile, 'r') as f:
+                index = json.load(f)
+        except ValueError:
+            return {}
+        if index.get('version') != INDEX_VERSION or index.get('bids_dir') != self.bids_dir:
+            return {}
+        return index['dirs']
+
+    def save_index(self):
+        if not self.indexFile:
+            return
+        tmpFile = '{0}.{1}.tmp'.format(self.indexFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'bids_dir': self.bids_dir, 'dirs': self.dirs}, f)
+        os.rename(tmpFile, self.indexFile)
+
+    def scan_dir(self, rel, cachedDirs):
+        path = os.path.join(self.bids_dir, rel)
+        mtime = os.stat(path).st_mtime
+        cached = cachedDirs.get(rel)
+        if cached is not None and cached['mtime'] == mtime:
+            entry = cached
+        else:
+            self.rescanned += 1
+            files = []
+            subdirs = []
+            for name in sorted(os.listdir(path)):
+                if name.startswith('.'):
+                    continue
+                if os.path.isdir(os.path.join(path, name)):
+                    # only subject folders are indexed below the top level
+                    if rel or name.startswith('sub-'):
+                        subdirs.append(name)
+                else:
+                    files.append(name)
+            entry = {'mtime': mtime, 'files': files, 'subdirs': subdirs}
+        self.dirs[rel] = entry
+        for name in entry['subdirs']:
+            self.scan_dir(os.path.join(rel, name), cachedDirs)
+
+    def add_file(self, path, filename):
+        entities, datatype, extension = parseFilename(filename)
+        if 'task' in entities:
+            self.tasks.add(entities['task'])
+        if 'sub' not in entities:
+            return
+        subject = entities['sub']
+        self.subjects.add(subject)
+        session = entities.get('ses')
+        run = entities.get('run')
+        for key in [(subject, session, run, datatype), (subject, ANY, run, datatype),
+                    (subject, session, ANY, datatype), (subject, ANY, ANY, datatype)]:
+            self.files.setdefault(key, []).append((path, session, run, extension))
+
+    def lookup(self, subject, type, session=ANY, run=ANY, extensions=None):
+        if session is None:
+            session = ANY
+        if run is None:
+            run = ANY
+        sessions = session if isinstance(session, (list, tuple)) else [session]
+        matches = []
+        for ses in sessions:
+            for entry in self.files.get((subject, ses, run, type), []):
+                if extensions is None or entry[3] in extensions:
+                    matches.append(entry)
+        return matches
+
+    def get(self, subject, type, session=None, run=None, extensions=None):
+        '''
+        Returns the paths of the files of a subject with the given type (e.g. T1w, dwi, bold). Session may be
+        a single label or a list of labels.
+        '''
+        return sorted(set(entry[0] for entry in self.lookup(subject, type, session, run, extensions)))
+
+    def get_sessions(self, subject, type, extensions=None):
+        return sorted(set(entry[1] for entry in self.lookup(subject, type, extensions=extensions)
+                          if entry[1] is not None))
+
+    def get_runs(self, subject, type, session=None, extensions=None):
+        return sorted(set(entry[2] for entry in self.lookup(subject, type, session, extensions=extensions)
+                          if entry[2] is not None))
+
+    def get_subjects(self):
+        return sorted(self.subjects)
+
+    def get_tasks(self):
+        return sorted(self.tasks)
+
+    def get_nearest(self, path, extension):
+        '''
+        Finds the sidecar file with the given extension that applies to path, following the BIDS inheritance
+        principle: the closest directory wins and the sidecar's entities must be a subset of those of path.
+        '''
+        entities, datatype, _ = parseFilename(os.path.basename(path))
+        rel = os.path.relpath(os.path.dirname(os.path.abspath(path)), self.bids_dir)
+        if rel == '.':
+            rel = ''
+        while True:
+            candidates = []
+            for filename in self.dirs.get(rel, {'files': []})['files']:
+                sidecarEntities, sidecarType, sidecarExtension = parseFilename(filename)
+                if sidecarExtension == extension and sidecarType == datatype and \
+                        all(entities.get(key) == value for key, value in sidecarEntities.items()):
+                    candidates.append((len(sidecarEntities), filename))
+            if candidates:
+                return os.path.join(self.bids_dir, rel, max(candidates)[1])
+            if not rel:
+                break
+            rel = os.path.dirname(rel)
+        raise ValueError('No .{0} file found for {1}.'.format(extension, path))
+
+    def get_bval(self, path):
+        return self.get_nearest(path, 'bval')
+
+    def get_bvec(self, path):
+        return self.get_nearest(path, 'bvec')
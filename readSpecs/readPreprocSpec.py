@@ -25,18 +25,31 @@ import sys
 import json
 import configparser
 from io import StringIO
-import nipype.pipeline.engine as pe
-import nipype.interfaces.brainsuite as bs
 from datetime import datetime
 from collections import OrderedDict
 
-Obj = pe.Node(interface=bs.Bfc(), name='Obj')
-undefined = Obj.inputs.biasRange
+# BFP configuration template, completed by the preprocessing specification
+BFP_CONFIG = '/config.ini'
+# placeholder of the per-subject scbPath in the BFP configuration
+SCBPATH_PLACEHOLDER = '@scbPath@'
+
+def write_atomic(filename, text):
+    tmpFile = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(tmpFile, 'w') as f:
+        f.write(text)
+    os.rename(tmpFile, filename)
 
 class preProcSpec(object):
+    '''
+    Preprocessing parameters: the defaults, overridden by the preprocessing specification file (--preprocspec)
+    if one is given. The file is read and validated once; the parameters cannot be changed afterwards. The
+    per-subject files derived from it are written by write_subject_files.
+    '''
 
-    def __init__(self, bids_dir, outputdir):
+    def __init__(self, bids_dir, outputdir, preprocfile=None):
         self.read_file = False
+        self.specsText = None
+        self.configText = None
 
         # svreg
         self.atlas = 'BCI'
@@ -44,6 +57,7 @@ class preProcSpec(object):
 
         # nipype config
         self.cache = '/tmp'
+        self.resources = {}
 
         # bfp
         self.taskname = ["rest"]
@@ -126,19 +140,29 @@ class preProcSpec(object):
         self.forcePartialROIStats = False
 
 
-        self.echoSpacing = undefined
+        # None: not set (left undefined in the BDP node)
+        self.echoSpacing = None
         self.fieldmapCorrection = None
-        self.diffusion_time_ms = undefined
+        self.diffusion_time_ms = None
 
         self.estimateODF_ERFO = False
-        self.sigma_GQI = undefined
-        self.ERFO_SNR = undefined
+        self.sigma_GQI = None
+        self.ERFO_SNR = None
 
         # smoothing
         self.smoothvol = 3.0
         self.smoothsurf = 2.0
 
-    def read_preprocfile(self, preprocfile, subjectID):
+        if preprocfile is not None:
+            self.read_preprocfile(preprocfile)
+        self.frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, 'frozen', False):
+            raise AttributeError('The preprocessing specification is read-only ({0} cannot be set).'.format(name))
+        object.__setattr__(self, name, value)
+
+    def read_preprocfile(self, preprocfile):
 
         try:
             if not os.path.isfile(preprocfile):
@@ -166,9 +190,10 @@ class preProcSpec(object):
             sys.exit(2)
 
         try:
-            specs = json.load(open(preprocfile))
+            with open(preprocfile, 'r') as f:
+                specs = json.load(f)
             self.specs = specs
-        except SyntaxError as e:
+        except (SyntaxError, ValueError) as e:
             sys.stdout.write('##############################################\n'
                              '##############################################\n'
                              '##############################################\n'
@@ -184,19 +209,32 @@ class preProcSpec(object):
             print(e, '\n')
             sys.exit(2)
 
-        # write a copy of the preproc.json file
-        CT = datetime.now()
-        CTstring = 'Y{0}M{1}D{2}H{3}M{4}S{5}ms{6}'.format(CT.year,CT.month,CT.day,CT.hour, CT.minute,CT.second,CT.microsecond)
-        preprocArchived = os.path.join(self.outputdir, subjectID, 'preprocspecs_{0}.json'.format(CTstring))
-        with open(preprocArchived, 'w') as f:
-            json.dump(self.specs, f)
+        try:
+            self.read_specs(specs)
+        except KeyError as e:
+            sys.stdout.write('##############################################\n'
+                             '##############################################\n'
+                             '##############################################\n'
+                             '************ ERROR!!! ************\n'
+                             'The field {0} is missing from the preprocessing specification file {1}.\n'
+                             '##############################################\n'
+                             '##############################################\n'
+                             '##############################################\n'.format(e, preprocfile))
+            sys.exit(2)
 
+        # copy of the specification, archived for each subject
+        self.specsText = json.dumps(specs)
+        self.configText = self.bfp_config()
+        self.read_file = True
+
+    def read_specs(self, specs):
         # svreg
         self.atlas = specs['BrainSuite']['Anatomical']['atlas']
         self.singleThread = bool(specs['BrainSuite']['Anatomical']['singleThread'])
 
         # nipype config
         self.cache = specs['BrainSuite']['Global Settings']['cacheFolder']
+        self.resources = specs['BrainSuite']['Global Settings'].get('resources', {})
 
         # bse
         self.autoParameters = bool(specs['BrainSuite']['Anatomical']['autoParameters'])
@@ -249,14 +287,14 @@ class preProcSpec(object):
                              '##############################################\n'
                              '\n')
 
-        self.echoSpacing = undefined if (specs['BrainSuite']['Diffusion']['echoSpacing'] == '' ) \
+        self.echoSpacing = None if (specs['BrainSuite']['Diffusion']['echoSpacing'] == '' ) \
             else specs['BrainSuite']['Diffusion']['echoSpacing']
         self.fieldmapCorrection = None if (specs['BrainSuite']['Diffusion']['fieldmapCorrection']  == '') \
             else specs['BrainSuite']['Diffusion']['fieldmapCorrection']
 
-        self.sigma_GQI = undefined if (specs['BrainSuite']['Diffusion']['sigma_GQI'] == '') \
+        self.sigma_GQI = None if (specs['BrainSuite']['Diffusion']['sigma_GQI'] == '') \
             else specs['BrainSuite']['Diffusion']['sigma_GQI']
-        self.ERFO_SNR = undefined if (specs['BrainSuite']['Diffusion']['ERFO_SNR'] == '') \
+        self.ERFO_SNR = None if (specs['BrainSuite']['Diffusion']['ERFO_SNR'] == '') \
             else specs['BrainSuite']['Diffusion']['ERFO_SNR']
 
         self.flm = specs['BrainSuite']['Diffusion']['flm']
@@ -281,7 +319,7 @@ class preProcSpec(object):
 
         # check diffusion_time_ms dependency
         if self.estimateODF_3DShore:
-            assert self.diffusion_time_ms != undefined, "If you would like to estimate using 3DShore, " \
+            assert self.diffusion_time_ms is not None, "If you would like to estimate using 3DShore, " \
                                                         "please define the diffusion time, in ms."
 
 
@@ -308,9 +346,8 @@ class preProcSpec(object):
         self.bpoption = specs['BrainSuite']['Functional']['BPoption']
         self.rundetrend = specs['BrainSuite']['Functional']['RunDetrend']
         self.runnsr = specs['BrainSuite']['Functional']['RunNSR']
+        # if not set, scbPath is func/scb.mat in the output folder of each subject (see write_subject_files)
         self.scbpath = specs['BrainSuite']['Functional']['scbPath']
-        if not self.scbpath:
-            self.scbpath = os.path.join(self.outputdir, subjectID, 'func', 'scb.mat')
         self.T1mask = specs['BrainSuite']['Functional']['T1mask']
         # self.epit1corr = specs['BrainSuite']['Functional']['epit1corr']
         # self.epit1corr_mask = specs['BrainSuite']['Functional']['epit1corr_mask']
@@ -320,7 +357,12 @@ class preProcSpec(object):
         self.uscrigid_similarity = specs['BrainSuite']['Functional']['uscrigid_similarity']
         self.simref = specs['BrainSuite']['Functional']['SimRef']
 
-        ini_str = u'[main]\n' + open('/config.ini', 'r').read()
+    def bfp_config(self):
+        '''
+        Returns the BFP configuration (/config.ini with the parameters of the specification). scbPath is
+        SCBPATH_PLACEHOLDER if it is set per subject.
+        '''
+        ini_str = u'[main]\n' + open(BFP_CONFIG, 'r').read()
         ini_fp = StringIO(ini_str)
         config = configparser.RawConfigParser()
         # config.optionxform(str())
@@ -352,19 +394,28 @@ class preProcSpec(object):
 
         config.set('main','RunDetrend', str(self.rundetrend))
         config.set('main','RunNSR', str(self.runnsr))
-        config.set('main', 'scbPath', str(self.scbpath))
+        config.set('main', 'scbPath', str(self.scbpath) if self.scbpath else SCBPATH_PLACEHOLDER)
         config.set('main', 'T1mask', str(self.T1mask))
         config.set('main', 'uscrigid_similarity', str(self.uscrigid_similarity))
 
-        with open('{0}/config.ini'.format(self.outputdir + '/' + subjectID), 'w') as configfile:
-            config.write(configfile)
-
-        with open('{0}/config.ini'.format(self.outputdir + '/' + subjectID), 'r') as fin:
-            data = fin.read().splitlines(True)
-        with open('{0}/config.ini'.format(self.outputdir + '/' + subjectID), 'w') as fout:
-            fout.writelines(data[1:])
-
-        self.read_file = True
+        configfile = StringIO()
+        config.write(configfile)
+        # without the [main] section header
+        return ''.join(configfile.getvalue().splitlines(True)[1:])
+
+    def write_subject_files(self, subjectID):
+        '''
+        Writes the files of a subject derived from the specification: a timestamped copy of the specification
+        and the BFP configuration (config.ini) in the output folder of the subject.
+        '''
+        if not self.read_file:
+            return
+        subjectDir = os.path.join(self.outputdir, subjectID)
+        CT = datetime.now()
+        CTstring = 'Y{0}M{1}D{2}H{3}M{4}S{5}ms{6}'.format(CT.year,CT.month,CT.day,CT.hour, CT.minute,CT.second,CT.microsecond)
+        write_atomic(os.path.join(subjectDir, 'preprocspecs_{0}.json'.format(CTstring)), self.specsText)
+        scbpath = self.scbpath if self.scbpath else os.path.join(subjectDir, 'func', 'scb.mat')
+        write_atomic(os.path.join(subjectDir, 'config.ini'), self.configText.replace(SCBPATH_PLACEHOLDER, scbpath))
 
 
     def write_preproc_params(self, outputdir, STAGES, dataset_description_file=None):
@@ -430,11 +481,11 @@ class preProcSpec(object):
             echoSpacing = self.echoSpacing
             fieldmapCorrection = self.fieldmapCorrection
             diffusion_time_ms = self.diffusion_time_ms
-            if self.echoSpacing == undefined:
+            if self.echoSpacing is None:
                 echoSpacing = ''
-            if self.fieldmapCorrection == undefined:
+            if self.fieldmapCorrection is None:
                 fieldmapCorrection = ''
-            if self.diffusion_time_ms == undefined:
+            if self.diffusion_time_ms is None:
                 diffusion_time_ms = ''
             params['BrainSuite BIDS App run parameters'].append({
                 'BDP': {
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+VALIDATION_FILE = '.bidsValidation.json'
+# folders that bids-validator does not look into
+IGNORED_DIRS = ['derivatives', 'sourcedata', 'code']
+PARTICIPANTS_FILE = 'participants.tsv'
+
+def fingerprintTree(path):
+    '''
+    Digest of the paths, sizes and modification times of all files below path.
+    '''
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            filename = os.path.join(root, name)
+            st = os.stat(filename)
+            digest.update('{0}\0{1}\0{2}\n'.format(os.path.relpath(filename, path), st.st_size,
+                                                    st.st_mtime).encode('utf-8'))
+    return digest.hexdigest()
+
+class bidsValidation(object):
+    '''
+    Keeps the outcome of previous bids-validator runs in output_dir, keyed on a fingerprint of the dataset
+    (paths, sizes and mtimes of the files). If the top level of the dataset and the validator options are
+    unchanged, only the subjects that are new or have changed since the last successful validation are
+    validated again.
+    '''
+
+    def __init__(self, bids_dir, outputdir, options):
+        self.bids_dir = os.path.abspath(bids_dir)
+        self.validationFile = os.path.join(outputdir, VALIDATION_FILE)
+        self.options = options
+        if options.get('config') and os.path.isfile(options['config']):
+            self.options['configFingerprint'] = os.stat(options['config']).st_mtime
+        self.tmpdir = None
+
+        self.topLevel = hashlib.sha1()
+        self.subjects = {}
+        for name in sorted(os.listdir(self.bids_dir)):
+            path = os.path.join(self.bids_dir, name)
+            if name.startswith('sub-') and os.path.isdir(path):
+                self.subjects[name] = fingerprintTree(path)
+            elif os.path.isdir(path) and (name.startswith('.') or name in IGNORED_DIRS):
+                self.topLevel.update('{0}\n'.format(name).encode('utf-8'))
+            elif os.path.isdir(path):
+                self.topLevel.update('{0}\0{1}\n'.format(name, fingerprintTree(path)).encode('utf-8'))
+            else:
+                st = os.stat(path)
+                self.topLevel.update('{0}\0{1}\0{2}\n'.format(name, st.st_size, st.st_mtime).encode('utf-8'))
+        self.topLevel = self.topLevel.hexdigest()
+
+    def load(self):
+        if not os.path.exists(self.validationFile):
+            return None
+        try:
+            with open(self.validationFile, 'r') as f:
+                return json.load(f)
+        except ValueError:
+            return None
+
+    def prepare(self):
+        '''
+        Returns the directory that bids-validator needs to be run on: bids_dir itself, a temporary dataset
+        with only the changed subjects, or None if the previous validation still holds.
+        '''
+        previous = self.load()
+        if previous is None or previous['options'] != self.options or previous['topLevel'] != self.topLevel:
+            return self.bids_dir
+        changed = [subject for subject, fingerprint in self.subjects.items()
+                   if previous['subjects'].get(subject) != fingerprint]
+        if len(changed) == 0:
+            print('The BIDS dataset has not changed since it was last validated. Skipping bids-validator.')
+            return None
+        if len(changed) == len(self.subjects):
+            return self.bids_dir
+
+        # Link the top level files and the changed subjects into a temporary dataset
+        print('Running bids-validator on the {0} subject(s) that changed since the last validation.'.format(
+            len(changed)))
+        self.tmpdir = tempfile.mkdtemp(prefix='bidsValidation')
+        for name in os.listdir(self.bids_dir):
+            if name == PARTICIPANTS_FILE:
+                self.writeParticipants(os.path.join(self.tmpdir, name), changed)
+            elif not name.startswith('sub-') or name in changed:
+                os.symlink(os.path.join(self.bids_dir, name), os.path.join(self.tmpdir, name))
+        return self.tmpdir
+
+    def writeParticipants(self, filename, subjects):
+        '''
+        Writes the rows of participants.tsv of the given subjects only, since bids-validator reports the subjects
+        listed in participants.tsv that are not in the dataset as an error.
+        '''
+        with open(os.path.join(self.bids_dir, PARTICIPANTS_FILE), 'r') as f:
+            lines = f.read().splitlines()
+        with open(filename, 'w') as f:
+            for num, line in enumerate(lines):
+                if num == 0 or line.split('\t')[0].strip() in subjects:
+                    f.write(line + '\n')
+
+    def record(self):
+        '''
+        Stores the fingerprints after bids-validator has run successfully.
+        '''
+        tmpFile = '{0}.{1}.tmp'.format(self.validationFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'options': self.options, 'topLevel': self.topLevel, 'subjects': self.subjects}, f)
+        os.rename(tmpFile, self.validationFile)
+        self.cleanup()
+
+    def cleanup(self):
+        if self.tmpdir:
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+            self.tmpdir = None
@@ -24,6 +24,9 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 from __future__ import unicode_literals, print_function
 
+import time
+# start of run.py, for the startup budget (see checkStartup)
+STARTUP_TIME = time.time()
 import os
 import sys
 import subprocess
@@ -33,12 +36,16 @@ import traceback
 
 import warnings
 warnings.filterwarnings(action='ignore', category=FutureWarning)
-from bids.grabbids import BIDSLayout
 from builtins import str
 import shutil
 
 from readSpecs.readPreprocSpec import preProcSpec
-from workflows.runWorkflow import runWorkflow
+from readSpecs.readBidsIndex import bidsIndex
+from readSpecs.validateBids import bidsValidation
+from workflows.workUnits import enumerateWorkUnits, shardWorkUnits, arrayJobShard
+from workflows.runtimeProfile import writeCohortReport, COHORT_TIMINGS_FILE
+from workflows.mcrCache import mcrCacheRoot
+from workflows.executionPlugin import PLUGINS, PLUGIN_ENV, CLUSTER_ARGS_ENV, SUBMIT_COMMANDS
 from QC.stageNumDict import stageNumDict
 
 ########################################################################
@@ -65,6 +72,23 @@ def run(command, env={}, cwd=None):
 
 BFPpath= os.environ['BFP'] + '/bfp.sh'
 
+# seconds allowed from the start of run.py to the end of argument parsing. nipype, pybids, rpy2 and nibabel
+# are only imported by the modes that need them (participant-level processing, group-level analysis).
+STARTUP_BUDGET = 1.0
+HEAVY_MODULES = ['nipype', 'bids', 'rpy2', 'nibabel', 'numpy', 'pandas']
+
+def checkStartup():
+    '''
+    Reports a startup (imports and argument parsing) slower than STARTUP_BUDGET, with the heavy modules that
+    were imported.
+    '''
+    elapsed = time.time() - STARTUP_TIME
+    if elapsed > STARTUP_BUDGET:
+        loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+        print('Startup took {0:.2f} s (budget: {1:.1f} s). Heavy modules imported at startup: {2}'.format(
+            elapsed, STARTUP_BUDGET, ', '.join(loaded) if loaded else 'none'))
+    return elapsed
+
 __version__ = open('/BrainSuite/version').read()
 BrainsuiteVersion = os.environ['BrainSuiteVersion']
 
@@ -110,6 +134,15 @@ def parser():
                        'provided, all subjects will be analyzed. Multiple '
                        'participants can be specified with a space separated list.',
                        nargs="+")
+    dataselect.add_argument('--shardIndex', help='Optional. Index (starting at 0) of the shard of work units to process '
+                            'when a cohort is split across several jobs. Every (subject, session, run) work unit is '
+                            'assigned to one of --shardCount shards, balancing the expected cost of each shard.',
+                            type=int, required=False)
+    dataselect.add_argument('--shardCount', help='Optional. Number of shards the work units are split into.',
+                            type=int, required=False)
+    dataselect.add_argument('--arrayJob', help='Reads the shard index and shard count from the environment of a SLURM '
+                            '(SLURM_ARRAY_TASK_ID) or SGE (SGE_TASK_ID) array job, with one shard per array task.',
+                            action='store_true', required=False)
     dataselect.add_argument('--session', help='The session label of the participant that should be analyzed. The label '
                             'corresponds to ses-<session label> from the BIDS spec (so it does not include "ses-"). If this '
                             'parameter is not provided, all sessions will be analyzed. Multiple sessions can be specified '
@@ -188,6 +221,10 @@ def parser():
                                              'on how to create this JSON file, please visit https://github.com/bids-standard/bids-validator#configuration.', nargs='?',
                         const='',
                         required=False)
+    bidsval.add_argument('--skipBidsValidator', help='Skips the bids-validator step (e.g. for DASHBOARD or group-level runs '
+                                                     'on a dataset that has already been validated). Otherwise, validation '
+                                                     'results are cached in output_dir and only new or changed subjects '
+                                                     'are validated again.', action='store_true', required=False)
 
     parser.add_argument_group('Miscellaneous options')
     parser.add_argument('--cache', help='Nipype cache output folder.', required=False)
@@ -196,6 +233,43 @@ def parser():
     parser.add_argument('--maxmem', help='Maximum memory (in GB) that can be used at once.',
                         required=False,
                         default=16)
+    parser.add_argument('--cohortWorkflow', help='Runs all of the selected subjects/sessions/runs as a single nipype '
+                                                 'execution so that --ncpus and --maxmem are shared across subjects, '
+                                                 'instead of processing one subject at a time.',
+                        action='store_true', required=False)
+    parser.add_argument('--resume', help='Skips the stages (CSE, SVREG, BDP, SVREG+BDP, BFP) whose outputs in '
+                                         'output_dir are complete and unchanged since they were last produced '
+                                         'with the same parameters.',
+                        action='store_true', required=False)
+    parser.add_argument('--globalCache', help='Optional. Folder of a content-addressed cache of node outputs shared '
+                                              'across subjects and runs. Nodes whose inputs and tool version match '
+                                              'a cached execution restore its outputs instead of running.',
+                        required=False, default=None)
+    parser.add_argument('--globalCacheSizeGB', help='Maximum size (in GB) of the --globalCache folder; the least '
+                                                    'recently used entries are evicted first.',
+                        required=False, default=50, type=float)
+    parser.add_argument('--stageAtlas', help='Optional. Copies the SVReg atlas once per machine into this local '
+                                             'scratch folder (e.g. a local disk or tmpfs such as /dev/shm) and '
+                                             'reads it from there, instead of from the container image, for every '
+                                             'subject. If no folder is given, $TMPDIR/BrainSuiteAtlas is used.',
+                        nargs='?', const=os.path.join(os.environ.get('TMPDIR', '/tmp'), 'BrainSuiteAtlas'),
+                        required=False, default=None)
+    parser.add_argument('--mcrCacheRoot', help='Optional. MATLAB Runtime cache folder shared by the subjects processed '
+                                               'on a machine, preferably on local disk; a pre-warmed cache (see '
+                                               'workflows/mcrCache.py) can be used. Defaults to $BRAINSUITE_MCR_CACHE '
+                                               'if set, otherwise output_dir/.mcrCache/<host name>.',
+                        required=False, default=None)
+    parser.add_argument('--plugin', help='nipype execution plugin. MultiProc runs the nodes in parallel on this '
+                                          'machine within --ncpus and --maxmem; Linear runs them one at a time. '
+                                          'SLURM and SGE submit SVReg, BDP, Eddy and BFP as batch jobs '
+                                          'requesting the memory and cpus of their resource profile, and run the '
+                                          'other nodes (CSE, QC renders) locally; the compute nodes must share '
+                                          'output_dir and the BrainSuite installation.',
+                        choices=PLUGINS, required=False, default='MultiProc')
+    parser.add_argument('--clusterArgs', help='Optional. Options added to every sbatch/qsub submission with '
+                                              '--plugin SLURM or SGE, e.g. --clusterArgs="--partition=long '
+                                              '--time=12:00:00".',
+                        required=False, default='')
     parser.add_argument('-v', '--version', action='version',
                         version='BrainSuite{0} Pipelines BIDS App version {1}'.format(BrainsuiteVersion,BrainsuiteVersion))
 
@@ -204,6 +278,7 @@ def parser():
 
 def main():
     args = parser().parse_args()
+    checkStartup()
 
     # Configure bids validator args then run bids-validator
     ignoreSubjectConsistency = ''
@@ -214,9 +289,21 @@ def main():
         bidsconfig = ' --config {0} '.format(args.bidsconfig)
     if not os.path.exists(args.output_dir):
         os.mkdir(args.output_dir)
-    run("bids-validator " + args.bids_dir + ignoreSubjectConsistency + bidsconfig, cwd=args.output_dir)
-
-    layout = BIDSLayout(args.bids_dir)
+    if args.skipBidsValidator:
+        print('Skipping bids-validator.')
+    else:
+        validation = bidsValidation(args.bids_dir, args.output_dir,
+                                    {'ignoreSubjectConsistency': args.ignoreSubjectConsistency,
+                                     'config': args.bidsconfig})
+        try:
+            validate_dir = validation.prepare()
+            if validate_dir:
+                run("bids-validator " + validate_dir + ignoreSubjectConsistency + bidsconfig, cwd=args.output_dir)
+                validation.record()
+        finally:
+            validation.cleanup()
+
+    layout = bidsIndex(args.bids_dir, args.output_dir)
     subjects_to_analyze = []
 
     # Determine which subjects to run or QC
@@ -241,6 +328,19 @@ def main():
     # set variables for nipype multiproc plugin resources and total num for stages
     os.environ['NCPUS'] = str(args.ncpus)
     os.environ['MAXMEM'] = str(args.maxmem)
+    os.environ[PLUGIN_ENV] = args.plugin
+    os.environ[CLUSTER_ARGS_ENV] = args.clusterArgs
+    if args.plugin in SUBMIT_COMMANDS and not shutil.which(SUBMIT_COMMANDS[args.plugin]):
+        sys.stdout.write('************ ERROR!!! ************\n'
+                         '{0} was not found; it is required by --plugin {1}. For testing, a stand-in of '
+                         'sbatch/squeue that runs the jobs on this machine is in workflows/localScheduler.\n'.format(
+                             SUBMIT_COMMANDS[args.plugin], args.plugin))
+        sys.exit(2)
+    if args.globalCache:
+        os.environ['BRAINSUITE_GLOBAL_CACHE'] = os.path.abspath(args.globalCache)
+        os.environ['BRAINSUITE_GLOBAL_CACHE_GB'] = str(args.globalCacheSizeGB)
+    if args.stageAtlas:
+        os.environ['BRAINSUITE_ATLAS_SCRATCH'] = os.path.abspath(args.stageAtlas)
     os.environ["numstages"] = str(len(stageNumDict))
     stages = args.stages
 
@@ -293,31 +393,60 @@ def main():
 
     if (args.analysis_level == "participant"):
 
+        # enumerate the (subject, session, run) work units
+        workUnits = []
+        for subject_label in subjects_to_analyze:
+            workUnits.extend(enumerateWorkUnits(layout, subject_label, args))
+
+        # in array-job mode, only process this job's shard of the work units
+        shardIndex, shardCount = args.shardIndex, args.shardCount
+        if args.arrayJob:
+            envIndex, envCount = arrayJobShard()
+            if envCount is None:
+                sys.stdout.write('************ ERROR!!! ************\n'
+                                 '--arrayJob was used, but no SLURM (SLURM_ARRAY_TASK_ID) or SGE (SGE_TASK_ID) array job '
+                                 'was detected.\n')
+                sys.exit(2)
+            if shardIndex is None:
+                shardIndex = envIndex
+            if shardCount is None:
+                shardCount = envCount
+        shardT1ws = None
+        if (shardIndex is not None or shardCount is not None) and 'DASHBOARD' not in stages:
+            if shardIndex is None or shardCount is None or not (0 <= shardIndex < shardCount):
+                sys.stdout.write('************ ERROR!!! ************\n'
+                                 'Both --shardIndex and --shardCount are required, with 0 <= shardIndex < shardCount.\n')
+                sys.exit(2)
+            workUnits = shardWorkUnits(workUnits, shardIndex, shardCount, stages)
+            shardT1ws = set([t1w for unit in workUnits for t1w in unit['t1ws']])
+            shardSubjects = set([unit['subject_label'] for unit in workUnits])
+            subjects_to_analyze = [subject_label for subject_label in subjects_to_analyze
+                                   if subject_label in shardSubjects]
+            print('Shard {0} of {1}: processing {2} work unit(s): {3}'.format(
+                shardIndex, shardCount, len(workUnits), ' '.join(sorted(shardT1ws))))
+
         cacheset =False
         # initialize preprocessing parameters
-        preprocspecs = preProcSpec(args.bids_dir, args.output_dir)
+        preprocspecs = preProcSpec(args.bids_dir, args.output_dir, args.preprocspec)
+        if args.preprocspec:
+            atlas = atlases[str(preprocspecs.atlas)]
+            thread = preprocspecs.singleThread
+            if preprocspecs.cache:
+                cacheset = True
+                args.cache = preprocspecs.cache
         # pre-grab subject IDs and write necessary sidecar files
         allt1ws = []
         for subject_label in subjects_to_analyze:
 
-            if args.session:
-                t1ws = [f.filename for f in layout.get(subject=subject_label, session=args.session,
-                                                   type='T1w', extensions=["nii.gz", "nii"])]
-            else:
-                t1ws = [f.filename for f in layout.get(subject=subject_label,
-                                                   type='T1w', extensions=["nii.gz", "nii"])]
+            t1ws = layout.get(subject_label, 'T1w', session=args.session, extensions=["nii.gz", "nii"])
+            if shardT1ws is not None:
+                t1ws = [t1w for t1w in t1ws if t1w in shardT1ws]
 
             for t1w in t1ws:
                 subjectID = t1w.split('/')[-1].split('_T1w')[0]
                 if not os.path.exists('{0}/{1}/'.format(args.output_dir, subjectID)):
                     os.makedirs('{0}/{1}/'.format(args.output_dir, subjectID))
-                if args.preprocspec:
-                    preprocspecs.read_preprocfile(args.preprocspec, subjectID)
-                    atlas = atlases[str(preprocspecs.atlas)]
-                    thread = preprocspecs.singleThread
-                    if preprocspecs.cache:
-                        cacheset = True
-                        args.cache = preprocspecs.cache
+                preprocspecs.write_subject_files(subjectID)
             allt1ws.extend(t1ws)
         dataset_description = None
         if os.path.exists(args.bids_dir + '/dataset_description.json'):
@@ -348,76 +477,25 @@ def main():
             # qc is automatically added into the stages for now
             if 'QC' not in stages:
                 stages.append('QC')
-            for subject_label in subjects_to_analyze:
-                mcrCache = os.path.join(args.output_dir, '.mcrCache/{0}.mcrCache'.format(subject_label))
-                if not os.path.exists(mcrCache):
-                    os.makedirs(mcrCache)
-                os.environ['MCR_CACHE_ROOT']= mcrCache
-
-                sessions = layout.get(target='session', return_type='id',
-                                      subject=subject_label, type='T1w', extensions=["nii.gz","nii"])
-                if args.session:
-                    sessions = args.session
-                # determine which files to run the runWorkflow
-                if len(sessions) > 0:
-                    for ses in range(0, len(sessions)):
-                        runs = layout.get(target='run', return_type='id', session=sessions[ses],
-                                      subject=subject_label, type='T1w', extensions=["nii.gz","nii"])
-                        if len(runs) > 0:
-                            for r in range(0, len(runs)):
-                                t1ws = [f.filename for f in layout.get(subject=subject_label, run=runs[r],
-                                                                       type='T1w', session=sessions[ses],
-                                                                       extensions=["nii.gz", "nii"])]
-                                dwis = [f.filename for f in layout.get(subject=subject_label, run=runs[r],
-                                                                       type='dwi', session=sessions[ses],
-                                                                       extensions=["nii.gz", "nii"])]
-                                funcs = [f.filename for f in layout.get(subject=subject_label, run=runs[r],
-                                                                        type='bold', session=sessions[ses],
-                                                                        extensions=["nii.gz", "nii"])]
-                                runWorkflow(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout,
-                                            dwis, funcs, subject_label, args)
-
-                        else:
-                            t1ws = [f.filename for f in layout.get(subject=subject_label,
-                                                                   type='T1w', session=sessions[ses],
-                                                                   extensions=["nii.gz", "nii"])]
-                            dwis = [f.filename for f in layout.get(subject=subject_label,
-                                                                   type='dwi', session=sessions[ses],
-                                                                   extensions=["nii.gz", "nii"])]
-                            funcs = [f.filename for f in layout.get(subject=subject_label,
-                                                                    type='bold', session=sessions[ses],
-                                                                    extensions=["nii.gz", "nii"])]
-                            runWorkflow(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout,
-                                    dwis, funcs, subject_label, args)
-                else:
-                    runs = layout.get(target='run', return_type='id',
-                                      subject=subject_label, type='T1w', extensions=["nii.gz", "nii"])
-                    if len(runs) > 0:
-                        for r in range(0, len(runs)):
-                            t1ws = [f.filename for f in layout.get(subject=subject_label, run=runs[r],
-                                                                   type='T1w',
-                                                                   extensions=["nii.gz", "nii"])]
-                            dwis = [f.filename for f in layout.get(subject=subject_label, run=runs[r],
-                                                                   type='dwi',
-                                                                   extensions=["nii.gz", "nii"])]
-                            funcs = [f.filename for f in layout.get(subject=subject_label, run=runs[r],
-                                                                    type='bold',
-                                                                    extensions=["nii.gz", "nii"])]
-                            runWorkflow(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout,
-                                        dwis, funcs, subject_label, args)
-                    else:
-                        t1ws = [f.filename for f in layout.get(subject=subject_label,
-                                                               type='T1w', extensions=["nii.gz", "nii"])]
-                        # assert (len(t1ws) > 0), "No T1w files found for subject %s!" % subject_label
-
-                        dwis = [f.filename for f in layout.get(subject=subject_label,
-                                                               type='dwi', extensions=["nii.gz", "nii"])]
-
-                        funcs = [f.filename for f in layout.get(subject=subject_label,
-                                                                type='bold',
-                                                                extensions=["nii.gz", "nii"])]
-                        runWorkflow(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout,
-                                dwis, funcs, subject_label, args)
+            # MATLAB Runtime cache shared by the subjects processed on this machine
+            os.environ['MCR_CACHE_ROOT'] = mcrCacheRoot(args.output_dir, args.mcrCacheRoot)
+            from workflows.runWorkflow import runWorkflow, runCohortWorkflow
+            if args.cohortWorkflow:
+                runCohortWorkflow(stages, workUnits, preprocspecs, atlas, cacheset, thread, layout, args)
+            else:
+                for unit in workUnits:
+                    subject_label = unit['subject_label']
+                    runWorkflow(stages, unit['t1ws'], preprocspecs, atlas, cacheset, thread, layout,
+                                unit['dwis'], unit['funcs'], subject_label, args)
+
+            # aggregate the per-subject timings.json files of output_dir
+            cohortTimings = writeCohortReport(args.output_dir)
+            if len(cohortTimings) > 0:
+                print('\nStages with the largest total wall time (see {0}.tsv in {1}):'.format(COHORT_TIMINGS_FILE,
+                                                                                          args.output_dir))
+                for entry in cohortTimings[:10]:
+                    print('  {0:<24} {1:>10.1f} s over {2} run(s)'.format(entry['node'], entry['total_wall_time_s'],
+                                                                       entry['count']))
 
     if args.analysis_level == "group":
         from readSpecs.readModelSpec import bstrSpec
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+# Checks that the key of the global node cache (workflows/nodeCache.py) only depends on what a node computes, so
+# that an execution can be served to another subject.
+
+import os
+import sys
+import tempfile
+from nipype.interfaces.brainsuite import Bse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from workflows.nodeCache import nodeCache, hashedInputs
+from workflows.runtimeProfile import EVENT_LOG_ENV, EVENT_SUBJECT_ENV
+
+def test_keyIgnoresEventLog():
+    directory = tempfile.mkdtemp()
+    cache = nodeCache(os.path.join(directory, 'cache'))
+    keys = []
+    for subject in ['sub-01', 'sub-02']:
+        anat = os.path.join(directory, subject, 'anat')
+        os.makedirs(anat)
+        t1 = os.path.join(anat, '{0}_T1w.nii.gz'.format(subject))
+        with open(t1, 'wb') as f:
+            f.write(b'same T1')
+        eventLog = os.path.join(directory, subject, 'events.jsonl')
+        with open(eventLog, 'w') as f:
+            f.write('{{"subject": "{0}"}}\n'.format(subject))
+        bse = Bse()
+        bse.inputs.inputMRIFile = t1
+        bse.inputs.environ = {EVENT_LOG_ENV: eventLog, EVENT_SUBJECT_ENV: subject}
+        outputs = [bse._gen_filename(name) for name in ['outputMRIVolume', 'outputMaskFile']]
+        keys.append(cache.key('Bse', bse._cmd, hashedInputs(bse.inputs), outputs))
+    assert keys[0] == keys[1]
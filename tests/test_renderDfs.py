@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+# Checks the surface renderer of the QC thumbnails (QC/renderDfs.py) against a stored reference image of two
+# spheres seen from above (renderdfs --sup): the left one red, the right one green (--use-colors), Lambert shaded
+# with the light at the viewer, on a black background. The reference is the exact (analytic) rendering of the
+# spheres; run this file to write it again.
+
+import os
+import sys
+import zlib
+import struct
+import tempfile
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from QC.renderDfs import renderViews, AMBIENT
+from QC.renderVolslice import writePNG
+
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'renderDfsSpheres.png')
+SIZE = 128
+RADIUS = 20.0
+CENTERS = [(-30.0, 0.0, 0.0), (30.0, 0.0, 0.0)]
+COLORS = [(1, 0, 0), (0, 1, 0)]
+
+def readPNG(filename):
+    '''
+    Reads an 8-bit RGB PNG file without filtered scanlines, as written by writePNG.
+    '''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    offset, idat = 8, b''
+    while offset < len(data):
+        length, tag = struct.unpack('>I4s', data[offset:offset + 8])
+        if tag == b'IHDR':
+            width, height = struct.unpack('>II', data[offset + 8:offset + 16])
+        elif tag == b'IDAT':
+            idat += data[offset + 8:offset + 8 + length]
+        offset += 12 + length
+    rows = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(height, width * 3 + 1)
+    assert not rows[:, 0].any()
+    return rows[:, 1:].reshape(height, width, 3)
+
+def icosphere(center, radius, subdivisions=4):
+    t = (1 + 5 ** 0.5) / 2
+    vertices = [(-1, t, 0), (1, t, 0), (-1, -t, 0), (1, -t, 0), (0, -1, t), (0, 1, t), (0, -1, -t), (0, 1, -t),
+                (t, 0, -1), (t, 0, 1), (-t, 0, -1), (-t, 0, 1)]
+    faces = [(0, 11, 5), (0, 5, 1), (0, 1, 7), (0, 7, 10), (0, 10, 11), (1, 5, 9), (5, 11, 4), (11, 10, 2),
+             (10, 7, 6), (7, 1, 8), (3, 9, 4), (3, 4, 2), (3, 2, 6), (3, 6, 8), (3, 8, 9), (4, 9, 5), (2, 4, 11),
+             (6, 2, 10), (8, 6, 7), (9, 8, 1)]
+    vertices = [np.asarray(v, dtype=np.float64) / np.linalg.norm(v) for v in vertices]
+    for _ in range(subdivisions):
+        midpoints, subdivided = {}, []
+        for face in faces:
+            middle = []
+            for a, b in [(face[0], face[1]), (face[1], face[2]), (face[2], face[0])]:
+                if (b, a) in midpoints:
+                    middle.append(midpoints[(b, a)])
+                    continue
+                v = vertices[a] + vertices[b]
+                vertices.append(v / np.linalg.norm(v))
+                midpoints[(a, b)] = len(vertices) - 1
+                middle.append(len(vertices) - 1)
+            subdivided.extend([(face[0], middle[0], middle[2]), (face[1], middle[1], middle[0]),
+                               (face[2], middle[2], middle[1]), (middle[0], middle[1], middle[2])])
+        faces = subdivided
+    return np.asarray(faces, dtype=np.int32), np.asarray(vertices) * radius + center
+
+def writeDFS(filename, faces, vertices):
+    hdrsize = 184
+    header = struct.pack('<12i', hdrsize, 0, 0, len(faces), len(vertices), 0, 0, 0, 0, 0, 0, 0)
+    with open(filename, 'wb') as f:
+        f.write(b'DFS_LE v2.0\0' + header + b'\0' * (hdrsize - 12 - len(header)))
+        f.write(faces.astype('<i4').tobytes())
+        f.write(vertices.astype('<f4').tobytes())
+
+def analyticSpheres():
+    '''
+    The spheres seen from above at zoom 1: the largest extent of the surfaces (200 mm) fills the image, image
+    right is subject right and image up is anterior.
+    '''
+    extent = CENTERS[1][0] - CENTERS[0][0] + 2 * RADIUS
+    scale = SIZE / extent
+    cols, rows = np.meshgrid(np.arange(SIZE) + 0.5, np.arange(SIZE) + 0.5)
+    x, y = (cols - SIZE / 2.0) / scale, (SIZE / 2.0 - rows) / scale
+    image = np.zeros((SIZE, SIZE, 3))
+    for center, color in zip(CENTERS, COLORS):
+        distance2 = ((x - center[0]) ** 2 + (y - center[1]) ** 2) / RADIUS ** 2
+        inside = distance2 < 1
+        shade = AMBIENT + (1 - AMBIENT) * np.sqrt(1 - distance2[inside])
+        image[inside] = shade[:, None] * np.asarray(color, dtype=np.float64)
+    return (np.clip(image, 0, 1) * 255).astype(np.uint8)
+
+def test_renderDfsMatchesReference():
+    directory = tempfile.mkdtemp()
+    surfaces = []
+    for num, center in enumerate(CENTERS):
+        surfaces.append(os.path.join(directory, 'sphere{0}.dfs'.format(num)))
+        writeDFS(surfaces[-1], *icosphere(center, RADIUS))
+    outFile = os.path.join(directory, 'sup.png')
+    renderViews(surfaces, [{'outFile': outFile, 'view': 'Sup'}], useColors='1 0 0 0 1 0', width=SIZE, height=SIZE)
+    rendered = readPNG(outFile).astype(np.int64)
+    reference = readPNG(REFERENCE).astype(np.int64)
+    assert rendered.shape == reference.shape
+    # same silhouette, up to the pixels along the outline of the spheres
+    silhouette = rendered.sum(axis=2) > 0
+    assert np.mean(silhouette != (reference.sum(axis=2) > 0)) < 0.02
+    # same colors and shading, up to the faceting of the meshes
+    difference = np.abs(rendered - reference).max(axis=2)
+    assert np.mean(difference > 24) < 0.02
+    assert np.median(difference[silhouette]) <= 4
+
+if __name__ == '__main__':
+    writePNG(REFERENCE, analyticSpheres())
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+# Checks the volume renderer of the QC thumbnails (QC/renderVolslice.py) on a small synthetic volume stored in
+# LPS orientation with anisotropic voxels: the views must be reoriented to RAS, take the requested slice, resample
+# to square pixels, read only the first volume of a 4D series, and blend the mask and label colors. The expected
+# images are written out by hand from the RAS voxel values.
+
+import os
+import sys
+import tempfile
+import numpy as np
+import nibabel as nib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from QC.renderVolslice import renderViews
+from test_renderDfs import readPNG
+
+SHAPE = (3, 2, 2)
+# voxel size along x (left-right), y (posterior-anterior) and z (inferior-superior)
+ZOOMS = (1.0, 2.0, 1.0)
+
+def rasVolume():
+    '''
+    Value of the RAS voxel (i, j, k): 10 * (1 + i + 3j + 6k), from 10 (right-posterior-inferior is 30) to 120.
+    '''
+    i, j, k = np.meshgrid(*[np.arange(n) for n in SHAPE], indexing='ij')
+    return 10 * (1 + i + 3 * j + 6 * k)
+
+def saveLPS(filename, data):
+    '''
+    Saves a RAS volume with its first two axes flipped, as an LPS volume.
+    '''
+    affine = np.diag([-ZOOMS[0], -ZOOMS[1], ZOOMS[2], 1.0])
+    nib.save(nib.Nifti1Image(data[::-1, ::-1], affine), filename)
+
+def render(directory, views):
+    for num, view in enumerate(views):
+        view['outFile'] = os.path.join(directory, 'view{0}.png'.format(num))
+        # grey levels are the voxel values
+        view['scaling'] = 255
+    renderViews(views)
+    return [readPNG(view['outFile']) for view in views]
+
+def grey(rows):
+    return np.stack([np.asarray(rows, dtype=np.uint8)] * 3, axis=-1)
+
+def test_renderVolsliceViews():
+    directory = tempfile.mkdtemp()
+    volume = os.path.join(directory, 'dwi.nii.gz')
+    # a 4D series whose second volume must not be shown
+    saveLPS(volume, np.stack([rasVolume(), np.full(SHAPE, 255)], axis=-1).astype(np.int16))
+    axial, coronal, sagittal = render(directory, [{'inFile': volume, 'view': 1},
+                                                  {'inFile': volume, 'view': 2, 'Slice': 0},
+                                                  {'inFile': volume, 'view': 3, 'Slice': 2}])
+    # center axial slice (k = 1): anterior at the top, right to the right, rows doubled by the 2 mm voxels
+    assert np.array_equal(axial, grey([[100, 110, 120], [100, 110, 120], [70, 80, 90], [70, 80, 90]]))
+    # posterior coronal slice (j = 0): superior at the top
+    assert np.array_equal(coronal, grey([[70, 80, 90], [10, 20, 30]]))
+    # rightmost sagittal slice (i = 2): superior at the top, anterior to the right, columns doubled
+    assert np.array_equal(sagittal, grey([[90, 90, 120, 120], [30, 30, 60, 60]]))
+
+def test_renderVolsliceOverlays():
+    directory = tempfile.mkdtemp()
+    volume = os.path.join(directory, 'bfc.nii.gz')
+    saveLPS(volume, rasVolume().astype(np.int16))
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[2, 1, 1] = 1
+    maskFile = os.path.join(directory, 'mask.nii.gz')
+    saveLPS(maskFile, mask)
+    labels = np.zeros(SHAPE, dtype=np.int16)
+    labels[0, 0, 1] = 3
+    labelFile = os.path.join(directory, 'label.nii.gz')
+    saveLPS(labelFile, labels)
+    labelDesc = os.path.join(directory, 'labels.xml')
+    with open(labelDesc, 'w') as f:
+        f.write('<labelset><label id="3" color="0x0000FF" fullname="test"/></labelset>\n')
+    image, = render(directory, [{'inFile': volume, 'view': 1, 'maskFile': maskFile, 'labelFile': labelFile,
+                                 'labelDesc': labelDesc}])
+    expected = grey([[100, 110, 120], [100, 110, 120], [70, 80, 90], [70, 80, 90]])
+    # mask: red at 96/255 over 120 (right-anterior voxel)
+    expected[0:2, 2] = [170, 74, 74]
+    # label 3: its blue at 64/255 over 70 (left-posterior voxel)
+    expected[2:4, 0] = [52, 52, 116]
+    assert np.array_equal(image, expected)
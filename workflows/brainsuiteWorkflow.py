@@ -21,21 +21,30 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 '''
 
 from __future__ import unicode_literals, print_function
-import subprocess
 from nipype import config #Set configuration before importing nipype pipeline
 cfg = dict(execution={'remove_unnecessary_outputs' : False}) #We do not want nipype to remove unnecessary outputs
 config.update_config(cfg)
 import sys
+import networkx as nx
 import nipype.pipeline.engine as pe
 import nipype.interfaces.brainsuite as bs
 from nipype.interfaces.fsl import Eddy, EddyQuad
-import nipype.interfaces.io as io
-from nipype.interfaces.utility import Function, Merge
+from nipype.interfaces.utility import Function
+from nipype.interfaces.base import Undefined, isdefined
 from nipype import Node
 from shutil import copyfile
 import os
 import errno
+import json
+import time
+import hashlib
 from QC.stageNumDict import stageNumDict, stageGroups
+from QC.stateStore import qcStateStore, completed, unqueued, queued
+from workflows.stageManifest import stageManifest
+from workflows.runtimeProfile import writeTimings, enableResourceMonitor, EVENTS_FILE, EVENT_LOG_ENV, EVENT_SUBJECT_ENV
+from workflows.stageTable import CSE_STAGES, SVREG_BDP_STAGES, expand
+from workflows.stateHooks import qcStateHooks
+from workflows.executionPlugin import pluginSettings, setSubmission
 
 BRAINSUITE_VERSION= os.environ['BrainSuiteVersion']
 ATLAS_MRI_SUFFIX = 'brainsuite.icbm452.lpi.v08a.img'
@@ -44,12 +53,22 @@ WORKFLOW_NAME = 'BrainSuite'
 BRAINSUITE_ATLAS_DIRECTORY = "/opt/BrainSuite{0}/atlas/".format(BRAINSUITE_VERSION)
 BRAINSUITE_LABEL_DIRECTORY = "/opt/BrainSuite{0}/labeldesc/".format(BRAINSUITE_VERSION)
 LABEL_SUFFIX = 'brainsuite_labeldescriptions_30March2018.xml'
-completed = 'C'
-launched = 'L'
-unqueued = 'N'
-queued = 'Q'
-errored = 'E'
-QCSTATE = '/BrainSuite/QC/qcState.sh'
+PIPELINES = ['CSE', 'SVREG', 'BDP', 'BFP']
+# parameters that the outputs of each stage group depend on (see resumeStages)
+STAGE_PARAMETERS = {
+    'CSE': ['autoParameters', 'prescale', 'diffusionIterations', 'diffusionConstant', 'edgeDetectionConstant',
+            'iterativeMode', 'spatialPrior', 'costFunction', 'useCentroids', 'linearConvergence',
+            'warpConvergence', 'warpLevel', 'tissueFractionThreshold'],
+    'SVREG': ['atlas', 'smoothsurf', 'smoothvol'],
+    'BDP': ['bdpfiles', 'BVecBValPair', 'fsleddy', 'indexFile', 'acqpFile', 'flm', 'slm', 'fep', 'interp', 'nvoxhp',
+            'fudge_factor', 'dont_sep_offs_move', 'dont_peas', 'niter', 'eddy_final_resamp', 'repol',
+            'is_shelled', 'useDerivatives', 'correctedOutputDir', 'correctedOutputSuffix', 'skipDistortionCorr',
+            'phaseEncodingDirection', 'estimateODF_3DShore', 'estimateODF_GQI', 'estimateODF_ERFO', 'sigma_GQI',
+            'ERFO_SNR', 'echoSpacing', 'fieldmapCorrection', 'diffusion_time_ms'],
+    'SVREG+BDP': ['atlas', 'smoothvol', 'skipDistortionCorr'],
+    'BFP': ['runNSR', 'EnabletNLMPdfFiltering']
+}
+DWI_MEASURES = ['FA', 'MD', 'axial', 'radial', 'mADC', 'FRT_GFA']
 
 class subjLevelProcessing(object):
     """
@@ -106,12 +125,13 @@ class subjLevelProcessing(object):
         self.estimateODF_3DShore = specs.estimateODF_3DShore
         self.estimateODF_GQI = specs.estimateODF_GQI
         self.estimateODF_ERFO = specs.estimateODF_ERFO
-        self.sigma_GQI = specs.sigma_GQI
-        self.ERFO_SNR = specs.ERFO_SNR
+        # parameters that are not set in the specification are left undefined in the BDP node
+        self.sigma_GQI = Undefined if specs.sigma_GQI is None else specs.sigma_GQI
+        self.ERFO_SNR = Undefined if specs.ERFO_SNR is None else specs.ERFO_SNR
 
-        self.echoSpacing = specs.echoSpacing
+        self.echoSpacing = Undefined if specs.echoSpacing is None else specs.echoSpacing
         self.fieldmapCorrection = specs.fieldmapCorrection
-        self.diffusion_time_ms = specs.diffusion_time_ms
+        self.diffusion_time_ms = Undefined if specs.diffusion_time_ms is None else specs.diffusion_time_ms
 
         self.epit1corr = specs.epit1corr
 
@@ -130,6 +150,7 @@ class subjLevelProcessing(object):
         self.smoothsurf = specs.smoothsurf
 
         self.cachedir = specs.cache
+        self.resources = specs.resources
 
         # bfp
         self.runNSR = specs.runnsr
@@ -154,21 +175,148 @@ class subjLevelProcessing(object):
             self.bdpfiles = keyword_parameters['BDP']
             self.BVecBValPair = [keyword_parameters['BVEC'], keyword_parameters['BVAL']]
 
+        # stage groups left out of the workflow because their outputs are complete (see resumeStages)
+        self.completedStages = []
+
+    def expectedOutputs(self, SUBJECT_ID, WORKFLOW_BASE_DIRECTORY, BFP):
+        '''
+        Final output files of each stage group, as recorded in the completion manifest.
+        '''
+        anat = os.path.join(WORKFLOW_BASE_DIRECTORY, 'anat', SUBJECT_ID + '_T1w')
+        dwi = os.path.join(WORKFLOW_BASE_DIRECTORY, 'dwi', SUBJECT_ID + '_dwi')
+        func = os.path.join(WORKFLOW_BASE_DIRECTORY, 'func')
+        atlasThickness = os.path.join(WORKFLOW_BASE_DIRECTORY, 'anat', 'atlas.pvc-thickness_0-6mm')
+        distcorr = "correct."
+        if self.skipDistortionCorr:
+            distcorr = ""
+
+        cseSuffixes = ['.mask.nii.gz', '.bfc.nii.gz', '.pvc.label.nii.gz', '.pvc.frac.nii.gz',
+                       '.cerebrum.mask.nii.gz', '.hemi.label.nii.gz', '.init.cortex.mask.nii.gz',
+                       '.cortex.scrubbed.mask.nii.gz', '.cortex.tca.mask.nii.gz', '.cortex.dewisp.mask.nii.gz',
+                       '.inner.cortex.dfs', '.pial.cortex.dfs', '.left.inner.cortex.dfs', '.right.inner.cortex.dfs',
+                       '.left.pial.cortex.dfs', '.right.pial.cortex.dfs',
+                       '.pvc-thickness_0-6mm.left.mid.cortex.dfs', '.pvc-thickness_0-6mm.right.mid.cortex.dfs']
+        if 'noBSE' not in self.stages:
+            cseSuffixes.append('.bse.nii.gz')
+        svregSuffixes = ['.svreg.label.nii.gz', '.svreg.inv.jacobian.nii.gz', '.svreg.inv.map.nii.gz',
+                         '.left.mid.cortex.svreg.dfs', '.right.mid.cortex.svreg.dfs',
+                         '.svreg.inv.jacobian.smooth{0}mm.nii.gz'.format(str(self.smoothvol))]
+
+        outputs = {
+            'CSE': [anat + suffix for suffix in cseSuffixes],
+            'SVREG': [anat + suffix for suffix in svregSuffixes] +
+                     [atlasThickness + '.{0}.mid.cortex.dfs'.format(hemi) for hemi in ['left', 'right']] +
+                     [atlasThickness + '.smooth{0}mm.{1}.mid.cortex.dfs'.format(str(self.smoothsurf), hemi)
+                      for hemi in ['left', 'right']],
+            'BDP': [dwi + '.tensor.T1_coord.bst', dwi + '.dwi.RAS.{0}FA.color.T1_coord.nii.gz'.format(distcorr)] +
+                   [dwi + '.dwi.RAS.{0}{1}.T1_coord.nii.gz'.format(distcorr, measure) for measure in DWI_MEASURES],
+            'SVREG+BDP': [dwi + '.dwi.RAS.{0}atlas.{1}.nii.gz'.format(distcorr, measure) for measure in DWI_MEASURES] +
+                         [dwi + '.dwi.RAS.{0}atlas.{1}.smooth{2}mm.nii.gz'.format(distcorr, measure, str(self.smoothvol))
+                          for measure in DWI_MEASURES],
+            'BFP': []
+        }
+        BFPoutput = '.32k.GOrd.filt.mat'
+        if not self.EnabletNLMPdfFiltering:
+            BFPoutput = '.32k.GOrd.mat'
+        for sess in BFP.get('sess', []):
+            prefix = os.path.join(func, BFP['subjID'] + '_' + sess + '_bold')
+            outputs['BFP'].extend([prefix + BFPoutput, prefix + '.example.func2t1.nii.gz'])
+        return outputs
+
+    def stageParameters(self, stageGroup, BFP):
+        '''
+        Digest of the parameters that the outputs of a stage group depend on.
+        '''
+        parameters = [getattr(self, name, None) for name in STAGE_PARAMETERS[stageGroup]]
+        if stageGroup == 'CSE':
+            parameters.append('noBSE' in self.stages)
+        if stageGroup == 'BFP':
+            parameters.append(BFP.get('TR'))
+            if BFP.get('configini') and os.path.exists(BFP['configini']):
+                with open(BFP['configini'], 'r') as f:
+                    parameters.append(f.read())
+        return hashlib.sha1(json.dumps(parameters, default=str).encode('utf-8')).hexdigest()
+
+    def resumeStages(self, SUBJECT_ID, WORKFLOW_BASE_DIRECTORY, BFP):
+        '''
+        Leaves the stage groups whose outputs already match the completion manifest out of the workflow.
+        If only one of SVREG and BDP is complete, the SVREG+BDP stages still run, reading the outputs of
+        the completed group from disk.
+        '''
+        manifest = stageManifest(WORKFLOW_BASE_DIRECTORY)
+        expected = self.expectedOutputs(SUBJECT_ID, WORKFLOW_BASE_DIRECTORY, BFP)
+        complete = [stageGroup for stageGroup in PIPELINES if stageGroup in self.stages and
+                    manifest.isComplete(stageGroup, expected[stageGroup], self.stageParameters(stageGroup, BFP))]
+        if 'SVREG' in self.stages and 'BDP' in self.stages:
+            pairComplete = manifest.isComplete('SVREG+BDP', expected['SVREG+BDP'],
+                                               self.stageParameters('SVREG+BDP', BFP))
+            if 'SVREG' in complete and 'BDP' in complete and pairComplete:
+                complete.append('SVREG+BDP')
+            elif 'SVREG' in complete or 'BDP' in complete:
+                self.stages.append('SVREG+BDP')
+        for stageGroup in complete:
+            if stageGroup in self.stages:
+                self.stages.remove(stageGroup)
+            self.completedStages.append(stageGroup)
+        if len(complete) > 0:
+            print('Outputs of {0} are complete for {1}; these stages will not be run again.'.format(
+                ', '.join(complete), SUBJECT_ID))
+
+    def recordStages(self, erroredStages):
+        '''
+        Adds the stage groups that ran without errors to the completion manifest.
+        '''
+        manifest = stageManifest(self.workflowBaseDirectory)
+        expected = self.expectedOutputs(self.subjectID, self.workflowBaseDirectory, self.BFP)
+        ranStages = [stageGroup for stageGroup in PIPELINES + ['SVREG+BDP'] if stageGroup in self.stages]
+        if 'SVREG' in self.stages and 'BDP' in self.stages and 'SVREG+BDP' not in ranStages:
+            ranStages.append('SVREG+BDP')
+        for stageGroup in ranStages:
+            if any([step in erroredStages for step in stageGroups[stageGroup]]):
+                manifest.invalidate(stageGroup)
+            else:
+                manifest.record(stageGroup, expected[stageGroup], self.stageParameters(stageGroup, self.BFP))
+
     def runWorkflow(self, SUBJECT_ID, INPUT_MRI_FILE, WORKFLOW_BASE_DIRECTORY, BFP):
+        brainsuite_workflow = self.buildWorkflow(SUBJECT_ID, INPUT_MRI_FILE, WORKFLOW_BASE_DIRECTORY, BFP)
+        hooks = qcStateHooks()
+        self.registerHooks(hooks, brainsuite_workflow)
+        plugin, plugin_args = pluginSettings(hooks)
+        enableResourceMonitor()
+        try:
+            brainsuite_workflow.run(plugin=plugin, plugin_args=plugin_args, updatehash=False)
+            # brainsuite_workflow.write_graph()
+        finally:
+            # also when a node raised and nipype reports that the workflow did not execute cleanly
+            self.updateStates(hooks.executedNodes(brainsuite_workflow.name),
+                              hooks.failedStages(brainsuite_workflow.name))
+
+    def buildWorkflow(self, SUBJECT_ID, INPUT_MRI_FILE, WORKFLOW_BASE_DIRECTORY, BFP, workflowName=WORKFLOW_NAME):
+        '''
+        Builds (without running) the nipype workflow of a single subject. The workflow can either be run
+        on its own (runWorkflow) or be nested in a cohort-level workflow (see workflows/runWorkflow.py).
+        '''
+        buildStart = time.time()
         STAGES = self.stages
         anat = WORKFLOW_BASE_DIRECTORY + '/anat/'
         dwi = WORKFLOW_BASE_DIRECTORY + '/dwi/'
         func = WORKFLOW_BASE_DIRECTORY + '/func/'
-        brainsuite_workflow = pe.Workflow(name=WORKFLOW_NAME)
+        brainsuite_workflow = pe.Workflow(name=workflowName)
         CACHE_DIRECTORY = self.cachedir
         if self.specs.read_file:
             CACHE_DIRECTORY = self.cachedir + '/' + SUBJECT_ID
             if not os.path.exists(CACHE_DIRECTORY):
                 os.makedirs(CACHE_DIRECTORY)
         brainsuite_workflow.base_dir = CACHE_DIRECTORY
-        brainsuite_workflow.config['execution']['crashdump_dir'] = CACHE_DIRECTORY + '/' + WORKFLOW_NAME
+        brainsuite_workflow.config['execution']['crashdump_dir'] = CACHE_DIRECTORY + '/' + workflowName
         brainsuite_workflow.config['execution']['crashfile_format'] = 'txt'
 
+        self.subjectID = SUBJECT_ID
+        self.workflowBaseDirectory = WORKFLOW_BASE_DIRECTORY
+        self.BFP = BFP
+        statesDir = None
+        WEBPATH = None
+
         if 'QC' in self.stages:
             # create web directory for status codes
             WEBPATH = os.path.join(self.QCdir, SUBJECT_ID)
@@ -180,40 +328,40 @@ class subjLevelProcessing(object):
                 os.makedirs(statesDir)
             # initialize status codes
             # If previously run status codes don't exist, first initialize as unqueued
-            for _, num in stageNumDict.items():
-                if not os.path.exists(os.path.join(statesDir, 'stage-{0}.state'.format(num))):
-                    cmd = [QCSTATE, statesDir, str(num), unqueued]
-                    subprocess.call(' '.join(cmd), shell=True)
+            stateStore = qcStateStore(statesDir)
+            stateStore.update(dict((num, unqueued) for num in stageNumDict.values()), initial=True)
+            states = {}
             # Change status codes to 'queued' based on user settings
-            pipelines = ['CSE', 'SVREG', 'BDP', 'BFP']
-            PROC_STAGES = [ stage for stage in pipelines if stage in STAGES ]
+            PROC_STAGES = [ stage for stage in PIPELINES if stage in STAGES ]
+            if ('SVREG' in STAGES and 'BDP' in STAGES) or 'SVREG+BDP' in STAGES:
+                PROC_STAGES.append('SVREG+BDP')
             for STAGE in PROC_STAGES:
                 for step in stageGroups[STAGE]:
-                    cmd = [QCSTATE, statesDir, str(stageNumDict[step]), queued]
-                    subprocess.call(' '.join(cmd), shell=True)
-            if 'SVREG' in STAGES and 'BDP' in STAGES:
-                for step in stageGroups['SVREG+BDP']:
-                    cmd = [QCSTATE, statesDir, str(stageNumDict[step]), queued]
-                    subprocess.call(' '.join(cmd), shell=True)
+                    states[stageNumDict[step]] = queued
+            # Stages skipped on resume are complete
+            for STAGE in self.completedStages:
+                for step in stageGroups[STAGE]:
+                    states[stageNumDict[step]] = completed
             # Then unqueue based on user selection
             if 'noBSE' in STAGES:
-                cmd = [QCSTATE, statesDir, str(stageNumDict['BSE']), unqueued]
-                subprocess.call(' '.join(cmd), shell=True)
+                states[stageNumDict['BSE']] = unqueued
             if not self.fsleddy:
                 for step in stageGroups['FSLEDDY']:
-                    cmd = [QCSTATE, statesDir, str(stageNumDict[step]), unqueued]
-                    subprocess.call(' '.join(cmd), shell=True)
-
-            stagesRun = {}
-
-            qcstateInitObj = pe.Node(interface=bs.QCState(), name='qcstateInitObj')
-            qcstateInitObj.inputs.prefix = statesDir
-            qcstateInitObj.inputs.state = launched
+                    states[stageNumDict[step]] = unqueued
+            stateStore.update(states)
 
         t1 = os.path.basename(INPUT_MRI_FILE)
 
         labeldesc = BRAINSUITE_LABEL_DIRECTORY + LABEL_SUFFIX
         smoothVolStd = '{0} {0} {0}'.format(self.smoothvol)
+        # values the strings of the stage tables are formatted with
+        context = {'subject': SUBJECT_ID, 't1': t1, 'anat': anat, 'dwi': dwi, 'webpath': WEBPATH,
+                   'labeldesc': labeldesc, 'smoothvol': self.smoothvol, 'smoothVolStd': smoothVolStd,
+                   'atlasMRI': BRAINSUITE_ATLAS_DIRECTORY + ATLAS_MRI_SUFFIX,
+                   'atlasLabel': BRAINSUITE_ATLAS_DIRECTORY + ATLAS_LABEL_SUFFIX}
+        # nodes of the workflow by name, and the stage of each stage node (its QC state is recorded by qcStateHooks)
+        nodes = {}
+        stageNodes = {}
 
         ### *--- Copy over T1w file ---* ###
         if 'CSE' in STAGES:
@@ -227,378 +375,11 @@ class subjLevelProcessing(object):
                 else:
                     raise
 
-            # ====CSE Inputs and Parameters====
-            bseObj = pe.Node(interface=bs.Bse(), name='BSE')
-            bseObj.inputs.inputMRIFile = os.path.join(anat, t1)
-            bseObj.inputs.diffusionIterations = self.diffusionIterations
-            bseObj.inputs.diffusionConstant = self.diffusionConstant  # -d
-            bseObj.inputs.edgeDetectionConstant = self.edgeDetectionConstant  # -s
-            bseObj.inputs.autoParameters = self.autoParameters
-            bseObj.inputs.prescale = self.prescale
-
-            bfcObj = pe.Node(interface=bs.Bfc(), name='BFC')
-            pvcObj = pe.Node(interface=bs.Pvc(), name='PVC')
-            cerebroObj = pe.Node(interface=bs.Cerebro(), name='CEREBRO')
-            cortexObj = pe.Node(interface=bs.Cortex(), name='CORTEX')
-            scrubmaskObj = pe.Node(interface=bs.Scrubmask(), name='SCRUBMASK')
-            tcaObj = pe.Node(interface=bs.Tca(), name='TCA')
-            dewispObj = pe.Node(interface=bs.Dewisp(), name='DEWISP')
-            dfsObj = pe.Node(interface=bs.Dfs(), name='DFS')
-            pialmeshObj = pe.Node(interface=bs.Pialmesh(), name='PIALMESH')
-            hemisplitObj = pe.Node(interface=bs.Hemisplit(), name='HEMISPLIT')
-
-            bfcObj.inputs.iterativeMode = self.iterativeMode
-            cerebroObj.inputs.inputAtlasMRIFile = (BRAINSUITE_ATLAS_DIRECTORY + ATLAS_MRI_SUFFIX)
-            cerebroObj.inputs.inputAtlasLabelFile = (BRAINSUITE_ATLAS_DIRECTORY + ATLAS_LABEL_SUFFIX)
-            pvcObj.inputs.spatialPrior = self.spatialPrior
-            cerebroObj.inputs.useCentroids = self.useCentroids
-            cerebroObj.inputs.costFunction = self.costFunction
-            cerebroObj.inputs.linearConvergence = self.linearConvergence
-            cerebroObj.inputs.warpConvergence = self.warpConvergence
-            cerebroObj.inputs.warpLevel = self.warpLevel
-            cerebroObj.inputs.inputBrainMaskFile = os.path.join(anat, SUBJECT_ID + '_T1w.mask.nii.gz')
-            cortexObj.inputs.tissueFractionThreshold = self.tissueFractionThreshold
-            pialmeshObj.inputs.tissueThreshold = 1.05
-            tcaObj.inputs.minCorrectionSize = 2500
-            tcaObj.inputs.foregroundDelta = 20
-
-            # ====Connect====
-            if 'noBSE' not in STAGES:
-                brainsuite_workflow.connect(bseObj, 'outputMRIVolume', bfcObj, 'inputMRIFile')
-            elif 'noBSE' in STAGES:
-                bfcObj.inputs.inputMRIFile = os.path.join(anat, SUBJECT_ID + '_T1w.bse.nii.gz')
-
-            brainsuite_workflow.connect(bfcObj, 'outputMRIVolume', pvcObj, 'inputMRIFile')
-            brainsuite_workflow.connect(pvcObj, 'outputTissueFractionFile', cortexObj, 'inputTissueFractionFile')
-
-            brainsuite_workflow.connect(bfcObj, 'outputMRIVolume', cerebroObj, 'inputMRIFile')
-            brainsuite_workflow.connect(cerebroObj, 'outputLabelVolumeFile', cortexObj, 'inputHemisphereLabelFile')
-
-            brainsuite_workflow.connect(cortexObj, 'outputCerebrumMask', scrubmaskObj, 'inputMaskFile')
-            brainsuite_workflow.connect(scrubmaskObj, 'outputMaskFile', tcaObj, 'inputMaskFile')
-            brainsuite_workflow.connect(tcaObj, 'outputMaskFile', dewispObj, 'inputMaskFile')
-            brainsuite_workflow.connect(dewispObj, 'outputMaskFile', dfsObj, 'inputVolumeFile')
-            brainsuite_workflow.connect(dfsObj, 'outputSurfaceFile', pialmeshObj, 'inputSurfaceFile')
-
-            brainsuite_workflow.connect(pvcObj, 'outputTissueFractionFile', pialmeshObj, 'inputTissueFractionFile')
-            brainsuite_workflow.connect(cerebroObj, 'outputCerebrumMaskFile', pialmeshObj, 'inputMaskFile')
-            brainsuite_workflow.connect(pialmeshObj, 'outputSurfaceFile', hemisplitObj, 'pialSurfaceFile')
-
-            brainsuite_workflow.connect(dfsObj, 'outputSurfaceFile', hemisplitObj, 'inputSurfaceFile')
-            brainsuite_workflow.connect(cerebroObj, 'outputLabelVolumeFile', hemisplitObj, 'inputHemisphereLabelFile')
-
-            ds = pe.Node(io.DataSink(), name='HemiSplitDataSink')
-            ds.inputs.base_directory = anat
-
-            thickPVCObj = pe.Node(interface=bs.ThicknessPVC(), name='ThickPVC')
-            thickPVCInputBase = anat + os.sep + SUBJECT_ID + '_T1w'
-            thickPVCObj.inputs.subjectFilePrefix = thickPVCInputBase
-
-            brainsuite_workflow.connect(hemisplitObj, 'outputRightPialHemisphere', ds, '@')
-            brainsuite_workflow.connect(hemisplitObj, 'outputLeftPialHemisphere', ds, '@1')
-            brainsuite_workflow.connect(ds, 'out_file', thickPVCObj, 'dataSinkDelay')
-
-            if 'QC' in STAGES:
-                origT1 = os.path.join(anat, t1)
-                bfc = os.path.join(anat, SUBJECT_ID + '_T1w.bfc.nii.gz')
-                pvclabel = os.path.join(anat, SUBJECT_ID + '_T1w.pvc.label.nii.gz')
-                cerebro = os.path.join(anat, SUBJECT_ID + '_T1w.cerebrum.mask.nii.gz')
-                hemilabel = os.path.join(anat, SUBJECT_ID + '_T1w.hemi.label.nii.gz')
-                dewisp = os.path.join(anat, SUBJECT_ID + '_T1w.cortex.dewisp.mask.nii.gz')
-                dfs = os.path.join(anat, SUBJECT_ID + '_T1w.inner.cortex.dfs')
-                Thickdfs = anat + os.sep + SUBJECT_ID + '_T1w.pvc-thickness_0-6mm.left.mid.cortex.dfs ' + \
-                           anat + os.sep + SUBJECT_ID + '_T1w.pvc-thickness_0-6mm.right.mid.cortex.dfs'
-                pialmesh = os.path.join(anat, SUBJECT_ID + '_T1w.pial.cortex.dfs')
-                hemisplit = anat + os.sep + SUBJECT_ID + '_T1w.left.pial.cortex.dfs ' + \
-                           anat + os.sep + SUBJECT_ID + '_T1w.right.pial.cortex.dfs'
-
-                if 'noBSE' not in STAGES:
-                    volbendbseObj = pe.Node(interface=bs.Volslice(), name='volblendbse')
-                    volbendbseObj.inputs.inFile = origT1
-                    volbendbseObj.inputs.outFile = '{0}/bse.png'.format(WEBPATH)
-                    volbendbseObj.inputs.view = 3 # sagittal
-
-                volbendbfcObj = pe.Node(interface=bs.Volslice(), name='volblendbfc')
-                volbendbfcObj.inputs.inFile = bfc
-                volbendbfcObj.inputs.outFile = '{0}/bfc.png'.format(WEBPATH)
-                volbendbfcObj.inputs.view = 1
-
-                volbendpvcObj = pe.Node(interface=bs.Volslice(), name='volblendpvc')
-                volbendpvcObj.inputs.inFile = bfc
-                volbendpvcObj.inputs.outFile = '{0}/pvc.png'.format(WEBPATH)
-                volbendpvcObj.inputs.labelDesc = labeldesc
-                volbendpvcObj.inputs.view = 1 # axial
-
-                volbendHemilabelObj = pe.Node(interface=bs.Volslice(), name='volblendHemilabel')
-                volbendHemilabelObj.inputs.inFile = origT1
-                volbendHemilabelObj.inputs.outFile = '{0}/hemilabel.png'.format(WEBPATH)
-                volbendHemilabelObj.inputs.labelDesc = labeldesc
-                volbendHemilabelObj.inputs.view = 2
-
-                volbendcerebroObj = pe.Node(interface=bs.Volslice(), name='volblendcerebro')
-                volbendcerebroObj.inputs.inFile = origT1
-                volbendcerebroObj.inputs.outFile = '{0}/cerebro.png'.format(WEBPATH)
-                volbendcerebroObj.inputs.maskFile = cerebro
-                volbendcerebroObj.inputs.view = 3
-
-                volbenddewispObj = pe.Node(interface=bs.Volslice(), name='volblenddewisp')
-                volbenddewispObj.inputs.inFile = bfc
-                volbenddewispObj.inputs.outFile = '{0}/dewisp.png'.format(WEBPATH)
-                volbenddewispObj.inputs.view = 1
-
-                volbenddewispCorObj = pe.Node(interface=bs.Volslice(), name='volblenddewispCor')
-                volbenddewispCorObj.inputs.inFile = bfc
-                volbenddewispCorObj.inputs.outFile = '{0}/dewispCor.png'.format(WEBPATH)
-                volbenddewispCorObj.inputs.view = 2
-
-                dfsrenderdfsLeftObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderdfsLeft')
-                dfsrenderdfsLeftObj.inputs.Surfaces = dfs
-                dfsrenderdfsLeftObj.inputs.OutFile = '{0}/dfsLeft.png'.format(WEBPATH)
-                dfsrenderdfsLeftObj.inputs.Left = True
-                dfsrenderdfsLeftObj.inputs.Zoom = 0.6
-                dfsrenderdfsLeftObj.inputs.CenterVol = bfc
-
-                dfsrenderdfsRightObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderdfsRight')
-                dfsrenderdfsRightObj.inputs.Surfaces = dfs
-                dfsrenderdfsRightObj.inputs.OutFile = '{0}/dfsRight.png'.format(WEBPATH)
-                dfsrenderdfsRightObj.inputs.Right = True
-                dfsrenderdfsRightObj.inputs.Zoom = 0.6
-                dfsrenderdfsRightObj.inputs.CenterVol = bfc
-
-                dfsrenderdfsSupObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderdfsSup')
-                dfsrenderdfsSupObj.inputs.Surfaces = dfs
-                dfsrenderdfsSupObj.inputs.OutFile = '{0}/dfsSup.png'.format(WEBPATH)
-                dfsrenderdfsSupObj.inputs.Sup = True
-                dfsrenderdfsSupObj.inputs.Zoom = 0.6
-                dfsrenderdfsSupObj.inputs.CenterVol = bfc
-
-                dfsrenderdfsInfObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderdfsInf')
-                dfsrenderdfsInfObj.inputs.Surfaces = dfs
-                dfsrenderdfsInfObj.inputs.OutFile = '{0}/dfsInf.png'.format(WEBPATH)
-                dfsrenderdfsInfObj.inputs.Inf = True
-                dfsrenderdfsInfObj.inputs.Zoom = 0.6
-                dfsrenderdfsInfObj.inputs.CenterVol = bfc
-
-                dfsrenderhemisplitObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderhemisplit')
-                dfsrenderhemisplitObj.inputs.Surfaces = hemisplit
-                dfsrenderhemisplitObj.inputs.OutFile = '{0}/hemisplit.png'.format(WEBPATH)
-                dfsrenderhemisplitObj.inputs.Sup = True
-                dfsrenderhemisplitObj.inputs.Zoom = 0.6
-                dfsrenderhemisplitObj.inputs.CenterVol = bfc
-                dfsrenderhemisplitObj.inputs.UseColors = '0 0.5 0.75 1 0.5 0.25'
-
-                dfsrenderThickLeftObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderThickLeft')
-                dfsrenderThickLeftObj.inputs.Surfaces = Thickdfs
-                dfsrenderThickLeftObj.inputs.OutFile = '{0}/ThickdfsLeft.png'.format(WEBPATH)
-                dfsrenderThickLeftObj.inputs.Left = True
-                dfsrenderThickLeftObj.inputs.Zoom = 0.6
-                dfsrenderThickLeftObj.inputs.CenterVol = bfc
-
-                dfsrenderThickRightObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderThickRight')
-                dfsrenderThickRightObj.inputs.Surfaces = Thickdfs
-                dfsrenderThickRightObj.inputs.OutFile = '{0}/ThickdfsRight.png'.format(WEBPATH)
-                dfsrenderThickRightObj.inputs.Right = True
-                dfsrenderThickRightObj.inputs.Zoom = 0.6
-                dfsrenderThickRightObj.inputs.CenterVol = bfc
-
-                dfsrenderThickSupObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderThickSup')
-                dfsrenderThickSupObj.inputs.Surfaces = Thickdfs
-                dfsrenderThickSupObj.inputs.OutFile = '{0}/ThickdfsSup.png'.format(WEBPATH)
-                dfsrenderThickSupObj.inputs.Sup = True
-                dfsrenderThickSupObj.inputs.Zoom = 0.6
-                dfsrenderThickSupObj.inputs.CenterVol = bfc
-
-                dfsrenderThickInfObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderThickInf')
-                dfsrenderThickInfObj.inputs.Surfaces = Thickdfs
-                dfsrenderThickInfObj.inputs.OutFile = '{0}/ThickdfsInf.png'.format(WEBPATH)
-                dfsrenderThickInfObj.inputs.Inf = True
-                dfsrenderThickInfObj.inputs.Zoom = 0.6
-                dfsrenderThickInfObj.inputs.CenterVol = bfc
-
-                qcpvcLaunch = pe.Node(interface=bs.QCState(), name='qcpvcLaunch')
-                qcpvcLaunch.inputs.prefix = statesDir
-                qcpvcLaunch.inputs.stagenum = stageNumDict['PVC']
-                qcpvcLaunch.inputs.state = launched
-                brainsuite_workflow.connect(bfcObj, 'outputMRIVolume', qcpvcLaunch, 'Run')
-                qccerebroLaunch = pe.Node(interface=bs.QCState(), name='qccerebroLaunch')
-                qccerebroLaunch.inputs.prefix = statesDir
-                qccerebroLaunch.inputs.stagenum = stageNumDict['CEREBRO']
-                qccerebroLaunch.inputs.state = launched
-                brainsuite_workflow.connect(pvcObj, 'outputLabelFile', qccerebroLaunch, 'Run')
-                qccortexLaunch = pe.Node(interface=bs.QCState(), name='qccortexLaunch')
-                qccortexLaunch.inputs.prefix = statesDir
-                qccortexLaunch.inputs.stagenum = stageNumDict['CORTEX']
-                qccortexLaunch.inputs.state = launched
-                brainsuite_workflow.connect(cerebroObj, 'outputCerebrumMaskFile', qccortexLaunch, 'Run')
-                qcscrubmaskLaunch = pe.Node(interface=bs.QCState(), name='qcscrubmaskLaunch')
-                qcscrubmaskLaunch.inputs.prefix = statesDir
-                qcscrubmaskLaunch.inputs.stagenum = stageNumDict['SCRUBMASK']
-                qcscrubmaskLaunch.inputs.state = launched
-                brainsuite_workflow.connect(cortexObj, 'outputCerebrumMask', qcscrubmaskLaunch, 'Run')
-                qctcaLaunch = pe.Node(interface=bs.QCState(), name='qctcaLaunch')
-                qctcaLaunch.inputs.prefix = statesDir
-                qctcaLaunch.inputs.stagenum = stageNumDict['TCA']
-                qctcaLaunch.inputs.state = launched
-                brainsuite_workflow.connect(scrubmaskObj, 'outputMaskFile', qctcaLaunch, 'Run')
-                qcdewispLaunch = pe.Node(interface=bs.QCState(), name='qcdewispLaunch')
-                qcdewispLaunch.inputs.prefix = statesDir
-                qcdewispLaunch.inputs.stagenum = stageNumDict['DEWISP']
-                qcdewispLaunch.inputs.state = launched
-                brainsuite_workflow.connect(tcaObj, 'outputMaskFile', qcdewispLaunch, 'Run')
-                qcdfsLaunch = pe.Node(interface=bs.QCState(), name='qcdfsLaunch')
-                qcdfsLaunch.inputs.prefix = statesDir
-                qcdfsLaunch.inputs.stagenum = stageNumDict['DFS']
-                qcdfsLaunch.inputs.state = launched
-                brainsuite_workflow.connect(dewispObj, 'outputMaskFile', qcdfsLaunch, 'Run')
-                qcpialmeshLaunch = pe.Node(interface=bs.QCState(), name='qcpialmeshLaunch')
-                qcpialmeshLaunch.inputs.prefix = statesDir
-                qcpialmeshLaunch.inputs.stagenum = stageNumDict['PIALMESH']
-                qcpialmeshLaunch.inputs.state = launched
-                brainsuite_workflow.connect(dfsObj, 'outputSurfaceFile', qcpialmeshLaunch, 'Run')
-                qchemisplitLaunch = pe.Node(interface=bs.QCState(), name='qchemisplitLaunch')
-                qchemisplitLaunch.inputs.prefix = statesDir
-                qchemisplitLaunch.inputs.stagenum = stageNumDict['HEMISPLIT']
-                qchemisplitLaunch.inputs.state = launched
-                brainsuite_workflow.connect(pialmeshObj, 'outputSurfaceFile', qchemisplitLaunch, 'Run')
-
-                qcstatevolbendbseObj = pe.Node(interface=bs.QCState(), name='qcstatevolbendbseObj')
-                qcstatevolbendbseObj.inputs.prefix = statesDir
-                qcstatevolbendbseObj.inputs.stagenum = stageNumDict['BSE']
-                qcstatevolbendbseObj.inputs.state = completed
-
-                qcstatevolbendbfcObj = pe.Node(interface=bs.QCState(), name='qcstatevolbendbfcObj')
-                qcstatevolbendbfcObj.inputs.prefix = statesDir
-                qcstatevolbendbfcObj.inputs.stagenum = stageNumDict['BFC']
-                qcstatevolbendbfcObj.inputs.state = completed
-
-                qcstatevolbendpvcObj = pe.Node(interface=bs.QCState(), name='qcstatevolbendpvcObj')
-                qcstatevolbendpvcObj.inputs.prefix = statesDir
-                qcstatevolbendpvcObj.inputs.stagenum = stageNumDict['PVC']
-                qcstatevolbendpvcObj.inputs.state = completed
-
-                qcstatevolbendcerebroObj = pe.Node(interface=bs.QCState(), name='qcstatevolbendcerebroObj')
-                qcstatevolbendcerebroObj.inputs.prefix = statesDir
-                qcstatevolbendcerebroObj.inputs.stagenum= stageNumDict['CEREBRO']
-                qcstatevolbendcerebroObj.inputs.state = completed
-
-                qcstatevolbendcortexObj = pe.Node(interface=bs.QCState(), name='qcstatevolbendcortexObj')
-                qcstatevolbendcortexObj.inputs.prefix = statesDir
-                qcstatevolbendcortexObj.inputs.stagenum = stageNumDict['CORTEX']
-                qcstatevolbendcortexObj.inputs.state = completed
-
-                qcstatevolbendscrubmaskObj = pe.Node(interface=bs.QCState(), name='qcstatevolbendscrubmaskObj')
-                qcstatevolbendscrubmaskObj.inputs.prefix = statesDir
-                qcstatevolbendscrubmaskObj.inputs.stagenum = stageNumDict['SCRUBMASK']
-                qcstatevolbendscrubmaskObj.inputs.state = completed
-
-                qcstatevolbendtcaObj = pe.Node(interface=bs.QCState(), name='qcstatevolbendtcaObj')
-                qcstatevolbendtcaObj.inputs.prefix = statesDir
-                qcstatevolbendtcaObj.inputs.stagenum = stageNumDict['TCA']
-                qcstatevolbendtcaObj.inputs.state = completed
-
-                qcstatevolbenddewispObj = pe.Node(interface=bs.QCState(), name='qcstatevolbenddewispObj')
-                qcstatevolbenddewispObj.inputs.prefix = statesDir
-                qcstatevolbenddewispObj.inputs.stagenum = stageNumDict['DEWISP']
-                qcstatevolbenddewispObj.inputs.state = completed
-
-                qcstatedfsrenderdfsObj = pe.Node(interface=bs.QCState(), name='qcstatedfsrenderdfsObj')
-                qcstatedfsrenderdfsObj.inputs.prefix = statesDir
-                qcstatedfsrenderdfsObj.inputs.stagenum= stageNumDict['DFS']
-                qcstatedfsrenderdfsObj.inputs.state = completed
-
-                qcstatedfsrenderpialmeshObj = pe.Node(interface=bs.QCState(), name='qcstatedfsrenderpialmeshObj')
-                qcstatedfsrenderpialmeshObj.inputs.prefix = statesDir
-                qcstatedfsrenderpialmeshObj.inputs.stagenum = stageNumDict['PIALMESH']
-                qcstatedfsrenderpialmeshObj.inputs.state = completed
-
-                qcstatedfsrenderhemisplitObj = pe.Node(interface=bs.QCState(), name='qcstatedfsrenderhemisplitObj')
-                qcstatedfsrenderhemisplitObj.inputs.prefix = statesDir
-                qcstatedfsrenderhemisplitObj.inputs.stagenum = stageNumDict['HEMISPLIT']
-                qcstatedfsrenderhemisplitObj.inputs.state = completed
-
-                # Connect QC nodes
-                if 'noBSE' not in STAGES:
-                    brainsuite_workflow.connect(bseObj, 'outputMaskFile', volbendbseObj, 'maskFile')
-                    qcbfcLaunch = pe.Node(interface=bs.QCState(), name='qcbfcLaunch')
-                    qcbfcLaunch.inputs.prefix = statesDir
-                    qcbfcLaunch.inputs.stagenum = stageNumDict['BFC']
-                    qcbfcLaunch.inputs.state = launched
-                    brainsuite_workflow.connect(bseObj, 'outputMRIVolume', qcbfcLaunch, 'Run')
-
-
-                brainsuite_workflow.connect(bfcObj, 'outputMRIVolume', volbendbfcObj, 'inFile')
-                brainsuite_workflow.connect(pvcObj, 'outputLabelFile', volbendpvcObj, 'labelFile')
-                brainsuite_workflow.connect(cerebroObj, 'outputCerebrumMaskFile', volbendcerebroObj, 'maskFile')
-                brainsuite_workflow.connect(cerebroObj, 'outputLabelVolumeFile', volbendHemilabelObj, 'labelFile')
-                brainsuite_workflow.connect(dewispObj, 'outputMaskFile', volbenddewispObj, 'maskFile')
-                brainsuite_workflow.connect(dewispObj, 'outputMaskFile', volbenddewispCorObj, 'maskFile')
-                brainsuite_workflow.connect(dfsObj, 'outputSurfaceFile', dfsrenderdfsLeftObj, 'Surfaces')
-                brainsuite_workflow.connect(dfsObj, 'outputSurfaceFile', dfsrenderdfsRightObj, 'Surfaces')
-                brainsuite_workflow.connect(dfsObj, 'outputSurfaceFile', dfsrenderdfsSupObj, 'Surfaces')
-                brainsuite_workflow.connect(dfsObj, 'outputSurfaceFile', dfsrenderdfsInfObj, 'Surfaces')
-                brainsuite_workflow.connect(ds, 'out_file', dfsrenderhemisplitObj, 'Surfbilateral')
-
-                qcthickPVCLaunch = pe.Node(interface=bs.QCState(), name='qcthickPVCLaunch')
-                qcthickPVCLaunch.inputs.prefix = statesDir
-                qcthickPVCLaunch.inputs.stagenum = stageNumDict['THICKPVC']
-                qcthickPVCLaunch.inputs.state = launched
-                brainsuite_workflow.connect(ds, 'out_file', qcthickPVCLaunch, 'Run')
-
-                dsQCThick = pe.Node(io.DataSink(), name='DATASINK_QCTHICK')
-                brainsuite_workflow.connect(thickPVCObj, 'atlasSurfLeftFile', dsQCThick, '@1')
-                brainsuite_workflow.connect(thickPVCObj, 'atlasSurfRightFile', dsQCThick, '@2')
-                brainsuite_workflow.connect(dsQCThick, 'out_file', dfsrenderThickLeftObj, 'Surfbilateral')
-                brainsuite_workflow.connect(dsQCThick, 'out_file', dfsrenderThickRightObj, 'Surfbilateral')
-                brainsuite_workflow.connect(dsQCThick, 'out_file', dfsrenderThickSupObj, 'Surfbilateral')
-                brainsuite_workflow.connect(dsQCThick, 'out_file', dfsrenderThickInfObj, 'Surfbilateral')
-
-                qcthickPVC = pe.Node(interface=bs.QCState(), name='qcthickPVC')
-                qcthickPVC.inputs.prefix = statesDir
-                qcthickPVC.inputs.stagenum = stageNumDict['THICKPVC']
-                qcthickPVC.inputs.state = completed
-
-                brainsuite_workflow.connect(dsQCThick, 'out_file', qcthickPVC, 'Run')
-
-
-                ###### Connect QC states with the steps ############
-                if 'noBSE' not in STAGES:
-                    qcstateInitObj.inputs.stagenum = stageNumDict['BSE']
-                    brainsuite_workflow.connect(qcstateInitObj, 'OutStateFile', bseObj, 'dummy')
-                    brainsuite_workflow.connect(bseObj, 'outputMRIVolume', qcstatevolbendbseObj, 'Run')
-                else:
-                    qcstateInitObj.inputs.stagenum = stageNumDict['BFC']
-                    brainsuite_workflow.connect(qcstateInitObj, 'OutStateFile', bfcObj, 'dummy')
-                brainsuite_workflow.connect(bfcObj, 'outputMRIVolume', qcstatevolbendbfcObj, 'Run')
-                brainsuite_workflow.connect(pvcObj, 'outputLabelFile', qcstatevolbendpvcObj, 'Run')
-                brainsuite_workflow.connect(cerebroObj, 'outputCerebrumMaskFile', qcstatevolbendcerebroObj, 'Run')
-                brainsuite_workflow.connect(cortexObj, 'outputCerebrumMask', qcstatevolbendcortexObj, 'Run')
-                brainsuite_workflow.connect(qccortexLaunch, 'OutStateFile', qcstatevolbendcortexObj, 'LaunchInput')
-                brainsuite_workflow.connect(scrubmaskObj, 'outputMaskFile', qcstatevolbendscrubmaskObj, 'Run')
-                brainsuite_workflow.connect(tcaObj, 'outputMaskFile', qcstatevolbendtcaObj, 'Run')
-                brainsuite_workflow.connect(dewispObj, 'outputMaskFile', qcstatevolbenddewispObj, 'Run')
-                brainsuite_workflow.connect(dfsObj, 'outputSurfaceFile', qcstatedfsrenderdfsObj, 'Run')
-                brainsuite_workflow.connect(pialmeshObj, 'outputSurfaceFile', qcstatedfsrenderpialmeshObj, 'Run')
-                brainsuite_workflow.connect(ds, 'out_file', qcstatedfsrenderhemisplitObj, 'Run')
-
-
-
-                if 'noBSE' not in STAGES:
-                    stagesRun.update({
-                       'BSE': stageNumDict['BSE']
-                    })
-                stagesRun.update({
-                    'BFC': stageNumDict['BFC'],
-                    'PVC': stageNumDict['PVC'],
-                    'CEREBRO':stageNumDict['CEREBRO'],
-                    'CORTEX':stageNumDict['CORTEX'],
-                    'SCRUBMASK':stageNumDict['SCRUBMASK'],
-                    'TCA': stageNumDict['TCA'],
-                    'DEWISP':stageNumDict['DEWISP'],
-                    'DFS': stageNumDict['DFS'],
-                    'PIALMESH':stageNumDict['PIALMESH'],
-                    'HEMISPLIT':stageNumDict['HEMISPLIT'],
-                    'THICKPVC': stageNumDict['THICKPVC']
-                })
+            # ====CSE stages (see workflows/stageTable.py)====
+            skip = []
+            if 'noBSE' in STAGES:
+                skip.append('BSE')
+            stageNodes.update(self.addStages(brainsuite_workflow, CSE_STAGES, context, nodes, skip))
 
         if 'BDP' in STAGES:
             bdpInputBase = dwi + SUBJECT_ID + '_dwi'
@@ -625,6 +406,7 @@ class subjLevelProcessing(object):
             INPUT_DWI_BASE = self.bdpfiles
             INPUT_DWI_SUBJECT_ID = INPUT_DWI_BASE.split('/')[-1].split('.')[0]
             bdpObj = pe.Node(interface=bs.BDP(), name='BDP')
+            nodes['BDP'] = bdpObj
 
             # bdp inputs that will be created. We delay execution of BDP until BFC is done
             bdpObj.inputs.bfcFile = bdpInputBase + '.bfc.nii.gz'
@@ -645,6 +427,10 @@ class subjLevelProcessing(object):
             bdpObj.inputs.sigma_GQI = self.sigma_GQI
             bdpObj.inputs.ERFO_SNR = self.ERFO_SNR
 
+            # the files staged with copyFile (the BFC image and brain mask for BDP, the DWI for eddy's mask, the
+            # outputs of the BFP tasks in func/ and their PNGs in the QC web folder) are only read by the tools,
+            # which write their outputs to new files, so they are reflinked or linked. No tool of this workflow rewrites one of them in place; such a
+            # destination would need links = False.
             copyBFCtoDWI = pe.Node(interface=bs.copyFile(), name='copyBFCtoDWI')
             copyBFCtoDWI.inputs.inFile = anat + os.sep + SUBJECT_ID + '_T1w.bfc.nii.gz'
             copyBFCtoDWI.inputs.outFile = bdpInputBase + '.bfc.nii.gz'
@@ -653,8 +439,11 @@ class subjLevelProcessing(object):
             copyBSEMasktoDWI.inputs.outFile = bdpInputBase + '.mask.nii.gz'
 
             if 'CSE' in STAGES:
-                brainsuite_workflow.connect(bfcObj, 'outputMRIVolume', copyBFCtoDWI, 'inFile')
-                brainsuite_workflow.connect(bseObj, 'outputMaskFile', copyBSEMasktoDWI, 'inFile')
+                brainsuite_workflow.connect(nodes['BFC'], 'outputMRIVolume', copyBFCtoDWI, 'inFile')
+                if 'BSE' in nodes:
+                    brainsuite_workflow.connect(nodes['BSE'], 'outputMaskFile', copyBSEMasktoDWI, 'inFile')
+            brainsuite_workflow.connect(copyBFCtoDWI, 'OutFile', bdpObj, 'bfcFile')
+            brainsuite_workflow.connect(copyBSEMasktoDWI, 'OutFile', bdpObj, 'dataSinkDelay')
 
             if not self.fsleddy:
                 if self.useDerivatives:
@@ -665,26 +454,16 @@ class subjLevelProcessing(object):
                 else:
                     bdpObj.inputs.inputDiffusionData = INPUT_DWI_BASE + '.nii.gz'
                     bdpObj.inputs.BVecBValPair = self.BVecBValPair
-                brainsuite_workflow.connect(copyBFCtoDWI, 'OutFile', bdpObj, 'bfcFile')
-                brainsuite_workflow.connect(copyBSEMasktoDWI, 'OutFile', bdpObj, 'dataSinkDelay')
             else:
                 copyDWItoEddyPrep = pe.Node(interface=bs.copyFile(), name='copyDWItoEddyPrep')
                 copyDWItoEddyPrep.inputs.inFile = INPUT_DWI_BASE + '.nii.gz'
                 copyDWItoEddyPrep.inputs.outFile = eddyprepdir + INPUT_DWI_SUBJECT_ID + '.nii.gz'
 
-                ds4 = pe.Node(io.DataSink(), name='BDPMaskDataSink')
-                ds4.inputs.base_directory = dwi
                 bdpMaskObj = pe.Node(interface=bs.BDP(), name='BDPMask')
-                bdpMaskObj.inputs.inputDiffusionData = eddyprepdir +  INPUT_DWI_SUBJECT_ID + '.nii.gz'
                 bdpMaskObj.inputs.maskOnly = True
                 bdpMaskObj.inputs.noStructuralRegistration = True
                 bdpMaskObj.inputs.BVecBValPair = self.BVecBValPair
-                brainsuite_workflow.connect(copyBFCtoDWI, 'OutFile', ds4, 'dataSinkDelay.@')
-                brainsuite_workflow.connect(copyBSEMasktoDWI, 'OutFile', ds4, 'dataSinkDelay.@1')
-                brainsuite_workflow.connect(copyDWItoEddyPrep, 'OutFile', ds4, 'dataSinkDelay.@2')
-                brainsuite_workflow.connect(ds4, 'out_file', bdpMaskObj, 'dataSinkDelay')
-                # brainsuite_workflow.connect(copyBFCtoDWI, 'OutFile', bdpMaskObj, 'dataSinkDelay')
-                # brainsuite_workflow.connect(copyBSEMasktoDWI, 'OutFile', bdpMaskObj, 'dataSinkDelay')
+                brainsuite_workflow.connect(copyDWItoEddyPrep, 'OutFile', bdpMaskObj, 'inputDiffusionData')
                 eddy = pe.Node(interface=Eddy(), name='EDDY')
                 eddy.inputs.in_file = INPUT_DWI_BASE + '.nii.gz'
                 eddy.inputs.in_index = self.indexFile
@@ -710,45 +489,16 @@ class subjLevelProcessing(object):
                 bdpObj.inputs.BVecBValPair = [rotbvec, self.BVecBValPair[1]]
                 brainsuite_workflow.connect(eddy, 'out_corrected', bdpObj, 'inputDiffusionData')
 
+            if self.fsleddy:
+                stageNodes.update({'BDPMask': 'BDPMASK', 'EDDY': 'EDDY'})
+            stageNodes['BDP'] = 'BDP'
 
             if 'QC' in STAGES:
-                qcbdpLaunch= pe.Node(interface=bs.QCState(), name='qcbdpLaunch')
-                qcbdpLaunch.inputs.prefix = statesDir
-                qcbdpLaunch.inputs.stagenum = stageNumDict['BDP']
-                qcbdpLaunch.inputs.state = launched
                 if self.fsleddy:
-                    qcBDPMaskLaunch = pe.Node(interface=bs.QCState(), name='qcBDPMaskLaunch')
-                    qcBDPMaskLaunch.inputs.prefix = statesDir
-                    qcBDPMaskLaunch.inputs.stagenum = stageNumDict['BDPMASK']
-                    qcBDPMaskLaunch.inputs.state = launched
-                    if not 'CSE' in STAGES:
-                        brainsuite_workflow.connect(copyBFCtoDWI, 'OutFile', qcBDPMaskLaunch, 'Run')
-                    else:
-                        brainsuite_workflow.connect(bfcObj, 'outputMRIVolume', qcBDPMaskLaunch, 'Run')
-
-                    qcBDPMaskComplete = pe.Node(interface=bs.QCState(), name='qcBDPMaskComplete')
-                    qcBDPMaskComplete.inputs.prefix = statesDir
-                    qcBDPMaskComplete.inputs.stagenum = stageNumDict['BDPMASK']
-                    qcBDPMaskComplete.inputs.state = completed
-                    brainsuite_workflow.connect(bdpMaskObj, 'DWIMask', qcBDPMaskComplete, 'Run')
-
-                    qceddyLaunch = pe.Node(interface=bs.QCState(), name='qceddyLaunch')
-                    qceddyLaunch.inputs.prefix = statesDir
-                    qceddyLaunch.inputs.stagenum = stageNumDict['EDDY']
-                    qceddyLaunch.inputs.state = launched
-
-                    brainsuite_workflow.connect(bdpMaskObj, 'DWIMask', qceddyLaunch, 'Run')
-
-                    qceddyComplete = pe.Node(interface=bs.QCState(), name='qceddyComplete')
-                    qceddyComplete.inputs.prefix = statesDir
-                    qceddyComplete.inputs.stagenum = stageNumDict['EDDY']
-                    qceddyComplete.inputs.state = completed
-                    brainsuite_workflow.connect(eddy, 'out_corrected', qceddyComplete, 'Run')
-
-                    volbendBDPMaskObj = pe.Node(interface=bs.Volslice(), name='volbendBDPMaskObj')
+                    volbendBDPMaskObj = pe.Node(interface=bs.VolsliceBatch(), name='volbendBDPMaskObj')
                     volbendBDPMaskObj.inputs.inFile = INPUT_DWI_BASE + '.nii.gz'
-                    volbendBDPMaskObj.inputs.outFile = '{0}/dmriMask.png'.format(WEBPATH)
-                    volbendBDPMaskObj.inputs.view = 3 # sagittal
+                    volbendBDPMaskObj.inputs.views = [{'outFile': '{0}/dmriMask.png'.format(WEBPATH),
+                                                       'view': 3}] # sagittal
 
                     volbendPostEddyObj = pe.Node(interface=bs.Volslice(), name='volbendPostEddyObj')
                     volbendPostEddyObj.inputs.outFile = '{0}/PostEddy.png'.format(WEBPATH)
@@ -770,20 +520,10 @@ class subjLevelProcessing(object):
                     brainsuite_workflow.connect(bdpMaskObj, 'DWIMask', volbendBDPMaskObj, 'maskFile')
                     # brainsuite_workflow.connect(eddy, 'out_corrected', volbendPostEddyObj, 'inFile')
                     # brainsuite_workflow.connect(eddy, 'in_file', volbendPreEddyObj, 'inFile')
-                    brainsuite_workflow.connect(eddy, 'out_corrected', qcbdpLaunch, 'Run')
-
-
-                else:
-                    if not 'CSE' in STAGES:
-                        brainsuite_workflow.connect(copyBFCtoDWI, 'OutFile', qcbdpLaunch, 'Run')
-                    else:
-                        brainsuite_workflow.connect(bfcObj, 'outputMRIVolume', qcbdpLaunch, 'Run')
-
 
                 distcorr = "correct."
                 if self.skipDistortionCorr:
                     distcorr = ""
-                FA = bdpInputBase + '.dwi.RAS.{0}FA.T1_coord.nii.gz'.format(distcorr)
                 bseMask = bdpInputBase + '.D_coord.mask.nii.gz'
                 pvcLabel = anat + SUBJECT_ID + '_T1w.pvc.label.nii.gz'
 
@@ -791,84 +531,43 @@ class subjLevelProcessing(object):
                 makeMaskObj.inputs.fileNameAndROIs =' '.join([pvcLabel,"1","2","4","5","6"])
                 brainsuite_workflow.connect(bdpObj, 'tensor_coord', makeMaskObj, "Run")
 
-                # FA PVC
-                volbendFApvcObj = pe.Node(interface=bs.Volslice(), name='volblendFApvc')
-                volbendFApvcObj.inputs.inFile = FA
-                volbendFApvcObj.inputs.outFile = '{0}/FApvc.png'.format(WEBPATH)
-                volbendFApvcObj.inputs.view = 1  # axial
-
-                # FA axial
-                volbendFAObj = pe.Node(interface=bs.Volslice(), name='volblendFA')
-                volbendFAObj.inputs.outFile = '{0}/FA.png'.format(WEBPATH)
-                volbendFAObj.inputs.view = 1  # axial
-
-                # color FA axial
-                volbendColorFAObj = pe.Node(interface=bs.Volslice(), name='volblendColorFA')
-                volbendColorFAObj.inputs.outFile = '{0}/colorFA.png'.format(WEBPATH)
-                volbendColorFAObj.inputs.view = 1  # axial
-
-                # color mADC axial
-                volbendMADCObj = pe.Node(interface=bs.Volslice(), name='volblendMADC')
-                volbendMADCObj.inputs.outFile = '{0}/mADC.png'.format(WEBPATH)
-                volbendMADCObj.inputs.view = 1  # axial
-
-                # precorr axial
-                volbendPreCorrDWIObj = pe.Node(interface=bs.Volslice(), name='volblendPreCorrDWI')
-                volbendPreCorrDWIObj.inputs.outFile = '{0}/PreCorrDWI.png'.format(WEBPATH)
-                volbendPreCorrDWIObj.inputs.view = 1  # axial
-                volbendPreCorrDWIObj.inputs.maskFile = bseMask
-
-                # precorr sag
-                volbendPreCorrDWIsagObj = pe.Node(interface=bs.Volslice(), name='volblendPreCorrDWIsag')
-                volbendPreCorrDWIsagObj.inputs.outFile = '{0}/PreCorrDWIsag.png'.format(WEBPATH)
-                volbendPreCorrDWIsagObj.inputs.view = 3  # axial
-                volbendPreCorrDWIsagObj.inputs.inFile = bdpInputBase + '.dwi.RAS.nii.gz'
+                # FA PVC, FA, color FA and mADC (axial)
+                volbendFAObj = pe.Node(interface=bs.VolsliceBatch(), name='volblendFA')
+                volbendFAObj.inputs.views = [
+                    {'outFile': '{0}/FApvc.png'.format(WEBPATH), 'view': 1},
+                    {'outFile': '{0}/FA.png'.format(WEBPATH), 'maskFile': '', 'view': 1},
+                    {'outFile': '{0}/colorFA.png'.format(WEBPATH), 'maskFile': '', 'view': 1,
+                     'inFile': bdpInputBase + '.dwi.RAS.{0}FA.color.T1_coord.nii.gz'.format(distcorr)},
+                    {'outFile': '{0}/mADC.png'.format(WEBPATH), 'maskFile': '', 'view': 1,
+                     'inFile': bdpInputBase + '.dwi.RAS.{0}mADC.T1_coord.nii.gz'.format(distcorr)}]
+
+                # precorr axial and sagittal
+                volbendPreCorrDWIObj = pe.Node(interface=bs.VolsliceBatch(), name='volblendPreCorrDWI')
+                volbendPreCorrDWIObj.inputs.views = [{'outFile': '{0}/PreCorrDWI.png'.format(WEBPATH), 'view': 1},
+                                                     {'outFile': '{0}/PreCorrDWIsag.png'.format(WEBPATH), 'view': 3}]
+                if self.fsleddy:
+                    volbendPreCorrDWIObj.inputs.views[1]['maskFile'] = ''
 
                 ### Connect rendering to bdp ####
-                brainsuite_workflow.connect(makeMaskObj, 'OutFile', volbendFApvcObj, 'maskFile')
+                brainsuite_workflow.connect(makeMaskObj, 'OutFile', volbendFAObj, 'maskFile')
                 if self.skipDistortionCorr:
                     brainsuite_workflow.connect(bdpObj, 'FA', volbendFAObj, 'inFile')
-                    brainsuite_workflow.connect(bdpObj, 'ColorFA', volbendColorFAObj, 'inFile')
-                    brainsuite_workflow.connect(bdpObj, 'MADC', volbendMADCObj, 'inFile')
                 else:
                     brainsuite_workflow.connect(bdpObj, 'corrFA', volbendFAObj, 'inFile')
-                    brainsuite_workflow.connect(bdpObj, 'corrColorFA', volbendColorFAObj, 'inFile')
-                    brainsuite_workflow.connect(bdpObj, 'corrMADC', volbendMADCObj, 'inFile')
-                    # postcorr axial
-                    volbendPostCorrDWIObj = pe.Node(interface=bs.Volslice(), name='volblendPostCorrDWI')
-                    volbendPostCorrDWIObj.inputs.outFile = '{0}/PostCorrDWI.png'.format(WEBPATH)
-                    volbendPostCorrDWIObj.inputs.view = 1  # axial
+                    # postcorr axial and sagittal
+                    volbendPostCorrDWIObj = pe.Node(interface=bs.VolsliceBatch(), name='volblendPostCorrDWI')
                     volbendPostCorrDWIObj.inputs.maskFile = bseMask
-                    # postcorr sag
-                    volbendPostCorrDWIsagObj = pe.Node(interface=bs.Volslice(), name='volblendPostCorrDWIsag')
-                    volbendPostCorrDWIsagObj.inputs.outFile = '{0}/PostCorrDWIsag.png'.format(WEBPATH)
-                    volbendPostCorrDWIsagObj.inputs.view = 3  # axial
-                    volbendPostCorrDWIsagObj.inputs.maskFile = bseMask
+                    volbendPostCorrDWIObj.inputs.views = [
+                        {'outFile': '{0}/PostCorrDWI.png'.format(WEBPATH), 'view': 1},
+                        {'outFile': '{0}/PostCorrDWIsag.png'.format(WEBPATH), 'view': 3}]
 
                     brainsuite_workflow.connect(bdpObj, 'PostCorrDWI', volbendPostCorrDWIObj, 'inFile')
-                    brainsuite_workflow.connect(bdpObj, 'PostCorrDWI', volbendPostCorrDWIsagObj, 'inFile')
 
                 if self.fsleddy:
                     brainsuite_workflow.connect(eddy, 'out_corrected', volbendPreCorrDWIObj, 'inFile')
-                    brainsuite_workflow.connect(bdpObj, 'DcoordMask', volbendPreCorrDWIObj, 'maskFile')
-                    brainsuite_workflow.connect(eddy, 'out_corrected', volbendPreCorrDWIsagObj, 'inFile')
                 else:
                     brainsuite_workflow.connect(bdpObj, 'PreCorrDWI', volbendPreCorrDWIObj, 'inFile')
-                    brainsuite_workflow.connect(bdpObj, 'DcoordMask', volbendPreCorrDWIObj, 'maskFile')
-                    brainsuite_workflow.connect(bdpObj, 'PreCorrDWI', volbendPreCorrDWIsagObj, 'inFile')
-                    brainsuite_workflow.connect(bdpObj, 'DcoordMask', volbendPreCorrDWIsagObj, 'maskFile')
-
-                ###### Connect QC states with the steps ############
-                qcstateBDP = pe.Node(interface=bs.QCState(), name='qcstateBDP')
-                qcstateBDP.inputs.prefix = statesDir
-                qcstateBDP.inputs.stagenum = stageNumDict['BDP']
-                qcstateBDP.inputs.state = completed
-
-                stagesRun.update({
-                    'BDP': stageNumDict['BDP'],
-                })
-
-                brainsuite_workflow.connect(bdpObj, 'tensor_coord', qcstateBDP, 'Run')
+                brainsuite_workflow.connect(bdpObj, 'DcoordMask', volbendPreCorrDWIObj, 'maskFile')
 
         if 'SVREG' in STAGES:
             svregInputBase = anat + os.sep + SUBJECT_ID + '_T1w'
@@ -881,30 +580,22 @@ class subjLevelProcessing(object):
                     sys.exit(1)
 
             svregObj = pe.Node(interface=bs.SVReg(), name='SVREG')
+            nodes['SVREG'] = svregObj
             svregObj.inputs.subjectFilePrefix = svregInputBase
             svregObj.inputs.atlasFilePrefix = self.atlas
             svregObj.inputs.useSingleThreading = self.singleThread
             if 'CSE' in STAGES:
-                ds0_thick = pe.Node(io.DataSink(), name='DATASINK0THICK')
-                brainsuite_workflow.connect(thickPVCObj, 'atlasSurfLeftFile', ds0_thick, '@')
-                brainsuite_workflow.connect(thickPVCObj, 'atlasSurfRightFile', ds0_thick, '@1')
-                # We delay execution of SVReg until all CSE and datasink are done
-                brainsuite_workflow.connect(ds0_thick, 'out_file', svregObj, 'dataSinkDelay')
+                # We delay execution of SVReg until all CSE stages are done
+                brainsuite_workflow.connect(nodes['ThickPVC'], 'atlasSurfRightFile', svregObj, 'dataSinkDelay')
 
             thick2atlasObj = pe.Node(interface=bs.Thickness2Atlas(), name='THICK2ATLAS')
             thick2atlasObj.inputs.subjectFilePrefix = svregInputBase
 
             brainsuite_workflow.connect(svregObj, 'outputLabelFile', thick2atlasObj, 'dataSinkDelay')
 
-            ds3 = pe.Node(io.DataSink(), name='DATASINK3')
-            ds3.inputs.base_directory = anat
-
-            brainsuite_workflow.connect(thick2atlasObj, 'atlasSurfLeftFile', ds3, '@')
-            brainsuite_workflow.connect(thick2atlasObj, 'atlasSurfRightFile', ds3, '@1')
-
             generateXls = pe.Node(interface=bs.GenerateXls(), name='GenXls')
             generateXls.inputs.subjectFilePrefix = svregInputBase
-            brainsuite_workflow.connect(ds3, 'out_file', generateXls, 'dataSinkDelay')
+            brainsuite_workflow.connect(thick2atlasObj, 'atlasSurfRightFile', generateXls, 'dataSinkDelay')
 
             #### smooth surface files
             smoothSurfInputBase = anat + os.sep + 'atlas.pvc-thickness_0-6mm'
@@ -928,415 +619,45 @@ class subjLevelProcessing(object):
             brainsuite_workflow.connect(thick2atlasObj, 'atlasSurfRightFile', smoothSurfRightObj, 'inputSurface')
             brainsuite_workflow.connect(svregObj, 'JacDetFile', smoothVolJacObj, 'inFile')
 
-            if 'QC' in STAGES:
-                if not 'CSE' in STAGES:
-                    if 'QC' in STAGES:
-                        qcstateInitObj.inputs.stagenum = stageNumDict['SVREG']
-                        brainsuite_workflow.connect(qcstateInitObj, 'OutStateFile', svregObj, 'dataSinkDelay')
-
-                if 'CSE' in STAGES:
-                    qcsvregLaunch = pe.Node(interface=bs.QCState(), name='qcsvregLaunch')
-                    qcsvregLaunch.inputs.prefix = statesDir
-                    qcsvregLaunch.inputs.stagenum = stageNumDict['SVREG']
-                    qcsvregLaunch.inputs.state = launched
-                    brainsuite_workflow.connect(ds0_thick, 'out_file', qcsvregLaunch, 'Run')
+            # SVREG is complete once its statistics are written
+            stageNodes.update({'SVREG': 'SVREG', 'THICK2ATLAS': 'SVREG', 'GenXls': 'SVREG',
+                               'SMOOTHSURFLEFT': 'SMOOTHSURFLEFT', 'SMOOTHSURFRIGHT': 'SMOOTHSURFRIGHT',
+                               'SMOOTHVOL_MAP': 'SMOOTHVOLJAC'})
 
+            if 'QC' in STAGES:
                 svregLabel = svregInputBase + '.svreg.label.nii.gz'
                 SVREGdfs = svregInputBase + '.left.mid.cortex.svreg.dfs' + ' ' + \
                            svregInputBase + '.right.mid.cortex.svreg.dfs'
                 bfc = svregInputBase + '.bfc.nii.gz'
 
-                volbendSVRegLabelObj = pe.Node(interface=bs.Volslice(), name='volblendSVRegLabel')
+                volbendSVRegLabelObj = pe.Node(interface=bs.VolsliceBatch(), name='volblendSVRegLabel')
                 volbendSVRegLabelObj.inputs.inFile = bfc
-                volbendSVRegLabelObj.inputs.outFile = '{0}/svregLabel.png'.format(WEBPATH)
-                volbendSVRegLabelObj.inputs.labelDesc = labeldesc
-                volbendSVRegLabelObj.inputs.view = 1 # axial
-
-                volbendSVRegLabelCorObj = pe.Node(interface=bs.Volslice(), name='volblendSVRegLabelCor')
-                volbendSVRegLabelCorObj.inputs.inFile = bfc
-                volbendSVRegLabelCorObj.inputs.outFile = '{0}/svregLabelCor.png'.format(WEBPATH)
-                volbendSVRegLabelCorObj.inputs.labelDesc = labeldesc
-                volbendSVRegLabelCorObj.inputs.view = 2  # coronal
-
-                volbendSVRegLabelSagObj = pe.Node(interface=bs.Volslice(), name='volblendSVRegLabelSag')
-                volbendSVRegLabelSagObj.inputs.inFile = bfc
-                volbendSVRegLabelSagObj.inputs.outFile = '{0}/svregLabelSag.png'.format(WEBPATH)
-                volbendSVRegLabelSagObj.inputs.labelDesc = labeldesc
-                volbendSVRegLabelSagObj.inputs.view = 3  # saggittal
-
-                dfsrenderSVREGdfsLeftObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderSVREGdfsLeft')
-                dfsrenderSVREGdfsLeftObj.inputs.Surfaces = SVREGdfs
-                dfsrenderSVREGdfsLeftObj.inputs.OutFile = '{0}/SVREGdfsLeft.png'.format(WEBPATH)
-                dfsrenderSVREGdfsLeftObj.inputs.Left = True
-                dfsrenderSVREGdfsLeftObj.inputs.Zoom = 0.6
-                dfsrenderSVREGdfsLeftObj.inputs.CenterVol = bfc
-
-                dfsrenderSVREGdfsRightObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderSVREGdfsRight')
-                dfsrenderSVREGdfsRightObj.inputs.Surfaces = SVREGdfs
-                dfsrenderSVREGdfsRightObj.inputs.OutFile = '{0}/SVREGdfsRight.png'.format(WEBPATH)
-                dfsrenderSVREGdfsRightObj.inputs.Right = True
-                dfsrenderSVREGdfsRightObj.inputs.Zoom = 0.6
-                dfsrenderSVREGdfsRightObj.inputs.CenterVol = bfc
-
-                dfsrenderSVREGdfsInfObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderSVREGdfsInf')
-                dfsrenderSVREGdfsInfObj.inputs.Surfaces = SVREGdfs
-                dfsrenderSVREGdfsInfObj.inputs.OutFile = '{0}/SVREGdfsInf.png'.format(WEBPATH)
-                dfsrenderSVREGdfsInfObj.inputs.Inf = True
-                dfsrenderSVREGdfsInfObj.inputs.Zoom = 0.6
-                dfsrenderSVREGdfsInfObj.inputs.CenterVol = bfc
-
-                dfsrenderSVREGdfsSupObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderSVREGdfsSup')
-                dfsrenderSVREGdfsSupObj.inputs.Surfaces = SVREGdfs
-                dfsrenderSVREGdfsSupObj.inputs.OutFile = '{0}/SVREGdfsSup.png'.format(WEBPATH)
-                dfsrenderSVREGdfsSupObj.inputs.Sup = True
-                dfsrenderSVREGdfsSupObj.inputs.Zoom = 0.6
-                dfsrenderSVREGdfsSupObj.inputs.CenterVol = bfc
-
-                dfsrenderSVREGdfsAntObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderSVREGdfsAnt')
-                dfsrenderSVREGdfsAntObj.inputs.Surfaces = SVREGdfs
-                dfsrenderSVREGdfsAntObj.inputs.OutFile = '{0}/SVREGdfsAnt.png'.format(WEBPATH)
-                dfsrenderSVREGdfsAntObj.inputs.Ant = True
-                dfsrenderSVREGdfsAntObj.inputs.Zoom = 0.6
-                dfsrenderSVREGdfsAntObj.inputs.CenterVol = bfc
-
-                dfsrenderSVREGdfsPosObj = pe.Node(interface=bs.RenderDfs(), name='dfsrenderSVREGdfsPos')
-                dfsrenderSVREGdfsPosObj.inputs.Surfaces = SVREGdfs
-                dfsrenderSVREGdfsPosObj.inputs.OutFile = '{0}/SVREGdfsPos.png'.format(WEBPATH)
-                dfsrenderSVREGdfsPosObj.inputs.Pos = True
-                dfsrenderSVREGdfsPosObj.inputs.Zoom = 0.6
-                dfsrenderSVREGdfsPosObj.inputs.CenterVol = bfc
-
-                qcstateSVREG = pe.Node(interface=bs.QCState(), name='qcstateSVREG')
-                qcstateSVREG.inputs.prefix = statesDir
-                qcstateSVREG.inputs.stagenum= stageNumDict['SVREG']
-                qcstateSVREG.inputs.state = completed
+                volbendSVRegLabelObj.inputs.views = [
+                    {'outFile': '{0}/svregLabel.png'.format(WEBPATH), 'labelDesc': labeldesc, 'view': 1}, # axial
+                    {'outFile': '{0}/svregLabelCor.png'.format(WEBPATH), 'labelDesc': labeldesc, 'view': 2}, # coronal
+                    {'outFile': '{0}/svregLabelSag.png'.format(WEBPATH), 'labelDesc': labeldesc, 'view': 3}] # sagittal
+
+                dfsrenderSVREGdfsObj = pe.Node(interface=bs.RenderDfsViews(), name='dfsrenderSVREGdfs')
+                dfsrenderSVREGdfsObj.inputs.Surfaces = SVREGdfs
+                dfsrenderSVREGdfsObj.inputs.Zoom = 0.6
+                dfsrenderSVREGdfsObj.inputs.CenterVol = bfc
+                dfsrenderSVREGdfsObj.inputs.views = [{'OutFile': '{0}/SVREGdfs{1}.png'.format(WEBPATH, view), 'view': view}
+                                                     for view in ['Left', 'Right', 'Inf', 'Sup', 'Ant', 'Pos']]
 
                 ### Connect rendering to SVREG ####
                 brainsuite_workflow.connect(svregObj, 'outputLabelFile', volbendSVRegLabelObj, 'labelFile')
-                brainsuite_workflow.connect(svregObj, 'outputLabelFile', volbendSVRegLabelCorObj, 'labelFile')
-                brainsuite_workflow.connect(svregObj, 'outputLabelFile', volbendSVRegLabelSagObj, 'labelFile')
-                brainsuite_workflow.connect(svregObj, 'outputLabelFile', dfsrenderSVREGdfsLeftObj, 'dataSinkDelay')
-                brainsuite_workflow.connect(svregObj, 'outputLabelFile', dfsrenderSVREGdfsRightObj, 'dataSinkDelay')
-                brainsuite_workflow.connect(svregObj, 'outputLabelFile', dfsrenderSVREGdfsInfObj, 'dataSinkDelay')
-                brainsuite_workflow.connect(svregObj, 'outputLabelFile', dfsrenderSVREGdfsSupObj, 'dataSinkDelay')
-                brainsuite_workflow.connect(svregObj, 'outputLabelFile', dfsrenderSVREGdfsAntObj, 'dataSinkDelay')
-                brainsuite_workflow.connect(svregObj, 'outputLabelFile', dfsrenderSVREGdfsPosObj, 'dataSinkDelay')
-
-                ### Connect QC to SVREG ####
-                brainsuite_workflow.connect(generateXls, 'roiwisestats', qcstateSVREG, 'Run')
-
-                qcSurfLeftLaunch = pe.Node(interface=bs.QCState(), name='qcSurfLeftLaunch')
-                qcSurfLeftLaunch.inputs.prefix = statesDir
-                qcSurfLeftLaunch.inputs.stagenum = stageNumDict['SMOOTHSURFLEFT']
-                qcSurfLeftLaunch.inputs.state = launched
-                brainsuite_workflow.connect(ds3, 'out_file', qcSurfLeftLaunch, 'Run')
-                qcSurfRightLaunch = pe.Node(interface=bs.QCState(), name='qcSurfRightLaunch')
-                qcSurfRightLaunch.inputs.prefix = statesDir
-                qcSurfRightLaunch.inputs.stagenum = stageNumDict['SMOOTHSURFRIGHT']
-                qcSurfRightLaunch.inputs.state = launched
-                brainsuite_workflow.connect(ds3, 'out_file', qcSurfRightLaunch, 'Run')
-                qcsmoothVolJacLaunch = pe.Node(interface=bs.QCState(), name='qcsmoothVolJacLaunch')
-                qcsmoothVolJacLaunch.inputs.prefix = statesDir
-                qcsmoothVolJacLaunch.inputs.stagenum = stageNumDict['SMOOTHVOLJAC']
-                qcsmoothVolJacLaunch.inputs.state = launched
-                brainsuite_workflow.connect(ds3, 'out_file', qcsmoothVolJacLaunch, 'Run')
-
-                qcsmoothSurfLeft = pe.Node(interface=bs.QCState(), name='qcsmoothSurfLeft')
-                qcsmoothSurfLeft.inputs.prefix = statesDir
-                qcsmoothSurfLeft.inputs.stagenum = stageNumDict['SMOOTHSURFLEFT']
-                qcsmoothSurfLeft.inputs.state = completed
-                qcsmoothSurfRight = pe.Node(interface=bs.QCState(), name='qcsmoothSurfRight')
-                qcsmoothSurfRight.inputs.prefix = statesDir
-                qcsmoothSurfRight.inputs.stagenum = stageNumDict['SMOOTHSURFRIGHT']
-                qcsmoothSurfRight.inputs.state = completed
-                qcsmoothVolJac = pe.Node(interface=bs.QCState(), name='qcsmoothVolJac')
-                qcsmoothVolJac.inputs.prefix = statesDir
-                qcsmoothVolJac.inputs.stagenum = stageNumDict['SMOOTHVOLJAC']
-                qcsmoothVolJac.inputs.state = completed
-
-                brainsuite_workflow.connect(smoothSurfLeftObj, 'smoothSurfFile', qcsmoothSurfLeft, 'Run')
-                brainsuite_workflow.connect(smoothSurfRightObj, 'smoothSurfFile', qcsmoothSurfRight, 'Run')
-                brainsuite_workflow.connect(qcsmoothVolJacLaunch, 'OutStateFile', qcsmoothVolJac, 'LaunchInput')
-                brainsuite_workflow.connect(smoothVolJacObj, 'smoothFile', qcsmoothVolJac, 'Run')
-
-            stagesRun.update({
-                'SVREG': stageNumDict['SVREG'],
-                'SMOOTHSURFLEFT': stageNumDict['SMOOTHSURFLEFT'],
-                'SMOOTHSURFRIGHT': stageNumDict['SMOOTHSURFRIGHT'],
-                'SMOOTHVOLJAC': stageNumDict['SMOOTHVOLJAC']
-            })
-
-        if 'SVREG' in STAGES and 'BDP' in STAGES:
-            atlasFilePrefix = self.atlas
-
-            ######## Apply Map ########
-            applyMapInputBase = dwi + os.sep + SUBJECT_ID + '_dwi'
-            applyMapInputBaseSVReg = anat + os.sep + SUBJECT_ID + '_T1w'
-            applyMapMapFile = applyMapInputBaseSVReg + '.svreg.inv.map.nii.gz'
-            applyMapTargetFile = atlasFilePrefix + '.bfc.nii.gz'
+                brainsuite_workflow.connect(svregObj, 'outputLabelFile', dfsrenderSVREGdfsObj, 'dataSinkDelay')
 
+        if ('SVREG' in STAGES and 'BDP' in STAGES) or 'SVREG+BDP' in STAGES:
             distcorr = "correct."
             distcorrOutput = "corr"
             if self.skipDistortionCorr:
                 distcorr = ""
                 distcorrOutput = ""
+            context.update({'atlas': self.atlas, 'distcorr': distcorr, 'distcorrOutput': distcorrOutput})
 
-            applyMapFAObj = pe.Node(interface=bs.SVRegApplyMap(), name='APPLYMAPFA')
-            applyMapFAObj.inputs.outFile = applyMapInputBase + '.dwi.RAS.{0}atlas.FA.nii.gz'.format(distcorr)
-            applyMapFAObj.inputs.targetFile = applyMapTargetFile
-
-            applyMapMDObj = pe.Node(interface=bs.SVRegApplyMap(), name='APPLYMAPMD')
-            applyMapMDObj.inputs.outFile = applyMapInputBase + '.dwi.RAS.{0}atlas.MD.nii.gz'.format(distcorr)
-            applyMapMDObj.inputs.targetFile = applyMapTargetFile
-
-            applyMapAxialObj = pe.Node(interface=bs.SVRegApplyMap(), name='APPLYMAPAXIAL')
-            applyMapAxialObj.inputs.outFile = applyMapInputBase + '.dwi.RAS.{0}atlas.axial.nii.gz'.format(distcorr)
-            applyMapAxialObj.inputs.targetFile = applyMapTargetFile
-
-            applyMapRadialObj = pe.Node(interface=bs.SVRegApplyMap(), name='APPLYMAPRADIAL')
-            applyMapRadialObj.inputs.outFile = applyMapInputBase + '.dwi.RAS.{0}atlas.radial.nii.gz'.format(distcorr)
-            applyMapRadialObj.inputs.targetFile = applyMapTargetFile
-
-            applyMapmADCObj = pe.Node(interface=bs.SVRegApplyMap(), name='APPLYMAPmADC')
-            applyMapmADCObj.inputs.outFile = applyMapInputBase + '.dwi.RAS.{0}atlas.mADC.nii.gz'.format(distcorr)
-            applyMapmADCObj.inputs.targetFile = applyMapTargetFile
-
-            applyMapFRT_GFAObj = pe.Node(interface=bs.SVRegApplyMap(), name='APPLYMAPFRTGFA')
-            applyMapFRT_GFAObj.inputs.outFile = applyMapInputBase + '.dwi.RAS.{0}atlas.FRT_GFA.nii.gz'.format(distcorr)
-            applyMapFRT_GFAObj.inputs.targetFile = applyMapTargetFile
-
-            ds5 = pe.Node(io.DataSink(), name='DATASINK5')
-            ds5.inputs.base_directory = anat
-
-            brainsuite_workflow.connect(svregObj, 'InvMapFile', applyMapFAObj, 'mapFile')
-            brainsuite_workflow.connect(svregObj, 'InvMapFile', applyMapMDObj, 'mapFile')
-            brainsuite_workflow.connect(svregObj, 'InvMapFile', applyMapAxialObj, 'mapFile')
-            brainsuite_workflow.connect(svregObj, 'InvMapFile', applyMapRadialObj, 'mapFile')
-            brainsuite_workflow.connect(svregObj, 'InvMapFile', applyMapmADCObj, 'mapFile')
-            brainsuite_workflow.connect(svregObj, 'InvMapFile', applyMapFRT_GFAObj, 'mapFile')
-
-            brainsuite_workflow.connect(bdpObj, '%sFA' % distcorrOutput, applyMapFAObj, 'dataFile')
-            brainsuite_workflow.connect(bdpObj, '%sMD' % distcorrOutput, applyMapMDObj, 'dataFile')
-            brainsuite_workflow.connect(bdpObj, '%sAxial' % distcorrOutput, applyMapAxialObj, 'dataFile')
-            brainsuite_workflow.connect(bdpObj, '%sRadial' % distcorrOutput, applyMapRadialObj, 'dataFile')
-            brainsuite_workflow.connect(bdpObj, '%sMADC' % distcorrOutput, applyMapmADCObj, 'dataFile')
-            brainsuite_workflow.connect(bdpObj, '%sFRTGFA' % distcorrOutput, applyMapFRT_GFAObj, 'dataFile')
-
-            ####### Smooth Vol #######
-            smoothVolInputBase = dwi + os.sep + SUBJECT_ID  + '_dwi' + '.dwi.RAS.{0}atlas.'.format(distcorr)
-
-            smoothVolFAObj = pe.Node(interface=bs.GSmooth(), name='SMOOTHVOLFA')
-            smoothVolFAObj.inputs.sigma = smoothVolStd
-            smoothVolFAObj.inputs.outFile = smoothVolInputBase + 'FA.smooth{0}mm.nii.gz'.format(str(self.smoothvol))
-
-            smoothVolMDObj = pe.Node(interface=bs.GSmooth(), name='SMOOTHVOLMD')
-            smoothVolMDObj.inputs.sigma = smoothVolStd
-            smoothVolMDObj.inputs.outFile = smoothVolInputBase + 'MD.smooth{0}mm.nii.gz'.format(str(self.smoothvol))
-
-            smoothVolAxialObj = pe.Node(interface=bs.GSmooth(), name='SMOOTHVOLAXIAL')
-            smoothVolAxialObj.inputs.sigma = smoothVolStd
-            smoothVolAxialObj.inputs.outFile = smoothVolInputBase + 'axial.smooth{0}mm.nii.gz'.format(str(self.smoothvol))
-
-            smoothVolRadialObj = pe.Node(interface=bs.GSmooth(), name='SMOOTHVOLRADIAL')
-            smoothVolRadialObj.inputs.sigma = smoothVolStd
-            smoothVolRadialObj.inputs.outFile = smoothVolInputBase + 'radial.smooth{0}mm.nii.gz'.format(str(self.smoothvol))
-
-            smoothVolmADCObj = pe.Node(interface=bs.GSmooth(), name='SMOOTHVOLMADC')
-            smoothVolmADCObj.inputs.sigma = smoothVolStd
-            smoothVolmADCObj.inputs.outFile = smoothVolInputBase + 'mADC.smooth{0}mm.nii.gz'.format(str(self.smoothvol))
-
-            smoothVolFRT_GFAObj = pe.Node(interface=bs.GSmooth(), name='SMOOTHVOLFRTGFA')
-            smoothVolFRT_GFAObj.inputs.sigma = smoothVolStd
-            smoothVolFRT_GFAObj.inputs.outFile = smoothVolInputBase + 'FRT_GFA.smooth{0}mm.nii.gz'.format(str(self.smoothvol))
-
-            brainsuite_workflow.connect(applyMapFAObj, 'mappedFile', smoothVolFAObj, 'inFile')
-            brainsuite_workflow.connect(applyMapMDObj, 'mappedFile', smoothVolMDObj, 'inFile')
-            brainsuite_workflow.connect(applyMapAxialObj, 'mappedFile', smoothVolAxialObj, 'inFile')
-            brainsuite_workflow.connect(applyMapRadialObj, 'mappedFile', smoothVolRadialObj, 'inFile')
-            brainsuite_workflow.connect(applyMapmADCObj, 'mappedFile', smoothVolmADCObj, 'inFile')
-            brainsuite_workflow.connect(applyMapFRT_GFAObj, 'mappedFile', smoothVolFRT_GFAObj, 'inFile')
-
-            if 'QC' in STAGES:
-                qcapplyMapFALaunch = pe.Node(interface=bs.QCState(), name='qcapplyMapFALaunch')
-                qcapplyMapFALaunch.inputs.prefix = statesDir
-                qcapplyMapFALaunch.inputs.stagenum = stageNumDict['APPLYMAPFA']
-                qcapplyMapFALaunch.inputs.state = launched
-
-                qcapplyMapMDLaunch = pe.Node(interface=bs.QCState(), name='qcapplyMapMDLaunch')
-                qcapplyMapMDLaunch.inputs.prefix = statesDir
-                qcapplyMapMDLaunch.inputs.stagenum = stageNumDict['APPLYMAPMD']
-                qcapplyMapMDLaunch.inputs.state = launched
-
-                qcapplyMapAxialLaunch = pe.Node(interface=bs.QCState(), name='qcapplyMapAxialLaunch')
-                qcapplyMapAxialLaunch.inputs.prefix = statesDir
-                qcapplyMapAxialLaunch.inputs.stagenum = stageNumDict['APPLYMAPAXIAL']
-                qcapplyMapAxialLaunch.inputs.state = launched
-
-                qcapplyMapRadialLaunch = pe.Node(interface=bs.QCState(), name='qcapplyMapRadialLaunch')
-                qcapplyMapRadialLaunch.inputs.prefix = statesDir
-                qcapplyMapRadialLaunch.inputs.stagenum = stageNumDict['APPLYMAPRADIAL']
-                qcapplyMapRadialLaunch.inputs.state = launched
-
-                qcapplyMapmADCLaunch = pe.Node(interface=bs.QCState(), name='qcapplyMapmADCLaunch')
-                qcapplyMapmADCLaunch.inputs.prefix = statesDir
-                qcapplyMapmADCLaunch.inputs.stagenum = stageNumDict['APPLYMAPMADC']
-                qcapplyMapmADCLaunch.inputs.state = launched
-
-                qcapplyMapFRT_GFALaunch = pe.Node(interface=bs.QCState(), name='qcapplyMapFRT_GFALaunch')
-                qcapplyMapFRT_GFALaunch.inputs.prefix = statesDir
-                qcapplyMapFRT_GFALaunch.inputs.stagenum = stageNumDict['APPLYMAPFRTGFA']
-                qcapplyMapFRT_GFALaunch.inputs.state = launched
-
-                ds2 = pe.Node(io.DataSink(), name='DATASINK2')
-                ds2.inputs.base_directory = dwi
-
-                brainsuite_workflow.connect(svregObj, 'InvMapFile', ds2, '@0')
-
-                brainsuite_workflow.connect(bdpObj, '%sFA' % distcorrOutput, ds2, '@')
-                brainsuite_workflow.connect(bdpObj, '%sMD' % distcorrOutput, ds2, '@1')
-                brainsuite_workflow.connect(bdpObj, '%sAxial' % distcorrOutput, ds2, '@2')
-                brainsuite_workflow.connect(bdpObj, '%sRadial' % distcorrOutput, ds2, '@3')
-                brainsuite_workflow.connect(bdpObj, '%sMADC' % distcorrOutput, ds2, '@4')
-                brainsuite_workflow.connect(bdpObj, '%sFRTGFA' % distcorrOutput, ds2, '@5')
-
-                brainsuite_workflow.connect(ds2, 'out_file', qcapplyMapFALaunch, 'Run')
-                brainsuite_workflow.connect(ds2, 'out_file', qcapplyMapMDLaunch, 'Run')
-                brainsuite_workflow.connect(ds2, 'out_file', qcapplyMapAxialLaunch, 'Run')
-                brainsuite_workflow.connect(ds2, 'out_file', qcapplyMapRadialLaunch, 'Run')
-                brainsuite_workflow.connect(ds2, 'out_file', qcapplyMapmADCLaunch, 'Run')
-                brainsuite_workflow.connect(ds2, 'out_file', qcapplyMapFRT_GFALaunch, 'Run')
-
-                qcapplyMapFA = pe.Node(interface=bs.QCState(), name='qcapplyMapFA')
-                qcapplyMapFA.inputs.prefix = statesDir
-                qcapplyMapFA.inputs.stagenum = stageNumDict['APPLYMAPFA']
-                qcapplyMapFA.inputs.state = completed
-
-                qcapplyMapMD = pe.Node(interface=bs.QCState(), name='qcapplyMapMD')
-                qcapplyMapMD.inputs.prefix = statesDir
-                qcapplyMapMD.inputs.stagenum = stageNumDict['APPLYMAPMD']
-                qcapplyMapMD.inputs.state = completed
-
-                qcapplyMapAxial = pe.Node(interface=bs.QCState(), name='qcapplyMapAxial')
-                qcapplyMapAxial.inputs.prefix = statesDir
-                qcapplyMapAxial.inputs.stagenum = stageNumDict['APPLYMAPAXIAL']
-                qcapplyMapAxial.inputs.state = completed
-
-                qcapplyMapRadial = pe.Node(interface=bs.QCState(), name='qcapplyMapRadial')
-                qcapplyMapRadial.inputs.prefix = statesDir
-                qcapplyMapRadial.inputs.stagenum = stageNumDict['APPLYMAPRADIAL']
-                qcapplyMapRadial.inputs.state = completed
-
-                qcapplyMapmADC = pe.Node(interface=bs.QCState(), name='qcapplyMapmADC')
-                qcapplyMapmADC.inputs.prefix = statesDir
-                qcapplyMapmADC.inputs.stagenum = stageNumDict['APPLYMAPMADC']
-                qcapplyMapmADC.inputs.state = completed
-
-                qcapplyMapFRT_GFA = pe.Node(interface=bs.QCState(), name='qcapplyMapFRT_GFA')
-                qcapplyMapFRT_GFA.inputs.prefix = statesDir
-                qcapplyMapFRT_GFA.inputs.stagenum = stageNumDict['APPLYMAPFRTGFA']
-                qcapplyMapFRT_GFA.inputs.state = completed
-
-                brainsuite_workflow.connect(applyMapFAObj, 'mappedFile', qcapplyMapFA, 'Run')
-                brainsuite_workflow.connect(qcapplyMapFALaunch, 'OutStateFile', qcapplyMapFA, 'LaunchInput')
-                brainsuite_workflow.connect(applyMapMDObj, 'mappedFile', qcapplyMapMD, 'Run')
-                brainsuite_workflow.connect(qcapplyMapMDLaunch, 'OutStateFile', qcapplyMapMD, 'LaunchInput')
-                brainsuite_workflow.connect(applyMapAxialObj, 'mappedFile', qcapplyMapAxial, 'Run')
-                brainsuite_workflow.connect(qcapplyMapAxialLaunch, 'OutStateFile', qcapplyMapAxial, 'LaunchInput')
-                brainsuite_workflow.connect(applyMapRadialObj, 'mappedFile', qcapplyMapRadial, 'Run')
-                brainsuite_workflow.connect(qcapplyMapRadialLaunch, 'OutStateFile', qcapplyMapRadial, 'LaunchInput')
-                brainsuite_workflow.connect(applyMapmADCObj, 'mappedFile', qcapplyMapmADC, 'Run')
-                brainsuite_workflow.connect(qcapplyMapmADCLaunch, 'OutStateFile', qcapplyMapmADC, 'LaunchInput')
-                brainsuite_workflow.connect(applyMapFRT_GFAObj, 'mappedFile', qcapplyMapFRT_GFA, 'Run')
-                brainsuite_workflow.connect(qcapplyMapFRT_GFALaunch, 'OutStateFile', qcapplyMapFRT_GFA, 'LaunchInput')
-
-                qcsmoothVolFALaunch = pe.Node(interface=bs.QCState(), name='qcsmoothVolFALaunch')
-                qcsmoothVolFALaunch.inputs.prefix = statesDir
-                qcsmoothVolFALaunch.inputs.stagenum = stageNumDict['SMOOTHVOLFA']
-                qcsmoothVolFALaunch.inputs.state = launched
-
-                qcsmoothVolMDLaunch = pe.Node(interface=bs.QCState(), name='qcsmoothVolMDLaunch')
-                qcsmoothVolMDLaunch.inputs.prefix = statesDir
-                qcsmoothVolMDLaunch.inputs.stagenum = stageNumDict['SMOOTHVOLMD']
-                qcsmoothVolMDLaunch.inputs.state = launched
-
-                qcsmoothVolAxialLaunch = pe.Node(interface=bs.QCState(), name='qcsmoothVolAxialLaunch')
-                qcsmoothVolAxialLaunch.inputs.prefix = statesDir
-                qcsmoothVolAxialLaunch.inputs.stagenum = stageNumDict['SMOOTHVOLAXIAL']
-                qcsmoothVolAxialLaunch.inputs.state = launched
-
-                qcsmoothVolRadialLaunch = pe.Node(interface=bs.QCState(), name='qcsmoothVolRadialLaunch')
-                qcsmoothVolRadialLaunch.inputs.prefix = statesDir
-                qcsmoothVolRadialLaunch.inputs.stagenum = stageNumDict['SMOOTHVOLRADIAL']
-                qcsmoothVolRadialLaunch.inputs.state = launched
-
-                qcsmoothVolmADCLaunch = pe.Node(interface=bs.QCState(), name='qcsmoothVolmADCLaunch')
-                qcsmoothVolmADCLaunch.inputs.prefix = statesDir
-                qcsmoothVolmADCLaunch.inputs.stagenum = stageNumDict['SMOOTHVOLMADC']
-                qcsmoothVolmADCLaunch.inputs.state = launched
-
-                qcsmoothVolFRT_GFALaunch = pe.Node(interface=bs.QCState(), name='qcsmoothVolFRT_GFALaunch')
-                qcsmoothVolFRT_GFALaunch.inputs.prefix = statesDir
-                qcsmoothVolFRT_GFALaunch.inputs.stagenum = stageNumDict['SMOOTHVOLFRTGFA']
-                qcsmoothVolFRT_GFALaunch.inputs.state = launched
-
-                brainsuite_workflow.connect(applyMapFAObj, 'mappedFile', qcsmoothVolFALaunch, 'Run')
-                brainsuite_workflow.connect(applyMapMDObj, 'mappedFile', qcsmoothVolMDLaunch, 'Run')
-                brainsuite_workflow.connect(applyMapAxialObj, 'mappedFile', qcsmoothVolAxialLaunch, 'Run')
-                brainsuite_workflow.connect(applyMapRadialObj, 'mappedFile', qcsmoothVolRadialLaunch, 'Run')
-                brainsuite_workflow.connect(applyMapmADCObj, 'mappedFile', qcsmoothVolmADCLaunch, 'Run')
-                brainsuite_workflow.connect(applyMapFRT_GFAObj, 'mappedFile', qcsmoothVolFRT_GFALaunch, 'Run')
-
-                qcsmoothVolFA = pe.Node(interface=bs.QCState(), name='qcsmoothVolFA')
-                qcsmoothVolFA.inputs.prefix = statesDir
-                qcsmoothVolFA.inputs.stagenum = stageNumDict['SMOOTHVOLFA']
-                qcsmoothVolFA.inputs.state = completed
-
-                qcsmoothVolMD = pe.Node(interface=bs.QCState(), name='qcsmoothVolMD')
-                qcsmoothVolMD.inputs.prefix = statesDir
-                qcsmoothVolMD.inputs.stagenum = stageNumDict['SMOOTHVOLMD']
-                qcsmoothVolMD.inputs.state = completed
-
-                qcsmoothVolAxial = pe.Node(interface=bs.QCState(), name='qcsmoothVolAxial')
-                qcsmoothVolAxial.inputs.prefix = statesDir
-                qcsmoothVolAxial.inputs.stagenum = stageNumDict['SMOOTHVOLAXIAL']
-                qcsmoothVolAxial.inputs.state = completed
-
-                qcsmoothVolRadial = pe.Node(interface=bs.QCState(), name='qcsmoothVolRadial')
-                qcsmoothVolRadial.inputs.prefix = statesDir
-                qcsmoothVolRadial.inputs.stagenum = stageNumDict['SMOOTHVOLRADIAL']
-                qcsmoothVolRadial.inputs.state = completed
-
-                qcsmoothVolmADC = pe.Node(interface=bs.QCState(), name='qcsmoothVolmADC')
-                qcsmoothVolmADC.inputs.prefix = statesDir
-                qcsmoothVolmADC.inputs.stagenum = stageNumDict['SMOOTHVOLMADC']
-                qcsmoothVolmADC.inputs.state = completed
-
-                qcsmoothVolFRT_GFA = pe.Node(interface=bs.QCState(), name='qcsmoothVolFRT_GFA')
-                qcsmoothVolFRT_GFA.inputs.prefix = statesDir
-                qcsmoothVolFRT_GFA.inputs.stagenum = stageNumDict['SMOOTHVOLFRTGFA']
-                qcsmoothVolFRT_GFA.inputs.state = completed
-
-                brainsuite_workflow.connect(smoothVolFAObj, 'smoothFile', qcsmoothVolFA, 'Run')
-                brainsuite_workflow.connect(smoothVolMDObj, 'smoothFile', qcsmoothVolMD, 'Run')
-                brainsuite_workflow.connect(smoothVolAxialObj, 'smoothFile', qcsmoothVolAxial, 'Run')
-                brainsuite_workflow.connect(smoothVolRadialObj, 'smoothFile', qcsmoothVolRadial, 'Run')
-                brainsuite_workflow.connect(smoothVolmADCObj, 'smoothFile', qcsmoothVolmADC, 'Run')
-                brainsuite_workflow.connect(smoothVolFRT_GFAObj, 'smoothFile', qcsmoothVolFRT_GFA, 'Run')
-
-                stagesRun.update({
-                    'APPLYMAPFA' :stageNumDict['APPLYMAPFA'],
-                    'APPLYMAPMD' :stageNumDict['APPLYMAPMD'],
-                    'APPLYMAPAXIAL' :stageNumDict['APPLYMAPAXIAL'],
-                    'APPLYMAPRADIAL':stageNumDict['APPLYMAPRADIAL'],
-                    'APPLYMAPMADC':stageNumDict['APPLYMAPMADC'],
-                    'APPLYMAPFRTGFA':stageNumDict['APPLYMAPFRTGFA'],
-                    'SMOOTHVOLFA':stageNumDict['SMOOTHVOLFA'],
-                    'SMOOTHVOLMD':stageNumDict['SMOOTHVOLMD'],
-                    'SMOOTHVOLAXIAL':stageNumDict['SMOOTHVOLAXIAL'],
-                    'SMOOTHVOLRADIAL':stageNumDict['SMOOTHVOLRADIAL'],
-                    'SMOOTHVOLMADC':stageNumDict['SMOOTHVOLMADC'],
-                    'SMOOTHVOLFRTGFA':stageNumDict['SMOOTHVOLFRTGFA']
-                })
+            # ====Apply map and smooth vol stages, one per diffusion measure (see workflows/stageTable.py)====
+            stageNodes.update(self.addStages(brainsuite_workflow, SVREG_BDP_STAGES, context, nodes))
 
         if 'BFP' in STAGES:
             bfpInputBase = anat + os.sep + SUBJECT_ID + '_T1w'
@@ -1354,21 +675,42 @@ class subjLevelProcessing(object):
             if not os.path.exists(func):
                 os.makedirs(func)
 
+            BFP_SUFFIXES = {'SSIMpng': '.mc.ssim.png', 'MCOpng': '.mco.png', 'Func2T1': '.example.func2t1.nii.gz',
+                            'GOrdmat': '.32k.GOrd.mat', 'GOrdFiltmat': '.32k.GOrd.filt.mat'}
+            # bfp.sh has no T1-only mode: it processes the T1 (anat/, and the SCB file of tNLM filtering) on its
+            # first run and skips the steps whose outputs exist on later runs. The first task therefore runs alone
+            # and does the shared T1 processing once; the other tasks then run concurrently, each in its own
+            # study folder func/<session>/<subject>/, whose anat/ links to the subject's anat/ and whose func/
+            # is its own. Their outputs are then linked into the subject's func/ folder.
             BFPObjs = []
             for task in range(len(BFP['sess'])):
                 taskname = BFP['sess'][task].split('task-')[-1]
+                studydir = BFP['studydir']
+                if task > 0:
+                    studydir = func + BFP['sess'][task]
+                    taskAnat = os.path.join(studydir, BFP['subjID'], 'anat')
+                    if not os.path.lexists(taskAnat):
+                        if not os.path.exists(os.path.dirname(taskAnat)):
+                            os.makedirs(os.path.dirname(taskAnat))
+                        os.symlink(os.path.join('..', '..', '..', 'anat'), taskAnat)
                 BFPObjs.append(pe.Node(interface=bs.BFP(), name='BFP_{0}'.format(taskname)))
                 BFPObjs[task].inputs.configini = str(BFP['configini'])
                 BFPObjs[task].inputs.t1file = os.path.join(anat, t1)
                 BFPObjs[task].inputs.fmrifile = BFP['func'][task]
-                BFPObjs[task].inputs.studydir = BFP['studydir']
+                BFPObjs[task].inputs.studydir = studydir
                 BFPObjs[task].inputs.subjID = BFP['subjID']
                 BFPObjs[task].inputs.session = BFP['sess'][task]
                 BFPObjs[task].inputs.TR = BFP['TR']
-
-            if len(BFP['sess']) > 1:
-                for task in range(len(BFP['func'])-1):
-                    brainsuite_workflow.connect(BFPObjs[task], BFPoutput, BFPObjs[int(task+1)], 'dataSinkDelay')
+                # BFP is complete once all of its tasks are
+                stageNodes['BFP_{0}'.format(taskname)] = 'BFP'
+                if task > 0:
+                    brainsuite_workflow.connect(BFPObjs[0], BFPoutput, BFPObjs[task], 'dataSinkDelay')
+                    BFPPrefix = func + BFP['subjID'] + '_' + BFP['sess'][task] + '_bold'
+                    for output in ['SSIMpng', 'MCOpng', 'Func2T1', BFPoutput]:
+                        copyBFPObj = pe.Node(interface=bs.copyFile(), name='Copy{0}_{1}'.format(output, taskname))
+                        copyBFPObj.inputs.outFile = BFPPrefix + BFP_SUFFIXES[output]
+                        brainsuite_workflow.connect(BFPObjs[task], output, copyBFPObj, 'inFile')
+                        stageNodes['Copy{0}_{1}'.format(output, taskname)] = 'BFP'
 
             if 'QC' in STAGES:
                 pvcLabel = anat + SUBJECT_ID + '_T1w.pvc.label.nii.gz'
@@ -1376,17 +718,9 @@ class subjLevelProcessing(object):
                 makeMaskBFPpvcObj.inputs.fileNameAndROIs = ' '.join([pvcLabel, "1", "2", "4", "5", "6"])
 
                 if 'SVREG' in STAGES:
-                    qcBFPLaunch = pe.Node(interface=bs.QCState(), name='qcBFPLaunch')
-                    qcBFPLaunch.inputs.prefix = statesDir
-                    qcBFPLaunch.inputs.stagenum = stageNumDict['BFP']
-                    qcBFPLaunch.inputs.state = launched
-                    brainsuite_workflow.connect(thick2atlasObj, 'atlasSurfRightFile', qcBFPLaunch, 'Run')
                     brainsuite_workflow.connect(thick2atlasObj, 'atlasSurfRightFile', makeMaskBFPpvcObj, "Run")
                 elif 'CSE' in STAGES:
-                    brainsuite_workflow.connect(pvcObj, 'outputLabelFile', makeMaskBFPpvcObj, "Run")
-                else:
-                    qcstateInitObj.inputs.stagenum = stageNumDict['BFP']
-                    brainsuite_workflow.connect(qcstateInitObj, 'OutStateFile', makeMaskBFPpvcObj, "Run")
+                    brainsuite_workflow.connect(nodes['PVC'], 'outputLabelFile', makeMaskBFPpvcObj, "Run")
 
                 brainsuite_workflow.connect(makeMaskBFPpvcObj, 'OutFile', BFPObjs[0], 'dataSinkDelay')
 
@@ -1409,45 +743,125 @@ class subjLevelProcessing(object):
                     brainsuite_workflow.connect(BFPObjs[task], 'MCOpng', copyMCOObjs[task], "inFile")
 
                     # Func2T1 with PVC label mask
-                    volbendFunc2T1Objs.append(pe.Node(interface=bs.Volslice(), name='volblendFunc2T1_{0}'.format(taskname)))
-                    volbendFunc2T1Objs[task].inputs.outFile = '{0}/Func2T1{1}.png'.format(WEBPATH, task)
-                    volbendFunc2T1Objs[task].inputs.view = 1  # axial
+                    volbendFunc2T1Objs.append(pe.Node(interface=bs.VolsliceBatch(),
+                                                      name='volblendFunc2T1_{0}'.format(taskname)))
+                    volbendFunc2T1Objs[task].inputs.views = [{'outFile': '{0}/Func2T1{1}.png'.format(WEBPATH, task),
+                                                              'view': 1}] # axial
 
                     ### Connect rendering to BFP ####
                     brainsuite_workflow.connect(makeMaskBFPpvcObj, 'OutFile', volbendFunc2T1Objs[task], 'maskFile')
                     brainsuite_workflow.connect(BFPObjs[task], 'Func2T1', volbendFunc2T1Objs[task], 'inFile')
 
-                qcstateBFP = pe.Node(interface=bs.QCState(), name='qcstateBFP')
-                qcstateBFP.inputs.prefix = statesDir
-                qcstateBFP.inputs.stagenum = stageNumDict['BFP']
-                qcstateBFP.inputs.state = completed
-
-                ### Connect QC to BFP ####
-                brainsuite_workflow.connect(BFPObjs[-1], BFPoutput, qcstateBFP, 'Run')
-
-                stagesRun.update({
-                    'BFP_{0}'.format(BFP['sess'][task].split('task-')[-1]): stageNumDict['BFP']
-                })
-
-        brainsuite_workflow_return = \
-        brainsuite_workflow.run(plugin='MultiProc', plugin_args={'n_procs': int(os.environ['NCPUS']),
-                                                                 'memory_gb': int(os.environ['MAXMEM'])},
-                                updatehash=False)
-        # brainsuite_workflow.write_graph()
-        if 'QC' in STAGES:
-            err = False
-            nodes = list(brainsuite_workflow_return.nbunch_iter())
-            for node in range(0,len(nodes)):
-                if nodes[node].name in stagesRun:
-                    rc = nodes[node].result.runtime.returncode
-                    if rc != 0:
-                        err = True
-                        stagenum = stagesRun[nodes[node].name]
-                        cmd = [QCSTATE, statesDir, str(stagenum), errored]
-                        subprocess.call(' '.join(cmd), shell=True)
-            if err:
-                print('Processing for subject %s has completed with error(s). Nipype workflow is located at: %s' % (
-                SUBJECT_ID, WORKFLOW_BASE_DIRECTORY))
-            else:
-                print('Processing for subject %s has completed successfully. Nipype workflow is located at: %s' % (
-                SUBJECT_ID, WORKFLOW_BASE_DIRECTORY))
+        self.statesDir = statesDir
+        self.stageNodes = stageNodes
+        self.setResources(brainsuite_workflow)
+        self.setEventLog(brainsuite_workflow)
+        self.buildStats = {'nodes': brainsuite_workflow._graph.number_of_nodes(),
+                           'edges': brainsuite_workflow._graph.number_of_edges(),
+                           'seconds': time.time() - buildStart}
+        print('Built the workflow of {0}: {1} nodes, {2} edges in {3:.2f} s.'.format(
+            SUBJECT_ID, self.buildStats['nodes'], self.buildStats['edges'], self.buildStats['seconds']))
+        return brainsuite_workflow
+
+    def addStages(self, brainsuite_workflow, table, context, nodes, skip=()):
+        '''
+        Adds the nodes of a stage table (see workflows/stageTable.py) to the workflow, with their connections
+        and, with QC, their QC renders. nodes maps the names of the nodes already in the workflow to the nodes
+        and is updated. Returns {node name: stage} of the stage nodes that were added.
+        '''
+        stageNodes = {}
+        for entry in table:
+            if entry['stage'] in skip:
+                continue
+            self.addNode(brainsuite_workflow, entry, context, nodes)
+            stageNodes[entry['node']] = entry['stage']
+            if 'QC' in self.stages:
+                for render in entry.get('renders', []):
+                    self.addNode(brainsuite_workflow, render, context, nodes)
+        return stageNodes
+
+    def addNode(self, brainsuite_workflow, entry, context, nodes):
+        '''
+        Creates the node of a stage table entry, sets its inputs and connects it to its sources.
+        '''
+        node = pe.Node(interface=getattr(bs, entry['interface'])(), name=entry['node'])
+        for name in entry.get('parameters', []):
+            setattr(node.inputs, name, getattr(self, name))
+        for name, value in entry.get('inputs', {}).items():
+            setattr(node.inputs, name, expand(value, context))
+        brainsuite_workflow.add_nodes([node])
+        for connection in entry.get('connect', []):
+            source, output, name = expand(connection[:3], context)
+            if source in nodes:
+                brainsuite_workflow.connect(nodes[source], output, node, name)
+            elif len(connection) > 3:
+                # the source stage is not run (e.g. noBSE, or completed on resume); read its output from disk
+                setattr(node.inputs, name, expand(connection[3], context))
+        nodes[entry['node']] = node
+        return node
+
+    def registerHooks(self, hooks, brainsuite_workflow):
+        '''
+        Registers the stage nodes of the built workflow, and the stages that depend on each node, with the QC
+        state hooks of the run (see workflows/stateHooks.py).
+        '''
+        graph = brainsuite_workflow._graph
+        downstream = {}
+        for node in graph.nodes():
+            stages = set([self.stageNodes[descendant.name] for descendant in nx.descendants(graph, node)
+                          if descendant.name in self.stageNodes])
+            stages.discard(self.stageNodes.get(node.name))
+            downstream[node.name] = sorted(stages)
+        hooks.register(brainsuite_workflow.name, self.statesDir, self.stageNodes, downstream)
+
+    def setResources(self, brainsuite_workflow):
+        '''
+        Sets the memory and number of threads of each node from the resource profiles of the BrainSuite
+        interfaces, clamped to --ncpus and --maxmem so that MultiProc can schedule every node. With a cluster
+        plugin, the heavy nodes are submitted as batch jobs requesting their (unclamped) profile instead
+        (see workflows/executionPlugin.py).
+        '''
+        ncpus = int(os.environ['NCPUS'])
+        maxmem = float(os.environ['MAXMEM'])
+        for node in brainsuite_workflow._get_all_nodes():
+            profile = bs.resourceProfile(type(node.interface).__name__, node.name, self.resources)
+            if profile is not None:
+                if node.name == 'SVREG' and self.singleThread:
+                    profile['n_procs'] = 1
+                numThreads = getattr(node.inputs, 'num_threads', Undefined)
+                if isdefined(numThreads):
+                    # e.g. Eddy runs the threads of the preprocspec (eddy_num_threads)
+                    profile['n_procs'] = max(int(profile['n_procs']), int(numThreads))
+                # the n_procs setter also sets num_threads, so a threaded interface uses the slots it reserves
+                node.n_procs = max(1, min(int(profile['n_procs']), ncpus))
+                node._mem_gb = min(float(profile['mem_gb']), maxmem)
+            setSubmission(node, profile)
+
+    def setEventLog(self, brainsuite_workflow):
+        '''
+        Makes the BrainSuite commands of the workflow append an event to the subject's events.jsonl when they
+        end (see workflows/runtimeProfile.py), which the BrainSuite Dashboard summarizes (see QC/watchStates.py).
+        The variables are set in the environment of the nodes, which is neither part of their nipype hash nor
+        of their key in the global node cache (see workflows/nodeCache.hashedInputs), so that cached nodes
+        are unaffected and can still be shared between subjects.
+        '''
+        environ = {EVENT_LOG_ENV: os.path.join(self.workflowBaseDirectory, EVENTS_FILE),
+                   EVENT_SUBJECT_ENV: self.subjectID}
+        for node in brainsuite_workflow._get_all_nodes():
+            if isinstance(node.interface, bs.BrainSuiteCommandLine):
+                node.inputs.environ = dict(node.inputs.environ, **environ)
+
+    def updateStates(self, nodes, failedStages):
+        '''
+        Writes the subject's timings.json/.tsv and records the stage groups that ran without errors in the
+        completion manifest, given the executed nodes of this subject's workflow and the stages that failed or
+        were blocked by a failure. The QC states were recorded while the workflow ran (see workflows/stateHooks.py).
+        '''
+        writeTimings(self.workflowBaseDirectory, nodes)
+        self.recordStages(failedStages)
+        if len(failedStages) > 0:
+            print('Processing for subject %s has completed with error(s) in %s. Nipype workflow is located at: %s' % (
+            self.subjectID, ', '.join(failedStages), self.workflowBaseDirectory))
+        else:
+            print('Processing for subject %s has completed successfully. Nipype workflow is located at: %s' % (
+            self.subjectID, self.workflowBaseDirectory))
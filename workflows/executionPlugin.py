@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import math
+
+# environment variables set by run.py (--plugin, --clusterArgs)
+PLUGIN_ENV = 'BRAINSUITE_PLUGIN'
+CLUSTER_ARGS_ENV = 'BRAINSUITE_CLUSTER_ARGS'
+
+# nipype execution plugins: MultiProc runs the nodes in parallel on this machine, Linear one at a time in this
+# process; SLURM and SGE submit the heavy nodes as batch jobs (sbatch/squeue, qsub/qstat)
+PLUGINS = ['MultiProc', 'SLURM', 'SGE', 'Linear']
+CLUSTER_PLUGINS = {'SLURM': 'sbatch_args', 'SGE': 'qsub_args'}
+# commands that must be available to submit jobs (see workflows/localScheduler for a stand-in of SLURM)
+SUBMIT_COMMANDS = {'SLURM': 'sbatch', 'SGE': 'qsub'}
+
+# interfaces run as their own batch job with a cluster plugin; every other node (CSE, QC renders, ...) runs in
+# the process that runs the workflow. A resource profile (see RESOURCE_PROFILES in nipype/brainsuite) can
+# change this with 'submit', e.g. {"ThicknessPVC": {"submit": true}}.
+SUBMITTED_INTERFACES = ['SVReg', 'BDP', 'Eddy', 'BFP']
+
+def pluginName():
+    return os.environ.get(PLUGIN_ENV, 'MultiProc')
+
+def pluginSettings(hooks):
+    '''
+    Returns the plugin and plugin_args of the workflow run; hooks is the status callback of the run
+    (see workflows/stateHooks.py).
+    '''
+    plugin = pluginName()
+    if plugin == 'MultiProc':
+        plugin_args = {'n_procs': int(os.environ['NCPUS']),
+                       'memory_gb': int(os.environ['MAXMEM'])}
+    elif plugin in CLUSTER_PLUGINS:
+        clusterArgs = os.environ.get(CLUSTER_ARGS_ENV, '')
+        if plugin == 'SGE':
+            # jobs run with the environment of the BIDS App (MCR cache, global cache, ...)
+            clusterArgs = ' '.join(['-V', clusterArgs]).strip()
+        plugin_args = {CLUSTER_PLUGINS[plugin]: clusterArgs}
+    else:
+        plugin_args = {}
+    plugin_args['status_callback'] = hooks
+    return plugin, plugin_args
+
+def jobArgs(plugin, profile):
+    '''
+    Scheduler options requesting the memory and cpus of a resource profile, followed by its own
+    sbatch_args/qsub_args if any.
+    '''
+    memMB = int(math.ceil(float(profile['mem_gb']) * 1024))
+    n_procs = max(1, int(profile['n_procs']))
+    if plugin == 'SLURM':
+        args = '--mem={0}M --cpus-per-task={1}'.format(memMB, n_procs)
+    else:
+        # SGE memory limits are per slot
+        args = '-l h_vmem={0}M'.format(int(math.ceil(float(memMB) / n_procs)))
+        if n_procs > 1:
+            args += ' -pe smp {0}'.format(n_procs)
+    extra = profile.get(CLUSTER_PLUGINS[plugin])
+    if extra:
+        args += ' ' + extra
+    return args
+
+def setSubmission(node, profile, plugin=None):
+    '''
+    With a cluster plugin, marks a node to be submitted as a batch job sized from its resource profile, or to
+    run in the process that runs the workflow. profile is None for nodes without one (e.g. Function nodes).
+    '''
+    plugin = plugin or pluginName()
+    if plugin not in CLUSTER_PLUGINS:
+        return
+    submit = profile is not None and profile.get('submit', type(node.interface).__name__ in SUBMITTED_INTERFACES)
+    if not submit:
+        node.run_without_submitting = True
+        return
+    node.run_without_submitting = False
+    # added to the --clusterArgs of the run
+    node.plugin_args = {CLUSTER_PLUGINS[plugin]: jobArgs(plugin, profile), 'overwrite': False}
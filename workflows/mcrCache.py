@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import sys
+import fcntl
+import socket
+import subprocess
+
+# environment variable with the root of a shared (e.g. pre-warmed in the container) MATLAB Runtime cache;
+# overridden by run.py --mcrCacheRoot
+MCR_CACHE_ENV = 'BRAINSUITE_MCR_CACHE'
+# folder of the markers of the tools whose runtime components have been extracted in a cache
+WARMED_DIR = '.warmed'
+# seconds allowed for a tool to extract its components and print its usage
+WARM_TIMEOUT = 600
+# the compiled MATLAB tools of BrainSuite (nipype/brainsuite)
+MATLAB_TOOLS = ['svreg.sh', 'bdp.sh', 'thicknessPVC.sh', 'svreg_thickness2atlas.sh', 'svreg_smooth_surf_function.sh',
+                'svreg_apply_map.sh', 'svreg_smooth_vol_function.sh', 'generate_stats_xls.sh', 'bfp.sh']
+
+def mcrCacheRoot(outputDir, cacheRoot=None):
+    '''
+    Returns the MCR_CACHE_ROOT shared by the subjects processed on this machine: cacheRoot (run.py
+    --mcrCacheRoot) or $BRAINSUITE_MCR_CACHE if set, otherwise output_dir/.mcrCache/<host name>. The folder is
+    created if needed.
+    '''
+    root = cacheRoot or os.environ.get(MCR_CACHE_ENV)
+    if not root:
+        root = os.path.join(outputDir, '.mcrCache', socket.gethostname())
+    root = os.path.abspath(root)
+    if not os.path.exists(root):
+        try:
+            os.makedirs(root)
+        except OSError:
+            # created by another process
+            pass
+    return root
+
+def warmTool(cacheRoot, command, environ=None):
+    '''
+    Runs a compiled MATLAB tool without arguments, under an exclusive lock of the cache, the first time it is
+    used with cacheRoot, so that the MATLAB Runtime extracts its components once instead of concurrently in
+    every subject. Later calls only check a marker.
+    '''
+    marker = os.path.join(cacheRoot, WARMED_DIR, command)
+    if os.path.exists(marker):
+        return
+    try:
+        if not os.path.exists(os.path.dirname(marker)):
+            os.makedirs(os.path.dirname(marker))
+        with open(os.path.join(cacheRoot, '.{0}.lock'.format(command)), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(marker):
+                    return
+                env = dict(os.environ if environ is None else environ)
+                env['MCR_CACHE_ROOT'] = cacheRoot
+                with open(os.devnull, 'w') as devnull:
+                    subprocess.call([command], env=env, stdout=devnull, stderr=devnull, timeout=WARM_TIMEOUT)
+                open(marker, 'w').close()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    except (IOError, OSError, subprocess.TimeoutExpired) as e:
+        # the tool extracts its components itself when it runs
+        sys.stdout.write('Could not warm the MATLAB Runtime cache {0} for {1} ({2}).\n'.format(cacheRoot, command, e))
+
+def warmCache(cacheRoot, tools=MATLAB_TOOLS):
+    '''
+    Extracts the runtime components of the compiled MATLAB tools into cacheRoot, e.g. when building a
+    container with a pre-warmed cache (see $BRAINSUITE_MCR_CACHE).
+    '''
+    for command in tools:
+        print('Warming the MATLAB Runtime cache {0} for {1}...'.format(cacheRoot, command))
+        warmTool(cacheRoot, command)
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stdout.write('Usage: python -m workflows.mcrCache <MCR cache root>\n')
+        sys.exit(2)
+    warmCache(mcrCacheRoot(None, sys.argv[1]))
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import json
+import time
+import fcntl
+import hashlib
+
+# environment variables set by run.py (--globalCache, --globalCacheSizeGB)
+CACHE_ENV = 'BRAINSUITE_GLOBAL_CACHE'
+CACHE_SIZE_ENV = 'BRAINSUITE_GLOBAL_CACHE_GB'
+DEFAULT_SIZE_GB = 50
+# bumped when the layout of the cache or the key computation changes
+CACHE_FORMAT = 2
+
+def hashedInputs(inputs, ignored=()):
+    '''
+    Inputs of a node (its nipype input spec) that identify its execution: those that are defined and part of
+    nipype's hash, except ignored (e.g. inputs that only order the execution). nohash inputs such as environ,
+    which holds the subject's event log (see subjLevelProcessing.setEventLog), are left out.
+    '''
+    from nipype.interfaces.base import isdefined
+    return dict((name, value) for name, value in inputs.get().items()
+                if isdefined(value) and name not in ignored and not inputs.trait(name).nohash)
+
+def outputPrefix(outputs):
+    '''
+    Common prefix of the output files of a node, up to the subject's file name stem, e.g.
+    /out/sub-01/anat/sub-01_T1w for /out/sub-01/anat/sub-01_T1w.bse.nii.gz and /out/sub-01/anat/sub-01_T1w.mask.nii.gz.
+    The output files are cached relative to it, so that they do not depend on the subject or output folder.
+    '''
+    directory, name = os.path.split(os.path.commonprefix(sorted(outputs)))
+    return os.path.join(directory, name.split('.')[0])
+
+def sha256sum(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class nodeCache(object):
+    '''
+    Content-addressed cache of node outputs, shared across subjects and runs:
+
+        <root>/objects/<sha256[:2]>/<sha256>   contents of the output files
+        <root>/entries/<key>.json              {output file relative to the output prefix: sha256} of a node
+                                               execution
+
+    The key of a node execution is computed from the interface, its command, the BrainSuite version and its
+    inputs, where each input that names an existing file is replaced by the checksum of the file and each
+    output file by its name relative to the output prefix of the node (see outputPrefix). The key does not
+    depend on paths, so an execution is served to other subjects and to runs whose output or cache folder has
+    moved, under the names of their own outputs. The cache is bounded in size; the least recently used entries
+    are evicted first.
+    '''
+
+    def __init__(self, root, sizeGB=DEFAULT_SIZE_GB):
+        self.root = root
+        self.objectsDir = os.path.join(root, 'objects')
+        self.entriesDir = os.path.join(root, 'entries')
+        self.lockFile = os.path.join(root, 'cache.lock')
+        self.maxBytes = int(float(sizeGB) * 1024 ** 3)
+        self.checksums = {}
+        for directory in [self.objectsDir, self.entriesDir]:
+            if not os.path.exists(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # created by another process
+                    pass
+
+    def checksum(self, filename):
+        st = os.stat(filename)
+        signature = (filename, st.st_size, st.st_mtime)
+        if signature not in self.checksums:
+            self.checksums[signature] = sha256sum(filename)
+        return self.checksums[signature]
+
+    def normalize(self, value, outputs, prefix):
+        '''
+        Replaces the names of existing files in an input value (strings, possibly nested in lists and
+        dictionaries) by their checksums, and the names of output files by their names relative to prefix.
+        Space-separated lists of files are split.
+        '''
+        if isinstance(value, dict):
+            return dict((str(k), self.normalize(v, outputs, prefix)) for k, v in sorted(value.items()))
+        if isinstance(value, (list, tuple)):
+            return [self.normalize(v, outputs, prefix) for v in value]
+        if isinstance(value, str):
+            words = value.split()
+            if len(words) > 0 and all([word in outputs or os.path.isfile(word) for word in words]):
+                return [['output', word[len(prefix):]] if word in outputs else ['file', self.checksum(word)]
+                        for word in words]
+        return value
+
+    def key(self, interfaceName, command, inputs, outputs=()):
+        record = {'format': CACHE_FORMAT,
+                  'interface': interfaceName,
+                  'command': command,
+                  'version': os.environ.get('BrainSuiteVersion'),
+                  'inputs': self.normalize(inputs, set(outputs), outputPrefix(outputs))}
+        return hashlib.sha256(json.dumps(record, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def objectPath(self, checksum):
+        return os.path.join(self.objectsDir, checksum[:2], checksum)
+
+    def entryPath(self, key):
+        return os.path.join(self.entriesDir, key + '.json')
+
+    def locked(self, operation, exclusive=False):
+        '''
+        Runs operation() holding the lock of the cache: shared for restores, exclusive for stores and evictions.
+        '''
+        with open(self.lockFile, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                return operation()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def restore(self, key, outputs, stage):
+        '''
+        Restores the output files of a cached node execution with stage(source, destination), under the names of
+        outputs (the output files of the node being run). Returns False if the execution is not in the cache.
+        '''
+        return self.locked(lambda: self._restore(key, outputPrefix(outputs), stage))
+
+    def _restore(self, key, prefix, stage):
+        entryFile = self.entryPath(key)
+        try:
+            with open(entryFile, 'r') as f:
+                outputs = json.load(f)['outputs']
+        except (IOError, OSError, ValueError):
+            return False
+        if not all([os.path.exists(self.objectPath(checksum)) for checksum in outputs.values()]):
+            return False
+        for relativeName, checksum in outputs.items():
+            filename = prefix + relativeName
+            if os.path.exists(filename) and self.checksum(filename) == checksum:
+                continue
+            if not os.path.exists(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            stage(self.objectPath(checksum), filename)
+        # least recently used
+        os.utime(entryFile, None)
+        return True
+
+    def store(self, key, outputs, stage):
+        '''
+        Adds the output files of a node execution (those of outputs that exist) to the cache with
+        stage(source, destination), then evicts entries until the cache fits in its size.
+        '''
+        self.locked(lambda: self._store(key, outputs, stage), exclusive=True)
+
+    def _store(self, key, files, stage):
+        prefix = outputPrefix(files)
+        outputs = {}
+        for filename in files:
+            if not os.path.isfile(filename):
+                continue
+            checksum = self.checksum(filename)
+            objectFile = self.objectPath(checksum)
+            if not os.path.exists(objectFile):
+                if not os.path.exists(os.path.dirname(objectFile)):
+                    os.makedirs(os.path.dirname(objectFile))
+                stage(filename, objectFile)
+            outputs[filename[len(prefix):]] = checksum
+        entryFile = self.entryPath(key)
+        tmpFile = '{0}.{1}.tmp'.format(entryFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'outputs': outputs, 'created': time.time()}, f)
+        os.rename(tmpFile, entryFile)
+        self.evict()
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the objects they reference fit in the size of the cache,
+        then removes the objects that are no longer referenced. Called with the exclusive lock held.
+        '''
+        entries = []
+        references = {}
+        for name in os.listdir(self.entriesDir):
+            if not name.endswith('.json'):
+                continue
+            entryFile = os.path.join(self.entriesDir, name)
+            try:
+                with open(entryFile, 'r') as f:
+                    checksums = set(json.load(f)['outputs'].values())
+                entries.append((os.stat(entryFile).st_mtime, entryFile, checksums))
+            except (IOError, OSError, ValueError):
+                continue
+            for checksum in checksums:
+                references[checksum] = references.get(checksum, 0) + 1
+        sizes = {}
+        for directory, _, names in os.walk(self.objectsDir):
+            for name in names:
+                sizes[name] = os.path.getsize(os.path.join(directory, name))
+        total = sum([sizes.get(checksum, 0) for checksum in references])
+        for _, entryFile, checksums in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            os.remove(entryFile)
+            for checksum in checksums:
+                references[checksum] -= 1
+                if references[checksum] == 0:
+                    total -= sizes.get(checksum, 0)
+        for checksum in sizes:
+            if references.get(checksum, 0) == 0:
+                os.remove(self.objectPath(checksum))
+
+def globalCache():
+    '''
+    Returns the global node cache if it is enabled (see run.py --globalCache), otherwise None.
+    '''
+    root = os.environ.get(CACHE_ENV)
+    if not root:
+        return None
+    return nodeCache(root, os.environ.get(CACHE_SIZE_ENV, DEFAULT_SIZE_GB))
@@ -20,14 +20,21 @@ License along with this library; if not, write to the Free Software
 Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 '''
 
-from workflows.brainsuiteWorkflow import subjLevelProcessing
+from workflows.brainsuiteWorkflow import subjLevelProcessing, WORKFLOW_NAME
+from workflows.stateHooks import qcStateHooks
+from workflows.executionPlugin import pluginSettings
+from workflows.runtimeProfile import enableResourceMonitor
+import nipype.pipeline.engine as pe
 import os
 import shutil
 
-def runWorkflow(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout, dwis, funcs,
+COHORT_WORKFLOW_NAME = 'BrainSuiteCohort'
+
+def prepareWorkflows(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout, dwis, funcs,
             subject_label, args):
     '''
-    This function is a wrapper that runs the appropriate pipelines in brainsuiteWorkflow.py.
+    This function sets up the appropriate pipelines in brainsuiteWorkflow.py for each T1w of a subject.
+    Returns a list of (subjLevelProcessing, subjectID, T1w, output directory, BFP parameters).
 
     Authors: Yeun Kim, Jason Wong, Clayton Jerlow
 
@@ -46,6 +53,7 @@ def runWorkflow(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout, dwi
 
 
     assert (len(t1ws) > 0), "No T1w files found for subject %s!" % subject_label
+    processes = []
     for i, t1 in enumerate(t1ws):
         stages_tmp = stages[:]
         subjectID = t1ws[i].split('/')[-1].split('_T1w')[0]
@@ -123,4 +131,64 @@ def runWorkflow(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout, dwi
             process = subjLevelProcessing(stages_tmp, specs=preprocspecs, BDP=dwis[i].split('.')[0],
                                           BVAL=str(bval), BVEC=str(bvec), CACHE=cache, SingleThread=thread,
                                           ATLAS=str(atlas), QCDIR=QCdir)
+        if args.resume:
+            process.resumeStages(subjectID, outputdir, BFP)
+        processes.append((process, subjectID, t1, outputdir, dict(BFP)))
+    return processes
+
+def runWorkflow(stages, t1ws, preprocspecs, atlas, cacheset, thread, layout, dwis, funcs,
+            subject_label, args):
+    '''
+    This function is a wrapper that runs the appropriate pipelines in brainsuiteWorkflow.py,
+    one T1w at a time.
+    '''
+    for process, subjectID, t1, outputdir, BFP in prepareWorkflows(stages, t1ws, preprocspecs, atlas, cacheset,
+                                                                   thread, layout, dwis, funcs, subject_label, args):
         process.runWorkflow(subjectID, t1, outputdir, BFP)
+
+def runCohortWorkflow(stages, workUnits, preprocspecs, atlas, cacheset, thread, layout, args):
+    '''
+    Runs the pipelines of all of the work units (see workflows/workUnits.py) as a single nipype execution,
+    so that the --ncpus and --maxmem resources are shared across subjects instead of being used by
+    one subject at a time. Per-subject outputs are unchanged; the nipype working directories of each
+    subject are nested under <cache>/BrainSuiteCohort/.
+    '''
+    cohortBaseDir = args.output_dir
+    if cacheset:
+        cohortBaseDir = args.cache
+    cohort_workflow = pe.Workflow(name=COHORT_WORKFLOW_NAME)
+    cohort_workflow.base_dir = cohortBaseDir
+    cohort_workflow.config['execution']['crashdump_dir'] = os.path.join(cohortBaseDir, COHORT_WORKFLOW_NAME)
+    cohort_workflow.config['execution']['crashfile_format'] = 'txt'
+
+    subjectWorkflows = {}
+    hooks = qcStateHooks()
+    for unit in workUnits:
+        for process, subjectID, t1, outputdir, BFP in prepareWorkflows(stages, unit['t1ws'], preprocspecs, atlas,
+                                                                       cacheset, thread, layout, unit['dwis'],
+                                                                       unit['funcs'], unit['subject_label'], args):
+            workflowName = '{0}_{1}'.format(WORKFLOW_NAME, subjectID)
+            if workflowName in subjectWorkflows:
+                print('{0} has already been added to the cohort workflow. Skipping.'.format(subjectID))
+                continue
+            subject_workflow = process.buildWorkflow(subjectID, t1, outputdir, BFP, workflowName=workflowName)
+            cohort_workflow.add_nodes([subject_workflow])
+            process.registerHooks(hooks, subject_workflow)
+            subjectWorkflows[workflowName] = process
+
+    if len(subjectWorkflows) == 0:
+        return
+    plugin, plugin_args = pluginSettings(hooks)
+    enableResourceMonitor()
+    if plugin == 'MultiProc':
+        print('Running {0} subject workflow(s) with {1} cpus and {2} GB of memory shared across subjects.\n'.format(
+            len(subjectWorkflows), os.environ['NCPUS'], os.environ['MAXMEM']))
+    else:
+        print('Running {0} subject workflow(s) with the {1} plugin.\n'.format(len(subjectWorkflows), plugin))
+    try:
+        cohort_workflow.run(plugin=plugin, plugin_args=plugin_args, updatehash=False)
+    finally:
+        # the hooks map the executed nodes back to the subject workflow they belong to, also when a node raised
+        # and nipype reports that the cohort workflow did not execute cleanly
+        for workflowName, process in subjectWorkflows.items():
+            process.updateStates(hooks.executedNodes(workflowName), hooks.failedStages(workflowName))
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import json
+import fcntl
+from glob import glob
+from datetime import datetime
+
+TIMINGS_FILE = 'timings'
+COHORT_TIMINGS_FILE = 'cohortTimings'
+FIELDS = ['node', 'interface', 'wall_time_s', 'cpu_time_s', 'max_rss_mb', 'read_bytes', 'written_bytes',
+          'returncode']
+COHORT_FIELDS = ['node', 'interface', 'count', 'total_wall_time_s', 'mean_wall_time_s', 'max_wall_time_s',
+                 'total_cpu_time_s', 'max_rss_mb', 'read_bytes', 'written_bytes']
+# log of the BrainSuite commands run for a subject, one JSON event per line, in the subject's output folder
+EVENTS_FILE = 'events.jsonl'
+# set on the BrainSuite command nodes of a subject (see subjLevelProcessing.setEventLog); read by
+# BrainSuiteCommandLine (see nipype/brainsuite)
+EVENT_LOG_ENV = 'BRAINSUITE_EVENT_LOG'
+EVENT_SUBJECT_ENV = 'BRAINSUITE_EVENT_SUBJECT'
+
+def enableResourceMonitor():
+    '''
+    Turns on nipype's resource monitor for the nodes run from now on, also in the batch jobs of the cluster
+    plugins (the setting is part of the node configuration). It samples the memory of the process tree of
+    each node (runtime.mem_peak_gb), which is the peak memory reported for the node and its command. It needs
+    psutil; without it, nipype warns and the peak memory is only known when getrusage can attribute it.
+    '''
+    from nipype import config
+    config.enable_resource_monitor()
+
+def nodeTimings(nodes):
+    '''
+    Collects the runtime of the executed nodes of a workflow. Wall time and peak memory are measured by nipype
+    (see enableResourceMonitor); CPU time and I/O are those recorded by BrainSuiteCommandLine (see
+    nipype/brainsuite) and are left empty for other interfaces.
+    '''
+    rows = []
+    for node in nodes:
+        try:
+            runtime = getattr(node.result, 'runtime', None)
+        except (IOError, OSError, AttributeError):
+            # a node that raised before saving its result
+            runtime = None
+        if runtime is None:
+            continue
+        rusage = getattr(runtime, 'rusage', {}) or {}
+        row = {'node': node.name,
+               'interface': type(node.interface).__name__,
+               'wall_time_s': getattr(runtime, 'duration', None),
+               'cpu_time_s': rusage.get('cpu_time_s'),
+               'max_rss_mb': rusage.get('max_rss_mb'),
+               'read_bytes': rusage.get('read_bytes'),
+               'written_bytes': rusage.get('written_bytes'),
+               'returncode': getattr(runtime, 'returncode', None)}
+        # nipype's own resource monitor, if it was enabled, measures the memory of the process tree
+        if getattr(runtime, 'mem_peak_gb', None) is not None:
+            row['max_rss_mb'] = runtime.mem_peak_gb * 1024
+        rows.append(row)
+    return sorted(rows, key=lambda row: -(row['wall_time_s'] or 0))
+
+def commandEvent(interface, runtime, start, end, subject=None):
+    '''
+    Describes a BrainSuite command that has run: its command line, node (the name of its working folder),
+    subject, start and end times, wall and CPU time, peak memory (from nipype's resource monitor if enabled),
+    I/O of the children of the nipype worker (see BrainSuiteCommandLine._run_interface), return code and
+    size of its standard output.
+    '''
+    rusage = getattr(runtime, 'rusage', {}) or {}
+    stdout = getattr(runtime, 'stdout', None) or ''
+    maxRSS = rusage.get('max_rss_mb')
+    if getattr(runtime, 'mem_peak_gb', None) is not None:
+        maxRSS = runtime.mem_peak_gb * 1024
+    return {'cmd': getattr(runtime, 'cmdline', None) or interface.cmdline,
+            'node': os.path.basename(os.path.normpath(runtime.cwd)) if getattr(runtime, 'cwd', None) else None,
+            'interface': type(interface).__name__,
+            'subject': subject,
+            'host': getattr(runtime, 'hostname', None),
+            'start': datetime.fromtimestamp(start).astimezone().isoformat(timespec='milliseconds'),
+            'end': datetime.fromtimestamp(end).astimezone().isoformat(timespec='milliseconds'),
+            'wall_time_s': end - start,
+            'cpu_time_s': rusage.get('cpu_time_s'),
+            'max_rss_mb': maxRSS,
+            'read_bytes': rusage.get('read_bytes'),
+            'written_bytes': rusage.get('written_bytes'),
+            'returncode': getattr(runtime, 'returncode', None),
+            'stdout_bytes': len(stdout.encode('utf-8')),
+            'cached': bool(getattr(runtime, 'cached', False))}
+
+def appendEvent(eventLog, event):
+    '''
+    Appends event to eventLog as one JSON line, with a single write to the file opened with O_APPEND and under
+    an exclusive lock, so that the events of commands running at the same time (possibly on other hosts of a
+    shared filesystem, where O_APPEND alone is not atomic) are never interleaved.
+    '''
+    line = (json.dumps(event, sort_keys=True) + '\n').encode('utf-8')
+    fd = os.open(eventLog, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.write(fd, line)
+    finally:
+        # also releases the lock
+        os.close(fd)
+
+def writeTable(prefix, rows, fields):
+    '''
+    Writes rows as <prefix>.json and <prefix>.tsv.
+    '''
+    for extension in ['json', 'tsv']:
+        filename = '{0}.{1}'.format(prefix, extension)
+        tmpFile = '{0}.{1}.tmp'.format(filename, os.getpid())
+        with open(tmpFile, 'w') as f:
+            if extension == 'json':
+                json.dump(rows, f, indent=1)
+            else:
+                f.write('\t'.join(fields) + '\n')
+                for row in rows:
+                    f.write('\t'.join(['' if row.get(field) is None else str(row[field])
+                                       for field in fields]) + '\n')
+        os.rename(tmpFile, filename)
+
+def writeTimings(outputdir, nodes):
+    rows = nodeTimings(nodes)
+    writeTable(os.path.join(outputdir, TIMINGS_FILE), rows, FIELDS)
+    return rows
+
+def writeCohortReport(output_dir):
+    '''
+    Aggregates the timings of all subjects in output_dir by node and writes <output_dir>/cohortTimings.json
+    and .tsv, ordered by total wall time. Returns the aggregated rows.
+    '''
+    stats = {}
+    for timingsFile in sorted(glob(os.path.join(output_dir, '*', TIMINGS_FILE + '.json'))):
+        try:
+            with open(timingsFile, 'r') as f:
+                rows = json.load(f)
+        except ValueError:
+            continue
+        for row in rows:
+            entry = stats.setdefault(row['node'], {'node': row['node'], 'interface': row['interface'],
+                                                   'count': 0, 'total_wall_time_s': 0.0, 'max_wall_time_s': 0.0,
+                                                   'total_cpu_time_s': None, 'max_rss_mb': None,
+                                                   'read_bytes': None, 'written_bytes': None})
+            entry['count'] += 1
+            entry['total_wall_time_s'] += row['wall_time_s'] or 0.0
+            entry['max_wall_time_s'] = max(entry['max_wall_time_s'], row['wall_time_s'] or 0.0)
+            if row['cpu_time_s'] is not None:
+                entry['total_cpu_time_s'] = (entry['total_cpu_time_s'] or 0.0) + row['cpu_time_s']
+            if row['max_rss_mb'] is not None:
+                entry['max_rss_mb'] = max(entry['max_rss_mb'] or 0.0, row['max_rss_mb'])
+            for field in ['read_bytes', 'written_bytes']:
+                if row[field] is not None:
+                    entry[field] = (entry[field] or 0) + row[field]
+    rows = sorted(stats.values(), key=lambda entry: -entry['total_wall_time_s'])
+    for entry in rows:
+        entry['mean_wall_time_s'] = entry['total_wall_time_s'] / entry['count']
+    if len(rows) > 0:
+        writeTable(os.path.join(output_dir, COHORT_TIMINGS_FILE), rows, COHORT_FIELDS)
+    return rows
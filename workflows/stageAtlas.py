@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import sys
+import fcntl
+import shutil
+import hashlib
+
+# environment variable set by run.py (--stageAtlas)
+STAGE_ENV = 'BRAINSUITE_ATLAS_SCRATCH'
+# free space kept on the scratch folder after staging an atlas, in bytes
+HEADROOM = 1024 ** 3
+
+def atlasFiles(atlasDir):
+    '''
+    Lists the files of an atlas folder as (path relative to atlasDir, size, mtime).
+    '''
+    files = []
+    for directory, _, names in os.walk(atlasDir):
+        for name in sorted(names):
+            st = os.stat(os.path.join(directory, name))
+            files.append((os.path.relpath(os.path.join(directory, name), atlasDir), st.st_size, st.st_mtime))
+    return sorted(files)
+
+def stagedAtlasDir(atlasDir, scratchDir):
+    '''
+    Folder of the staged copy of atlasDir. Its name changes with the contents of atlasDir, so that an atlas
+    updated in the container is staged again.
+    '''
+    fingerprint = hashlib.sha256(repr([os.environ.get('BrainSuiteVersion'), os.path.abspath(atlasDir),
+                                       atlasFiles(atlasDir)]).encode('utf-8')).hexdigest()
+    return os.path.join(scratchDir, '{0}-{1}'.format(os.path.basename(atlasDir), fingerprint[:16]))
+
+def stageAtlas(atlasPrefix, scratchDir):
+    '''
+    Copies the folder of the SVReg atlas atlasPrefix into scratchDir (local disk or tmpfs), once per machine:
+    concurrent processes wait for the copy of the first one, and later runs reuse it. Returns the prefix of the
+    staged atlas, or atlasPrefix if the atlas cannot be staged.
+    '''
+    atlasDir = os.path.dirname(atlasPrefix)
+    stagedDir = stagedAtlasDir(atlasDir, scratchDir)
+    stagedPrefix = os.path.join(stagedDir, os.path.basename(atlasPrefix))
+    if os.path.isdir(stagedDir):
+        return stagedPrefix
+    try:
+        if not os.path.exists(scratchDir):
+            os.makedirs(scratchDir)
+        with open(os.path.join(scratchDir, '.stageAtlas.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.isdir(stagedDir):
+                    return stagedPrefix
+                size = sum([fileSize for _, fileSize, _ in atlasFiles(atlasDir)])
+                if shutil.disk_usage(scratchDir).free < size + HEADROOM:
+                    print('Not enough space in {0} to stage the atlas {1}; reading it from {2}.'.format(
+                        scratchDir, os.path.basename(atlasDir), atlasDir))
+                    return atlasPrefix
+                print('Staging the atlas {0} in {1}...'.format(atlasDir, stagedDir))
+                # the staged folder only appears once it is complete
+                tmpDir = '{0}.{1}.tmp'.format(stagedDir, os.getpid())
+                if os.path.exists(tmpDir):
+                    shutil.rmtree(tmpDir)
+                try:
+                    shutil.copytree(atlasDir, tmpDir)
+                    os.rename(tmpDir, stagedDir)
+                except (IOError, OSError, shutil.Error):
+                    shutil.rmtree(tmpDir, ignore_errors=True)
+                    raise
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+    except (IOError, OSError, shutil.Error) as e:
+        sys.stdout.write('Could not stage the atlas {0} in {1} ({2}); reading it from {0}.\n'.format(
+            atlasDir, scratchDir, e))
+        return atlasPrefix
+    return stagedPrefix
+
+def stagedAtlas(atlasPrefix):
+    '''
+    Returns the prefix to read the atlas atlasPrefix from: its staged copy if atlas staging is enabled (see
+    run.py --stageAtlas), otherwise atlasPrefix.
+    '''
+    scratchDir = os.environ.get(STAGE_ENV)
+    if not scratchDir or not os.path.isdir(os.path.dirname(atlasPrefix)):
+        return atlasPrefix
+    return stageAtlas(atlasPrefix, scratchDir)
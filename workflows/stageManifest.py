@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+import json
+import hashlib
+
+MANIFEST_FILE = 'stageManifest.json'
+
+def sha256sum(filename):
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+class stageManifest(object):
+    '''
+    Completion manifest of a subject's output directory. For each stage group (see QC/stageNumDict.py) that
+    finished without errors, the manifest holds the size, modification time and sha256 checksum of its
+    expected output files, along with a digest of the parameters it was run with.
+
+    A stage group is complete if its files still match the manifest. Checksums are only recomputed for files
+    whose size or modification time differ from the recorded ones.
+    '''
+
+    def __init__(self, outputdir):
+        self.manifestFile = os.path.join(outputdir, MANIFEST_FILE)
+        self.stages = {}
+        if os.path.exists(self.manifestFile):
+            try:
+                with open(self.manifestFile, 'r') as f:
+                    self.stages = json.load(f)
+            except ValueError:
+                self.stages = {}
+
+    def save(self):
+        tmpFile = '{0}.{1}.tmp'.format(self.manifestFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump(self.stages, f, indent=1)
+        os.rename(tmpFile, self.manifestFile)
+
+    def isComplete(self, stage, files, parameters):
+        record = self.stages.get(stage)
+        if record is None or record['parameters'] != parameters or sorted(record['files']) != sorted(files):
+            return False
+        updated = False
+        for filename in files:
+            entry = record['files'][filename]
+            try:
+                st = os.stat(filename)
+            except OSError:
+                return False
+            if st.st_size == entry['size'] and st.st_mtime == entry['mtime']:
+                continue
+            if st.st_size != entry['size'] or sha256sum(filename) != entry['sha256']:
+                return False
+            # same contents, e.g. the file was copied or touched
+            entry['mtime'] = st.st_mtime
+            updated = True
+        if updated:
+            self.save()
+        return True
+
+    def record(self, stage, files, parameters):
+        '''
+        Records the output files of a stage group. Returns False (and drops any previous record) if one of
+        the files is missing.
+        '''
+        entries = {}
+        for filename in files:
+            if not os.path.exists(filename):
+                self.stages.pop(stage, None)
+                self.save()
+                return False
+            st = os.stat(filename)
+            entries[filename] = {'size': st.st_size, 'mtime': st.st_mtime, 'sha256': sha256sum(filename)}
+        self.stages[stage] = {'parameters': parameters, 'files': entries}
+        self.save()
+        return True
+
+    def invalidate(self, stage):
+        if stage in self.stages:
+            self.stages.pop(stage)
+            self.save()
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+# Declarative description of the stages of the subject workflow (see subjLevelProcessing.addStages). Each entry
+# describes one node:
+#   stage       name of the stage in QC/stageNumDict.py whose QC state the node reports
+#   node        name of the nipype node
+#   interface   BrainSuite interface class (nipype/brainsuite); its resources come from RESOURCE_PROFILES
+#   parameters  inputs set from the attribute of the same name of subjLevelProcessing (the preprocessing spec)
+#   inputs      fixed inputs; strings are formatted with the build context (subject, anat, webpath, ...)
+#   connect     (source node, source output, input[, file read instead if the source is not in the workflow])
+#   renders     QC thumbnail nodes of the stage, described in the same way (without stage), built with QC only
+
+SURFACE_VIEWS = ['Left', 'Right', 'Sup', 'Inf']
+
+CSE_STAGES = [
+    {'stage': 'BSE', 'node': 'BSE', 'interface': 'Bse',
+     'parameters': ['diffusionIterations', 'diffusionConstant', 'edgeDetectionConstant', 'autoParameters',
+                    'prescale'],
+     'inputs': {'inputMRIFile': '{anat}{t1}'},
+     'renders': [
+         {'node': 'volblendbse', 'interface': 'VolsliceBatch',
+          'inputs': {'inFile': '{anat}{t1}',
+                     'views': [{'outFile': '{webpath}/bse.png', 'view': 3}]}, # sagittal
+          'connect': [('BSE', 'outputMaskFile', 'maskFile')]}]},
+    {'stage': 'BFC', 'node': 'BFC', 'interface': 'Bfc',
+     'parameters': ['iterativeMode'],
+     'connect': [('BSE', 'outputMRIVolume', 'inputMRIFile', '{anat}{subject}_T1w.bse.nii.gz')],
+     'renders': [
+         {'node': 'volblendbfc', 'interface': 'VolsliceBatch',
+          'inputs': {'views': [{'outFile': '{webpath}/bfc.png', 'view': 1}]},
+          'connect': [('BFC', 'outputMRIVolume', 'inFile')]}]},
+    {'stage': 'PVC', 'node': 'PVC', 'interface': 'Pvc',
+     'parameters': ['spatialPrior'],
+     'connect': [('BFC', 'outputMRIVolume', 'inputMRIFile')],
+     'renders': [
+         {'node': 'volblendpvc', 'interface': 'VolsliceBatch',
+          'inputs': {'inFile': '{anat}{subject}_T1w.bfc.nii.gz',
+                     'views': [{'outFile': '{webpath}/pvc.png', 'labelDesc': '{labeldesc}', 'view': 1}]}, # axial
+          'connect': [('PVC', 'outputLabelFile', 'labelFile')]}]},
+    {'stage': 'CEREBRO', 'node': 'CEREBRO', 'interface': 'Cerebro',
+     'parameters': ['useCentroids', 'costFunction', 'linearConvergence', 'warpConvergence', 'warpLevel'],
+     'inputs': {'inputAtlasMRIFile': '{atlasMRI}',
+                'inputAtlasLabelFile': '{atlasLabel}',
+                'inputBrainMaskFile': '{anat}{subject}_T1w.mask.nii.gz'},
+     'connect': [('BFC', 'outputMRIVolume', 'inputMRIFile')],
+     'renders': [
+         {'node': 'volblendcerebro', 'interface': 'VolsliceBatch',
+          'inputs': {'inFile': '{anat}{t1}',
+                     'views': [{'outFile': '{webpath}/cerebro.png', 'labelFile': '', 'view': 3},
+                               {'outFile': '{webpath}/hemilabel.png', 'maskFile': '', 'labelDesc': '{labeldesc}',
+                                'view': 2}]},
+          'connect': [('CEREBRO', 'outputCerebrumMaskFile', 'maskFile'),
+                      ('CEREBRO', 'outputLabelVolumeFile', 'labelFile')]}]},
+    {'stage': 'CORTEX', 'node': 'CORTEX', 'interface': 'Cortex',
+     'parameters': ['tissueFractionThreshold'],
+     'connect': [('PVC', 'outputTissueFractionFile', 'inputTissueFractionFile'),
+                 ('CEREBRO', 'outputLabelVolumeFile', 'inputHemisphereLabelFile')]},
+    {'stage': 'SCRUBMASK', 'node': 'SCRUBMASK', 'interface': 'Scrubmask',
+     'connect': [('CORTEX', 'outputCerebrumMask', 'inputMaskFile')]},
+    {'stage': 'TCA', 'node': 'TCA', 'interface': 'Tca',
+     'inputs': {'minCorrectionSize': 2500, 'foregroundDelta': 20},
+     'connect': [('SCRUBMASK', 'outputMaskFile', 'inputMaskFile')]},
+    {'stage': 'DEWISP', 'node': 'DEWISP', 'interface': 'Dewisp',
+     'connect': [('TCA', 'outputMaskFile', 'inputMaskFile')],
+     'renders': [
+         {'node': 'volblenddewisp', 'interface': 'VolsliceBatch',
+          'inputs': {'inFile': '{anat}{subject}_T1w.bfc.nii.gz',
+                     'views': [{'outFile': '{webpath}/dewisp.png', 'view': 1},
+                               {'outFile': '{webpath}/dewispCor.png', 'view': 2}]},
+          'connect': [('DEWISP', 'outputMaskFile', 'maskFile')]}]},
+    {'stage': 'DFS', 'node': 'DFS', 'interface': 'Dfs',
+     'connect': [('DEWISP', 'outputMaskFile', 'inputVolumeFile')],
+     'renders': [
+         {'node': 'dfsrenderdfs', 'interface': 'RenderDfsViews',
+          'inputs': {'Zoom': 0.6, 'CenterVol': '{anat}{subject}_T1w.bfc.nii.gz',
+                     'views': [{'OutFile': '{webpath}/dfs' + view + '.png', 'view': view}
+                               for view in SURFACE_VIEWS]},
+          'connect': [('DFS', 'outputSurfaceFile', 'Surfaces')]}]},
+    {'stage': 'PIALMESH', 'node': 'PIALMESH', 'interface': 'Pialmesh',
+     'inputs': {'tissueThreshold': 1.05},
+     'connect': [('DFS', 'outputSurfaceFile', 'inputSurfaceFile'),
+                 ('PVC', 'outputTissueFractionFile', 'inputTissueFractionFile'),
+                 ('CEREBRO', 'outputCerebrumMaskFile', 'inputMaskFile')]},
+    {'stage': 'HEMISPLIT', 'node': 'HEMISPLIT', 'interface': 'Hemisplit',
+     'connect': [('PIALMESH', 'outputSurfaceFile', 'pialSurfaceFile'),
+                 ('DFS', 'outputSurfaceFile', 'inputSurfaceFile'),
+                 ('CEREBRO', 'outputLabelVolumeFile', 'inputHemisphereLabelFile')],
+     'renders': [
+         {'node': 'dfsrenderhemisplit', 'interface': 'RenderDfsViews',
+          'inputs': {'Surfaces': '{anat}/{subject}_T1w.left.pial.cortex.dfs '
+                                 '{anat}/{subject}_T1w.right.pial.cortex.dfs',
+                     'views': [{'OutFile': '{webpath}/hemisplit.png', 'view': 'Sup'}],
+                     'Zoom': 0.6, 'CenterVol': '{anat}{subject}_T1w.bfc.nii.gz',
+                     'UseColors': '0 0.5 0.75 1 0.5 0.25'},
+          'connect': [('HEMISPLIT', 'outputRightPialHemisphere', 'Surfbilateral')]}]},
+    {'stage': 'THICKPVC', 'node': 'ThickPVC', 'interface': 'ThicknessPVC',
+     'inputs': {'subjectFilePrefix': '{anat}/{subject}_T1w'},
+     # ordering edge: thicknessPVC reads the CSE outputs from disk
+     'connect': [('HEMISPLIT', 'outputRightPialHemisphere', 'dataSinkDelay')],
+     'renders': [
+         {'node': 'dfsrenderThick', 'interface': 'RenderDfsViews',
+          'inputs': {'Surfaces': '{anat}/{subject}_T1w.pvc-thickness_0-6mm.left.mid.cortex.dfs '
+                                 '{anat}/{subject}_T1w.pvc-thickness_0-6mm.right.mid.cortex.dfs',
+                     'Zoom': 0.6, 'CenterVol': '{anat}{subject}_T1w.bfc.nii.gz',
+                     'views': [{'OutFile': '{webpath}/Thickdfs' + view + '.png', 'view': view}
+                               for view in SURFACE_VIEWS]},
+          'connect': [('ThickPVC', 'atlasSurfRightFile', 'Surfbilateral')]}]},
+]
+
+# (measure in the BDP file names, suffix of the BDP output, suffix of the node names, suffix of the stage names)
+DWI_MEASURE_STAGES = [('FA', 'FA', 'FA', 'FA'),
+                      ('MD', 'MD', 'MD', 'MD'),
+                      ('axial', 'Axial', 'AXIAL', 'AXIAL'),
+                      ('radial', 'Radial', 'RADIAL', 'RADIAL'),
+                      ('mADC', 'MADC', 'mADC', 'MADC'),
+                      ('FRT_GFA', 'FRTGFA', 'FRTGFA', 'FRTGFA')]
+
+def svregBdpStages():
+    '''
+    SVREG+BDP: each diffusion measure is mapped to the atlas, then smoothed. When resuming, SVREG or BDP may have
+    been left out of the workflow; their outputs are then read from disk.
+    '''
+    stages = []
+    for measure, bdpOutput, nodeSuffix, stageSuffix in DWI_MEASURE_STAGES:
+        stages.extend([
+            {'stage': 'APPLYMAP' + stageSuffix, 'node': 'APPLYMAP' + nodeSuffix, 'interface': 'SVRegApplyMap',
+             'inputs': {'outFile': '{dwi}/{subject}_dwi.dwi.RAS.{distcorr}atlas.' + measure + '.nii.gz',
+                        'targetFile': '{atlas}.bfc.nii.gz'},
+             'connect': [('SVREG', 'InvMapFile', 'mapFile', '{anat}/{subject}_T1w.svreg.inv.map.nii.gz'),
+                         ('BDP', '{distcorrOutput}' + bdpOutput, 'dataFile',
+                          '{dwi}/{subject}_dwi.dwi.RAS.{distcorr}' + measure + '.T1_coord.nii.gz')]},
+            {'stage': 'SMOOTHVOL' + stageSuffix, 'node': 'SMOOTHVOL' + stageSuffix, 'interface': 'GSmooth',
+             'inputs': {'sigma': '{smoothVolStd}',
+                        'outFile': '{dwi}/{subject}_dwi.dwi.RAS.{distcorr}atlas.' + measure +
+                                   '.smooth{smoothvol}mm.nii.gz'},
+             'connect': [('APPLYMAP' + nodeSuffix, 'mappedFile', 'inFile')]}])
+    return stages
+
+SVREG_BDP_STAGES = svregBdpStages()
+
+def expand(value, context):
+    '''
+    Formats the strings of a table value (possibly nested in lists, tuples and dictionaries) with context.
+    '''
+    if isinstance(value, dict):
+        return dict((key, expand(item, context)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return type(value)([expand(item, context) for item in value])
+    if isinstance(value, str):
+        return value.format(**context)
+    return value
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import sys
+from QC.stageNumDict import stageNumDict
+from QC.stateStore import qcStateStore, completed, launched, errored, blocked
+
+def succeeded(node):
+    '''
+    BrainSuite interfaces do not raise when their command fails; the return code is in the node's result.
+    '''
+    try:
+        returncode = getattr(node.result.runtime, 'returncode', 0)
+    except (IOError, OSError, AttributeError):
+        return False
+    return not returncode
+
+class qcStateHooks(object):
+    '''
+    nipype status callback (plugin_args['status_callback']) that records the QC state of a stage when the nodes
+    of the stage start and finish, in the scheduler process, instead of QCState bookkeeping nodes. When a node
+    fails, its stage is marked errored and every stage that depends on it, directly or not, blocked, as soon as
+    the failure is reported. Subject workflows are registered by name, so one instance serves a single subject
+    or a cohort-level workflow.
+    '''
+
+    def __init__(self):
+        self.workflows = {}
+
+    def register(self, workflowName, statesDir, stageNodes, downstream=None):
+        '''
+        stageNodes maps the names of the nodes of the workflow to the name of their stage. A stage made of several
+        nodes is complete once all of them have finished. downstream maps the names of the nodes to the stages
+        that depend on them. Without statesDir (no QC), failures are only tracked (see failedStages).
+        '''
+        pending = {}
+        for nodeName, stage in stageNodes.items():
+            pending.setdefault(stage, set()).add(nodeName)
+        self.workflows[workflowName] = {'store': qcStateStore(statesDir) if statesDir else None,
+                                        'stages': dict(stageNodes),
+                                        'pending': pending,
+                                        'downstream': downstream or {},
+                                        'errored': set(),
+                                        'blocked': set(),
+                                        'executed': []}
+
+    def failedStages(self, workflowName):
+        '''
+        Names of the stages of a registered workflow that failed or were blocked by a failure.
+        '''
+        subject = self.workflows[workflowName]
+        return sorted(subject['errored'] | subject['blocked'])
+
+    def executedNodes(self, workflowName):
+        '''
+        Nodes of a registered workflow that have finished, with or without errors (or were found in nipype's
+        cache). Unlike the graph returned by Workflow.run, they are known when a node raised and the run did not
+        execute cleanly.
+        '''
+        return list(self.workflows[workflowName]['executed'])
+
+    def __call__(self, node, status):
+        subject = self.workflows.get((node._hierarchy or '').split('.')[-1])
+        if subject is None:
+            return
+        if status != 'start':
+            subject['executed'].append(node)
+        stage = subject['stages'].get(node.name)
+        if stage in subject['errored'] or stage in subject['blocked']:
+            # BrainSuite commands do not raise, so nipype still runs the nodes downstream of a failure; their
+            # stages keep the state of the failure
+            stage = None
+        states = {}
+        if status == 'start':
+            if stage is not None:
+                states[stageNumDict[stage]] = launched
+        elif status == 'end' and succeeded(node):
+            if stage is not None:
+                subject['pending'][stage].discard(node.name)
+                if len(subject['pending'][stage]) == 0:
+                    states[stageNumDict[stage]] = completed
+        else:
+            # 'exception', or a BrainSuite command that exited with an error
+            if stage is not None:
+                subject['errored'].add(stage)
+                states[stageNumDict[stage]] = errored
+            for downstreamStage in subject['downstream'].get(node.name, []):
+                if downstreamStage not in subject['errored']:
+                    subject['blocked'].add(downstreamStage)
+                    states[stageNumDict[downstreamStage]] = blocked
+        if subject['store'] is None or len(states) == 0:
+            return
+        try:
+            subject['store'].update(states)
+        except (IOError, OSError) as e:
+            # the QC states are informative; never stop the scheduler because of them
+            sys.stdout.write('Could not record the QC state of {0} ({1}).\n'.format(node.name, e))
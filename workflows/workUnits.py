@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+'''
+Copyright (C) 2023 The Regents of the University of California
+
+This file is part of the BrainSuite BIDS App.
+
+The BrainSuite BIDS App is free software; you can redistribute it and/or
+modify it under the terms of the GNU Lesser General Public License
+as published by the Free Software Foundation, version 2.1.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+Lesser General Public License for more details.
+
+You should have received a copy of the GNU Lesser General Public
+License along with this library; if not, write to the Free Software
+Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+'''
+
+import os
+
+EXTENSIONS = ["nii.gz", "nii"]
+
+def getFiles(layout, subject_label, datatype, **entities):
+    return layout.get(subject_label, datatype, extensions=EXTENSIONS, **entities)
+
+def makeWorkUnit(layout, subject_label, **entities):
+    return {'subject_label': subject_label,
+            't1ws': getFiles(layout, subject_label, 'T1w', **entities),
+            'dwis': getFiles(layout, subject_label, 'dwi', **entities),
+            'funcs': getFiles(layout, subject_label, 'bold', **entities)}
+
+def enumerateWorkUnits(layout, subject_label, args):
+    '''
+    Lists the session/run combinations of a subject that are processed by runWorkflow. Each work unit is a
+    dictionary with the subject label and its T1w, dwi and bold files. layout is a readSpecs.readBidsIndex.bidsIndex.
+    '''
+    workUnits = []
+    sessions = layout.get_sessions(subject_label, 'T1w', extensions=EXTENSIONS)
+    if args.session:
+        sessions = args.session
+    if len(sessions) > 0:
+        for ses in sessions:
+            runs = layout.get_runs(subject_label, 'T1w', session=ses, extensions=EXTENSIONS)
+            if len(runs) > 0:
+                for r in runs:
+                    workUnits.append(makeWorkUnit(layout, subject_label, session=ses, run=r))
+            else:
+                workUnits.append(makeWorkUnit(layout, subject_label, session=ses))
+    else:
+        runs = layout.get_runs(subject_label, 'T1w', extensions=EXTENSIONS)
+        if len(runs) > 0:
+            for r in runs:
+                workUnits.append(makeWorkUnit(layout, subject_label, run=r))
+        else:
+            workUnits.append(makeWorkUnit(layout, subject_label))
+    return workUnits
+
+# Relative cost of the pipelines run on a work unit, used to balance work units across shards
+COST_WEIGHTS = {'T1w': 1.0,
+                'dwi': 0.75,
+                'bold': 0.5}
+
+def unitCost(unit, stages):
+    cost = 0.0
+    if 'CSE' in stages or 'SVREG' in stages:
+        cost += COST_WEIGHTS['T1w'] * len(unit['t1ws'])
+    if 'BDP' in stages:
+        cost += COST_WEIGHTS['dwi'] * min(len(unit['dwis']), len(unit['t1ws']))
+    if 'BFP' in stages:
+        cost += COST_WEIGHTS['bold'] * len(unit['funcs'])
+    return cost
+
+def shardWorkUnits(workUnits, shardIndex, shardCount, stages):
+    '''
+    Splits the work units into shardCount shards of similar expected cost and returns the work units of
+    shard shardIndex (0-based). Work units are assigned greedily, most expensive first, to the shard with
+    the lowest total cost; ties are broken on the T1w file names and shard index so that every job of an
+    array computes the same assignment.
+    '''
+    order = sorted(workUnits, key=lambda unit: (-unitCost(unit, stages), unit['subject_label'], unit['t1ws']))
+    loads = [0.0] * shardCount
+    shard = set()
+    for unit in order:
+        target = min(range(shardCount), key=lambda s: (loads[s], s))
+        loads[target] += unitCost(unit, stages)
+        if target == shardIndex:
+            shard.add(id(unit))
+    # keep the enumeration order within the shard
+    return [unit for unit in workUnits if id(unit) in shard]
+
+def arrayJobShard():
+    '''
+    Reads the shard index and shard count from the environment of a SLURM or SGE array job.
+    Returns (None, None) if no array job is detected.
+    '''
+    env = os.environ
+    if env.get('SLURM_ARRAY_TASK_ID'):
+        first = int(env.get('SLURM_ARRAY_TASK_MIN', 0))
+        step = int(env.get('SLURM_ARRAY_TASK_STEP', 1))
+        if env.get('SLURM_ARRAY_TASK_MAX'):
+            count = (int(env['SLURM_ARRAY_TASK_MAX']) - first) // step + 1
+        else:
+            count = int(env['SLURM_ARRAY_TASK_COUNT'])
+        return (int(env['SLURM_ARRAY_TASK_ID']) - first) // step, count
+    if env.get('SGE_TASK_ID', 'undefined') != 'undefined':
+        first = int(env['SGE_TASK_FIRST'])
+        step = int(env.get('SGE_TASK_STEPSIZE', 1))
+        return (int(env['SGE_TASK_ID']) - first) // step, (int(env['SGE_TASK_LAST']) - first) // step + 1
+    return None, None